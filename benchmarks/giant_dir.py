@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+""" Peak memory benchmark for updating a project with a giant directory.
+
+Creates a project whose top directory holds a growing number of files (and
+a fan-out of empty subdirectories), and updates it at each size in a fresh
+process, reporting the seconds taken, the seconds until the first ACL was
+written and the peak RSS. With the walk streaming entries as `scandir`
+reads them, the peak RSS should stay flat as the directory grows:
+
+    python3 benchmarks/giant_dir.py [--files N] [--dirs D] [-j JOBS]
+            [--backend xattr|posix1e|memory]
+
+ACLs are set for real by default, which needs an ACL-capable filesystem but
+not root, as the caller owns the files. The memory backend keeps every
+entry's ACL, so its peak RSS grows with the directory by design.
+"""
+import os
+import sys
+import pwd
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import project_manager
+from suite import run, peak_rss
+
+def fill(top, start, stop):
+    """ Creates files `start` to `stop` (exclusive) in `top`."""
+    for i in range(start, stop):
+        os.close(os.open(os.path.join(top, 'f%07d' % i), os.O_CREAT | os.O_WRONLY, 0o644))
+
+def measure(root, backend, jobs):
+    """ Updates the 'giant' project below `root` in this process; prints the
+    seconds taken, seconds until the first ACL write and peak RSS in MiB."""
+    project_manager.PROJECT_ROOT = root
+    project_manager.ACL_BACKEND = backend
+    project_manager.logger.setLevel(logging.ERROR)
+    acls = project_manager.acl_backend()
+    write = acls.write
+    first = []
+    def timed_write(path, acl, default=False):
+        if not first:
+            first.append(time.perf_counter())
+        write(path, acl, default)
+    acls.write = timed_write
+    executer = pwd.getpwuid(os.getuid()).pw_name
+    start = time.perf_counter()
+    run(['update', '-j', str(jobs), 'giant'], executer)
+    elapsed = time.perf_counter() - start
+    print("%f %f %f" % (elapsed, (first or [start])[0] - start, peak_rss()))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--files", type=int, default=400000,
+            help="number of files in the directory at the largest size")
+    parser.add_argument("--dirs", type=int, default=5000,
+            help="number of (empty) subdirectories in the directory")
+    parser.add_argument("--steps", type=int, default=3,
+            help="number of sizes, each 4 times the previous one")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+            help="number of workers")
+    parser.add_argument("--dir", help="where to create the PROJECT_ROOT (default: $TMPDIR)")
+    parser.add_argument("--backend", choices=['xattr', 'posix1e', 'memory'],
+            default='xattr', help="ACL backend")
+    parser.add_argument("--measure", nargs=3, metavar=("ROOT", "BACKEND", "JOBS"),
+            help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        return measure(args.measure[0], args.measure[1], int(args.measure[2]))
+
+    root = tempfile.mkdtemp(prefix='project-giant-', dir=args.dir)
+    try:
+        project_manager.PROJECT_ROOT = root
+        top = project_manager.project_dir_path('giant')
+        os.mkdir(top)
+        for i in range(args.dirs):
+            os.mkdir(os.path.join(top, 'd%05d' % i))
+        project_manager.ProjectDB('giant', pwd.getpwuid(os.getuid()).pw_name).save()
+
+        print("%s: %d subdirectories, %s backend, %d jobs" % (
+                root, args.dirs, args.backend, args.jobs))
+        print("%10s %10s %14s %14s" % ("files", "seconds", "first write s",
+                "peak RSS MiB"))
+        sizes = [args.files // 4 ** i for i in reversed(range(args.steps))]
+        made = 0
+        for size in sizes:
+            fill(top, made, size)
+            made = size
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                    '--measure', root, args.backend, str(args.jobs)])
+            elapsed, first, rss = (float(field) for field in out.split())
+            print("%10d %10.3f %14.4f %14.1f" % (size, elapsed, first, rss))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+""" Startup time benchmark for the project tool.
+
+Times cheap commands (the ones run on every Tab press and by scripts) from
+interpreter start to exit, against a throwaway PROJECT_ROOT, and shows which
+modules dominate `python -X importtime`. Run it before and after changing
+imports or the argument parser:
+
+    python3 benchmarks/startup.py [-n RUNS] [-p PROJECTS]
+"""
+import os
+import sys
+import pwd
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), 'project_manager.py')
+# how wrapper.c runs the tool: importing it, so its bytecode is cached
+LAUNCH = [sys.executable, '-I', '-c', "import sys; sys.path.insert(0, %r); "
+        "import project_manager; project_manager.main()" % os.path.dirname(SCRIPT)]
+
+COMMANDS = [
+    ['help'],
+    ['list', '--all'],
+    ['list'],
+    ['info', 'project0'],
+    ['update', '--help'],
+    ['__complete', 'projects'],
+    ['__complete', 'members', 'project0'],
+]
+
+def make_root(nprojects):
+    """ Creates a PROJECT_ROOT with `nprojects` empty projects owned by the
+    current user."""
+    root = tempfile.mkdtemp(prefix='project-startup-')
+    user = pwd.getpwuid(os.getuid()).pw_name
+    for i in range(nprojects):
+        name = 'project%d' % i
+        os.mkdir(os.path.join(root, name))
+        with open(os.path.join(root, '.%s.yml' % name), 'w') as fobj:
+            fobj.write("owner: %s\npublic: false\nmembers: []\ncollaborators: []\n" % user)
+    return root
+
+def time_command(argv, runs, root=None):
+    """ Returns the wall clock times (in ms) of `runs` runs of `argv`, with
+    PROJECT_ROOT `root` if given."""
+    env = dict(os.environ, PROJECT_ROOT=root) if root else None
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                env=env)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def import_profile(root, argv):
+    """ Returns (cumulative us, module) for each module imported directly
+    while running `argv`, slowest first."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT, '-P', root] + argv,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        if len(name) - len(name.lstrip()) == 1:     # imported by the script
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--runs", type=int, default=20,
+            help="number of runs per command")
+    parser.add_argument("-p", "--projects", type=int, default=200,
+            help="number of projects in the scratch PROJECT_ROOT")
+    parser.add_argument("-t", "--top", type=int, default=10,
+            help="number of imports to show")
+    args = parser.parse_args()
+
+    root = make_root(args.projects)
+    try:
+        # build the project index and the completion cache once so that
+        # `list` and `__complete` measure the steady state (PROJECT_ROOT is
+        # passed in the environment rather than with -P, as `__complete`
+        # must come first to take the fast path)
+        time_command(LAUNCH + ['list'], 1, root)
+        time_command(LAUNCH + ['__complete', 'projects'], 1, root)
+
+        print("%-28s %10s %10s" % ("command", "median ms", "min ms"))
+        baseline = time_command([sys.executable, '-c', 'pass'], args.runs)
+        print("%-28s %10.1f %10.1f" % ("(bare interpreter)",
+                statistics.median(baseline), min(baseline)))
+        for argv in COMMANDS:
+            times = time_command(LAUNCH + argv, args.runs, root)
+            print("%-28s %10.1f %10.1f" % (' '.join(argv),
+                    statistics.median(times), min(times)))
+
+        print("\nslowest imports for 'list' (cumulative us):")
+        for cumulative, name in import_profile(root, ['list'])[:args.top]:
+            print("%10d  %s" % (cumulative, name))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+""" Throughput benchmark for the project tool's tree walking commands.
+
+Generates a synthetic PROJECT_ROOT (many projects, each a tree of the given
+depth and width with files and symbolic links in every directory), then
+times create, update, check, du, list, adduser and deluser against it and
+reports entries per second and peak memory. ACLs are kept in memory unless
+another --backend is given, so it runs without root or an ACL-capable
+filesystem:
+
+    python3 benchmarks/suite.py [-p PROJECTS] [--depth D] [--width W] [--files F]
+            [--backend memory|xattr|posix1e]
+
+The defaults make ~30k entries; e.g. `-p 50 --depth 4 --width 6 --files 20`
+makes about 1.8 million.
+"""
+import io
+import os
+import sys
+import pwd
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import contextlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import project_manager
+
+def make_tree(top, depth, width, files):
+    """ Creates `width` subdirectories `depth` levels deep under `top`, each
+    directory holding `files` files (every other one executable) and two
+    symbolic links, one to a sibling file and one leaving the project.
+    Returns the number of entries created."""
+    count = 0
+    for i in range(files):
+        path = os.path.join(top, 'file%d' % i)
+        with open(path, 'w') as fobj:
+            fobj.write('x')
+        if i % 2:
+            os.chmod(path, 0o755)
+        count += 1
+    if files:
+        os.symlink('file0', os.path.join(top, 'link'))
+        count += 1
+    os.symlink('/etc', os.path.join(top, 'outside'))
+    count += 1
+    if depth > 0:
+        for i in range(width):
+            sub = os.path.join(top, 'dir%d' % i)
+            os.mkdir(sub)
+            count += 1 + make_tree(sub, depth - 1, width, files)
+    return count
+
+def make_root(args, owner, members):
+    """ Creates the synthetic PROJECT_ROOT; returns it and the number of
+    entries in one project."""
+    root = tempfile.mkdtemp(prefix='project-bench-', dir=args.dir)
+    project_manager.PROJECT_ROOT = root
+    entries = 0
+    for i in range(args.projects):
+        name = 'bench%d' % i
+        os.mkdir(project_manager.project_dir_path(name))
+        entries = 1 + make_tree(project_manager.project_dir_path(name),
+                args.depth, args.width, args.files)
+        project_manager.ProjectDB(name, owner, members=members[:1]).save()
+    return root, entries
+
+def run(argv, executer):
+    """ Runs project command line `argv` in this process, discarding its output."""
+    parser, _ = project_manager.build_parser(project_manager.requested_command(argv))
+    args = parser.parse_args(argv)
+    args.executer = executer
+    with contextlib.redirect_stdout(io.StringIO()):
+        project_manager.dispatch(args)
+
+def reset_peak_rss():
+    """ Resets the peak RSS of this process (Linux >= 4.0); returns False if
+    it can't, in which case peaks are the process' high-water mark."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fobj:
+            fobj.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def peak_rss():
+    """ Returns the peak RSS of this process, in MiB."""
+    try:
+        with open('/proc/self/status') as fobj:
+            for line in fobj:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-p", "--projects", type=int, default=10,
+            help="number of projects")
+    parser.add_argument("--depth", type=int, default=3, help="depth of each project tree")
+    parser.add_argument("--width", type=int, default=5,
+            help="number of subdirectories in each directory")
+    parser.add_argument("--files", type=int, default=15,
+            help="number of files in each directory")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+            help="number of workers for the parallel runs")
+    parser.add_argument("--dir", help="where to create the PROJECT_ROOT (default: $TMPDIR)")
+    parser.add_argument("--backend", choices=['memory', 'xattr', 'posix1e'],
+            default='memory',
+            help="ACL backend (all but memory need an ACL-capable filesystem)")
+    parser.add_argument("--keep", action="store_true",
+            help="don't delete the PROJECT_ROOT afterwards")
+    args = parser.parse_args()
+
+    project_manager.ACL_BACKEND = args.backend
+    project_manager.logger.setLevel(logging.ERROR)    # escaping symlinks warn
+
+    executer = pwd.getpwuid(os.getuid()).pw_name
+    # adduser/deluser need real accounts other than the owner
+    others = [pw.pw_name for pw in pwd.getpwall() if pw.pw_name != executer][:2]
+    if not others:
+        parser.error("needs at least one user account besides %s" % executer)
+
+    start = time.perf_counter()
+    root, entries = make_root(args, executer, others)
+    total = entries * args.projects
+    print("%s: %d projects of %d entries (%d in all), generated in %.1fs" % (
+            root, args.projects, entries, total, time.perf_counter() - start))
+
+    # (label, command lines, entries they walk)
+    operations = [
+        ("create", [['create', 'bench-new']], 0),
+        ("update all (first)", [['update', 'bench%d' % i] for i in range(args.projects)], total),
+        ("update", [['update', 'bench0']], entries),
+        ("update -i", [['update', '-i', 'bench0']], entries),
+        ("update -j %d" % args.jobs, [['update', '-j', str(args.jobs), 'bench1']], entries),
+        ("adduser", [['adduser', 'bench0', 'collaborator', others[-1]]], entries),
+        ("deluser", [['deluser', 'bench0', others[-1]]], entries),
+        ("list", [['list']], 0),
+        ("list --all", [['list', '--all']], 0),
+        ("check", [['check', '-j', str(args.jobs)]], 0),
+        ("check --deep", [['check', '--deep', '-j', str(args.jobs)]], total),
+        ("check --sample 100", [['check', '--sample', '100', '-j', str(args.jobs)]], 0),
+        ("du --refresh", [['du', '--refresh', '-j', str(args.jobs), 'bench0']], entries),
+        ("du (cached)", [['du', '-j', str(args.jobs), 'bench0']], entries),
+    ]
+
+    print("%-20s %10s %12s %14s" % ("operation", "seconds", "entries/s", "peak RSS MiB"))
+    exact = True
+    try:
+        for label, argvs, walked in operations:
+            exact = reset_peak_rss() and exact
+            start = time.perf_counter()
+            for argv in argvs:
+                run(argv, executer)
+            elapsed = time.perf_counter() - start
+            rate = "%12.0f" % (walked / elapsed) if walked else "%12s" % "-"
+            print("%-20s %10.3f %s %14.1f" % (label, elapsed, rate, peak_rss()))
+        if not exact:
+            print("(can't reset the peak RSS here: it's the process' high-water mark)")
+    finally:
+        if args.keep:
+            print("kept %s" % root)
+        else:
+            shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -57,13 +57,11 @@ __projectcomp ()
     COMPREPLY=($(compgen -W "$list" -- "$cur"))
 }
 
+# `project __complete` answers from a small cache, without parsing configs
 __project_complete_projects ()
 {
     local cur="${COMP_WORDS[COMP_CWORD]}"
-    local root="/fmrif/projects"
-    #local projects=$(find /fmrif/projects/ -maxdepth 1 -type f -name "*.yml" -printf '%f\n' | sed 's/\.\(.\+\)\.yml/\1/g')
-    local projects=$(project list --all)
-
+    local projects=$(project __complete projects 2>/dev/null)
     COMPREPLY=($(compgen -W "$projects" -- "$cur"))
 }
 
@@ -73,11 +71,19 @@ __project_complete_roles ()
     COMPREPLY=($(compgen -W "collaborator member owner" -- "$cur"))
 }
 
+# users of the project at index $1
+__project_complete_members ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    local proj="${COMP_WORDS[$1]}"
+    local users=$(project __complete members "${proj}" 2>/dev/null)
+    COMPREPLY=($(compgen -W "$users" -- "$cur"))
+}
+
 __project_complete_usernames ()
 {
-    local idx=$1
-    local proj="${COMP_WORDS[idx]}"
-    local users=$(project info "${proj}" 2>/dev/null | egrep '^[[:space:]]+' | sed 's/\s//g')
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    local users=$(project __complete users 2>/dev/null)
     COMPREPLY=($(compgen -W "$users" -- "$cur"))
 }
 
@@ -86,7 +92,7 @@ _project_create ()
     local cur="${COMP_WORDS[COMP_CWORD]}"
     case "$cur" in
     -*)
-        __projectcomp "-h --help --public"
+        __projectcomp "-h --help --public -j --jobs"
         return
         ;;
     esac
@@ -133,7 +139,13 @@ _project_update ()
     local cur="${COMP_WORDS[COMP_CWORD]}"
     case "$cur" in
     -*)
-        __projectcomp "-h --help"
+        __projectcomp "-h --help -j --jobs -a --all -u --user -i --incremental --resume --wait --max-ops --nice --stats --stats-json --stats-top"
+        return
+        ;;
+    esac
+    case "${COMP_WORDS[COMP_CWORD-1]}" in
+    -u|--user)
+        __project_complete_usernames
         return
         ;;
     esac
@@ -145,7 +157,7 @@ _project_adduser ()
     local cur="${COMP_WORDS[COMP_CWORD]}"
     case "$cur" in
     -*)
-        __projectcomp "-h --help"
+        __projectcomp "-h --help -j --jobs"
         return
         ;;
     esac
@@ -156,6 +168,8 @@ _project_adduser ()
         __project_complete_projects
     elif [ "${COMP_CWORD}" -eq $((i+2)) ]; then
         __project_complete_roles
+    elif [ "${COMP_CWORD}" -gt $((i+2)) ]; then
+        __project_complete_usernames
     fi
 }
 
@@ -164,7 +178,7 @@ _project_moduser ()
     local cur="${COMP_WORDS[COMP_CWORD]}"
     case "$cur" in
     -*)
-        __projectcomp "-h --help"
+        __projectcomp "-h --help -j --jobs"
         return
         ;;
     esac
@@ -175,8 +189,8 @@ _project_moduser ()
         __project_complete_projects
     elif [ "${COMP_CWORD}" -eq $((i+2)) ]; then
         __project_complete_roles
-    elif [ "${COMP_CWORD}" -eq $((i+3)) ]; then
-        __project_complete_usernames $((i+1))
+    elif [ "${COMP_CWORD}" -gt $((i+2)) ]; then
+        __project_complete_members $((i+1))
     fi
 }
 
@@ -185,7 +199,7 @@ _project_deluser ()
     local cur="${COMP_WORDS[COMP_CWORD]}"
     case "$cur" in
     -*)
-        __projectcomp "-h --help"
+        __projectcomp "-h --help -j --jobs"
         return
         ;;
     esac
@@ -194,11 +208,35 @@ _project_deluser ()
 
     if [ "${COMP_CWORD}" -eq $((i+1)) ]; then
         __project_complete_projects
-    elif [ "${COMP_CWORD}" -eq $((i+2)) ]; then
-        __project_complete_usernames $((i+1))
+    elif [ "${COMP_CWORD}" -gt $((i+1)) ]; then
+        __project_complete_members $((i+1))
     fi
 }
 
+_project_purge_user ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    case "$cur" in
+    -*)
+        __projectcomp "-h --help -j --jobs"
+        return
+        ;;
+    esac
+    __project_complete_usernames
+}
+
+_project_replace_user ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    case "$cur" in
+    -*)
+        __projectcomp "-h --help -j --jobs"
+        return
+        ;;
+    esac
+    __project_complete_usernames
+}
+
 _project_list ()
 {
     local cur="${COMP_WORDS[COMP_CWORD]}"
@@ -215,7 +253,81 @@ _project_check ()
     local cur="${COMP_WORDS[COMP_CWORD]}"
     case "$cur" in
     -*)
-        __projectcomp "-h --help -a --all"
+        __projectcomp "-h --help -a --all -j --jobs --deep --sample --json"
+        return
+        ;;
+    esac
+}
+
+_project_du ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    case "$cur" in
+    -*)
+        __projectcomp "-h --help -a --all -j --jobs --top --refresh --json"
+        return
+        ;;
+    esac
+    __project_complete_projects
+}
+
+_project_trash ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    case "$cur" in
+    -*)
+        __projectcomp "-h --help -j --jobs --max-ops"
+        return
+        ;;
+    esac
+
+    local i=$(__projectcomp_indexof trash)
+
+    if [ "${COMP_CWORD}" -eq $((i+1)) ]; then
+        __projectcomp "list restore purge"
+    fi
+}
+
+_project_watch ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    case "$cur" in
+    -*)
+        __projectcomp "-h --help -j --jobs"
+        return
+        ;;
+    esac
+    __project_complete_projects
+}
+
+_project_migrate_config ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    case "$cur" in
+    -*)
+        __projectcomp "-h --help"
+        return
+        ;;
+    esac
+}
+
+_project_batch ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    case "$cur" in
+    -*)
+        __projectcomp "-h --help -j --jobs --json"
+        return
+        ;;
+    esac
+}
+
+_project_daemon ()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    case "$cur" in
+    -*)
+        __projectcomp "-h --help --socket"
         return
         ;;
     esac
@@ -255,7 +367,7 @@ _project ()
             __projectcomp "-h --help -P --project-root -v --verbose -d --debug --nocolor"
             ;;
         *)
-            __projectcomp "create rename delete info update adduser moduser deluser list check help"
+            __projectcomp "create rename delete info update adduser moduser deluser purge-user replace-user list check du trash watch migrate-config batch daemon help"
             ;;
         esac
         return
@@ -272,8 +384,16 @@ _project ()
     adduser)                    _project_adduser ;;
     moduser)                    _project_moduser ;;
     deluser)                    _project_deluser ;;
+    purge-user)                 _project_purge_user ;;
+    replace-user)               _project_replace_user ;;
     list)                       _project_list ;;
     check)                      _project_check ;;
+    du)                         _project_du ;;
+    trash)                      _project_trash ;;
+    watch)                      _project_watch ;;
+    migrate-config)             _project_migrate_config ;;
+    batch)                      _project_batch ;;
+    daemon)                     _project_daemon ;;
     help)                       _project_help ;;
     *)                          ;;
     esac
@@ -1,27 +1,110 @@
 #!/usr/bin/env python3
+import io
 import os
+import abc
 import sys
 import pwd
 import stat
-import glob
-import yaml
-import shutil
+import json
+import time
+import errno
+import heapq
 import logging
-import argparse
+import threading
+import contextlib
+import collections
 
-# pylibacl 0.5.2 from PyPi (pip install pylibacl - need python-devel,libacl-devel)
-import posix1e
+# Slow-to-import modules are imported by the functions that use them, so
+# that cheap commands (list, info, help) and completion start quickly:
+#   yaml (PyYAML), posix1e (pylibacl 0.5.2 from PyPi: pip install pylibacl -
+#   need python-devel,libacl-devel; only used by the 'posix1e' ACL_BACKEND),
+#   argparse (all but completion needs it), shutil, hashlib, shlex, copy,
+#   queue, concurrent.futures, socket, socketserver, struct, signal, ctypes,
+#   resource, random and math.
+# Check the effect of any change with `python3 benchmarks/startup.py`.
 
 DEBUG = False
+JOBS = 1
+# Directories waiting to be scanned each hold an open file descriptor; past
+# this many (or a quarter of RLIMIT_NOFILE), workers close the subdirectories
+# they find and scan them depth first instead, reopening them by path
+MAX_PENDING_DIRS = 1024
+# seconds between checkpoints of an update's progress (see `refresh_perms`)
+CHECKPOINT_INTERVAL = 60
+INDEX_VERSION = 1
+# seconds deleted projects stay in PROJECT_ROOT/.trash (see `trash_project`)
+TRASH_RETENTION = 7 * 24 * 3600
+# seconds between the daemon's removals of expired trash, and the entries
+# per second they (and `trash purge`) remove at most
+TRASH_PURGE_INTERVAL = 3600
+PURGE_MAX_OPS = 5000
+# seconds for which shell completion data is reused (see `complete`)
+COMPLETE_TTL = 300
+# seconds for which the uid/gid of users looked up through NSS are reused,
+# and for which users found not to exist are (see `UserResolver`); whether
+# the former are kept in PROJECT_ROOT/.cache/users.json for the commands
+# that follow; and how many users are looked up at once
+USER_CACHE_TTL = 600
+USER_CACHE_MISS_TTL = 10
+USER_CACHE_PERSIST = True
+USER_LOOKUP_THREADS = 8
+# entries `check --sample P%` checks in a project whose size isn't known yet,
+# and the entries of each directory (and directories of each depth) its
+# random walk keeps to draw from (see `sample_tree`)
+SAMPLE_UNKNOWN_SIZE = 1000
+SAMPLE_RESERVOIR = 64
+# changed directories `watch` rescans per poll after the kernel dropped
+# events; the others wait for the following polls (see `Watcher.catch_up`)
+WATCH_CATCH_UP_DIRS = 1000
 PROJECT_ROOT = os.path.realpath(os.path.expanduser(
         os.environ.get('PROJECT_ROOT', '/fmrif/projects')))
+# Unix socket of the project daemon (see `run_daemon`); must match wrapper.c
+SOCKET_PATH = os.environ.get('PROJECT_SOCKET', '/run/project.sock')
+# commands the daemon runs in the background, replying immediately
+BACKGROUND_COMMANDS = ('update',)
 OWNER_ROLE = "owner"
 MEMBER_ROLE = "member"
 COLLAB_ROLE = "collaborator"
 ROLE_NAMES = [OWNER_ROLE, MEMBER_ROLE, COLLAB_ROLE]
+# How ACLs are read and written (see `acl_backend`): 'xattr' encodes them
+# straight into the system.posix_acl_* extended attributes (Linux),
+# 'posix1e' goes through pylibacl and 'memory' keeps them in memory (tests)
+ACL_BACKEND = 'xattr' if hasattr(os, 'setxattr') else 'posix1e'
+# Where project configs are kept (see `config_store`): 'yaml' for a
+# .NAME.yml file per project, 'sqlite' for one PROJECT_ROOT/.projects.db,
+# or None for whichever PROJECT_ROOT uses ('sqlite' once migrated to it)
+CONFIG_STORE = None
+# ACL entry tags, as in <sys/acl.h> and the kernel's xattr format
+ACL_USER_OBJ, ACL_USER, ACL_GROUP_OBJ, ACL_GROUP, ACL_MASK, ACL_OTHER = \
+        0x01, 0x02, 0x04, 0x08, 0x10, 0x20
+COMMANDS = ["create", "rename", "delete", "info", "update", "adduser", "moduser",
+        "deluser", "purge-user", "replace-user", "migrate-config", "list", "check",
+        "du", "trash", "watch", "help", "batch", "daemon"]
 
 logger = logging.getLogger(__name__)
 
+# per-thread state of the daemon: the DaemonOutput of the request being
+# served, and the number of workers it asked for
+_request = threading.local()
+
+# parsed config files (and indexes), keyed by path, valid for the
+# (mtime, size, inode) of the file they were parsed from
+_conf_cache = {}
+_index_cache = {}
+# ACL backends by name, created on first use
+_backends = {}
+# config stores by (name, PROJECT_ROOT), created on first use
+_stores = {}
+# UserResolvers by PROJECT_ROOT, created on first use
+_resolvers = {}
+# per-thread names of the projects whose `config_lock` the thread holds
+_locks = threading.local()
+
+# An ACL to be applied: the backend's precomputed form of it (see
+# `AclBackend.prepare`) and its entries, a frozenset of (tag, qualifier,
+# permissions) tuples such as (ACL_USER, 1000, 'rwx')
+TargetACL = collections.namedtuple('TargetACL', ['acl', 'entries'])
+
 class ColorFormatter(logging.Formatter):
     black, red, green, yellow, blue, magenta, cyan, white = 0, 1, 2, 3, 4, 5, 6, 7
     colors = { 'WARNING': yellow, 'INFO': blue, 'DEBUG': green, 'CRITICAL': magenta, 'ERROR': red }
@@ -31,6 +114,69 @@ class ColorFormatter(logging.Formatter):
         # can't use `super` here because Formatter is not a 'new-style' class
         return logging.Formatter.format(self, record)
 
+class ProjectError(Exception):
+    """ Raised by `fail` when a command can't be carried out."""
+    pass
+
+# A problem found by `check`: the project, the offending path and why
+Problem = collections.namedtuple('Problem', ['project', 'path', 'reason'])
+
+class Stats(object):
+    """ What `update --stats` reports: the time spent in each phase, counts
+    of what was visited and done, and the `top` slowest directories. The
+    walker's threads record into it concurrently (see `use_stats`), so the
+    time of the phases they run in parallel (stat, acl_read, acl_write) is
+    summed over threads and can exceed the wall clock time."""
+    phases = ('config', 'chown', 'generate', 'walk', 'stat', 'acl_read',
+            'acl_write', 'save')
+
+    def __init__(self, top=10):
+        self.top = top
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.recorders = []
+        self.slowest = []
+
+    def recorder(self):
+        """ Returns the (seconds, counts) Counters of the calling thread,
+        which only it updates, so recording needs no lock."""
+        recorder = getattr(self.local, 'recorder', None)
+        if recorder is None:
+            recorder = self.local.recorder = (collections.Counter(), collections.Counter())
+            with self.lock:
+                self.recorders.append(recorder)
+        return recorder
+
+    def time(self, phase, seconds):
+        self.recorder()[0][phase] += seconds
+
+    def count(self, name, n=1):
+        self.recorder()[1][name] += n
+
+    def directory(self, path, seconds):
+        """ Records the time taken by the entries of directory `path`."""
+        with self.lock:
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, (seconds, path))
+            elif self.top and seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path))
+
+    def report(self):
+        """ Returns the totals as a dict that can be dumped to JSON."""
+        seconds, counts = collections.Counter(), collections.Counter()
+        for phases, counted in self.recorders:
+            seconds.update(phases)
+            counts.update(counted)
+        for name in ('dirs', 'files', 'symlinks', 'written', 'skipped', 'failed',
+                'rejected', 'warnings', 'errors'):
+            counts.setdefault(name, 0)
+        return {'started': self.started, 'elapsed': time.time() - self.started,
+                'seconds': dict((phase, seconds[phase]) for phase in self.phases),
+                'counts': dict(counts),
+                'slowest': [{'path': path, 'seconds': secs}
+                        for secs, path in sorted(self.slowest, reverse=True)]}
+
 class ProjectDB(object):
     def __init__(self, project, owner, public=False, members=[], collaborators=[]):
         self.project = project
@@ -50,35 +196,562 @@ class ProjectDB(object):
         s += "Public: %s" % self.public
         return s
 
+    def fingerprint(self):
+        """Returns a digest of everything that determines the project's ACLs."""
+        key = repr((self.owner, sorted(self.members),
+                sorted(self.collaborators), bool(self.public)))
+        import hashlib
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
     def save(self):
-        """Writes a project YAML config file to disk."""
-        stuff = {
+        """Atomically writes the project config (see `config_store`)."""
+        config_store().save(self)
+
+    def as_dict(self):
+        return {
             "public":self.public,
             "owner":self.owner,
             "members":self.members,
             "collaborators":self.collaborators
         }
-        with open(project_conf_path(self.project), 'w') as fobj:
-            fobj.write(yaml.dump(stuff, default_flow_style=False))
 
 def load_conf(project_name):
-    """ Reads a project YAML config file and returns a ProjectDB instance."""
-    path = project_conf_path(project_name)
+    """ Reads a project config and returns a ProjectDB instance."""
+    try:
+        return parse_conf(project_name)
+    except IOError:
+        fail("Failed to read project config: %s" %
+                config_store().location(project_name))
+    except:
+        fail("Invalid config: %s" % config_store().location(project_name))
+
+def parse_conf(project_name):
+    """ Like `load_conf`, but raises IOError if the config can't be read
+    and another exception if it is invalid. Callers get their own ProjectDB
+    they are free to modify."""
+    return config_store().load(project_name)
+
+@contextlib.contextmanager
+def config_lock(project_name):
+    """ Holds the lock of a project's config, an exclusive flock on
+    PROJECT_ROOT/.locks/NAME.lock, so that the configs read, changed and
+    saved under it don't overwrite each other's changes. It's re-entrant
+    within a thread."""
+    import fcntl
+    held = getattr(_locks, 'held', None)
+    if held is None:
+        held = _locks.held = set()
+    key = (PROJECT_ROOT, project_name)
+    if key in held:
+        yield
+        return
+    fd = open_lock(project_lock_path(project_name))
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        held.add(key)
+        try:
+            yield
+        finally:
+            held.discard(key)
+    finally:
+        os.close(fd)
+
+def filesystem_time(path):
+    """ Returns the current time, in nanoseconds, of the filesystem the file
+    `path` (created if needed, like a lock) is on: the ctime it gets when
+    touched. Directory ctimes are compared with it rather than with the
+    local clock, which a file server's needn't match."""
+    fd = open_lock(path)
+    try:
+        os.utime(fd)
+        return os.fstat(fd).st_ctime_ns
+    finally:
+        os.close(fd)
+
+def open_lock(path):
+    """ Opens (creating it, and PROJECT_ROOT/.locks, if needed) the lock
+    file `path`; returns its file descriptor, to be given to flock."""
     try:
+        return os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+        return os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+
+def config_store():
+    """ Returns the config store named by CONFIG_STORE or, if that's None,
+    the one PROJECT_ROOT uses: 'sqlite' once `migrate-config` has created
+    its database, 'yaml' otherwise."""
+    name = CONFIG_STORE
+    if name is None:
+        name = 'sqlite' if os.path.exists(config_db_path()) else 'yaml'
+    store = _stores.get((name, PROJECT_ROOT))
+    if store is None:
+        classes = {'yaml': YamlStore, 'sqlite': SqliteStore}
+        if name not in classes:
+            fail("Unknown config store: %s" % name)
+        store = _stores.setdefault((name, PROJECT_ROOT), classes[name]())
+    return store
+
+class ConfigStore(abc.ABC):
+    """ Reads and writes project configs for `load_conf` and
+    `ProjectDB.save`. Saves are atomic and made under the project's
+    `config_lock`; commands that change a config hold that lock from
+    reading it to saving it (see `edit_conf`)."""
+
+    @abc.abstractmethod
+    def load(self, project_name):
+        """ Returns the config of a project as a ProjectDB. Raises IOError if
+        it doesn't exist or can't be read, and another exception if it's
+        invalid."""
+
+    @abc.abstractmethod
+    def save(self, conf):
+        """ Saves ProjectDB `conf`, creating the project's config if need
+        be."""
+
+    @abc.abstractmethod
+    def exists(self, project_name):
+        """ Returns True if there's a config for the project."""
+
+    @abc.abstractmethod
+    def rename(self, old, new):
+        """ Moves the config of project `old` to project `new`."""
+
+    @abc.abstractmethod
+    def move_out(self, project_name, path):
+        """ Removes the config of a project, leaving a YAML copy at `path`."""
+
+    @abc.abstractmethod
+    def move_in(self, project_name, path):
+        """ Makes the YAML copy at `path` (see `move_out`) the config of a
+        project again."""
+
+    def path(self, project_name):
+        """ Returns the path of the file holding only this project's config,
+        whose ACL and owner are kept like the project's, or None."""
+        return None
+
+    @abc.abstractmethod
+    def location(self, project_name):
+        """ Returns where the config of a project is kept, for messages."""
+
+    def stamp(self):
+        """ Returns a list that changes whenever a config is saved, in
+        addition to the mtime of PROJECT_ROOT (see `root_stamp`)."""
+        return []
+
+class YamlStore(ConfigStore):
+    """ A PROJECT_ROOT/.NAME.yml file per project, written to a temporary
+    file that is renamed over it. Each file is parsed at most once per
+    process unless it changes on disk. Root-wide queries go through the
+    reverse index (see `load_index`)."""
+
+    def load(self, project_name):
+        path = project_conf_path(project_name)
+        with open(path) as fobj:
+            st = os.fstat(fobj.fileno())
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+            cached = _conf_cache.get(path)
+            if cached is not None and cached[0] == stamp:
+                loaded = cached[1]
+            else:
+                loaded = yaml_load(fobj.read())
+        conf = ProjectDB(project_name, loaded['owner'], loaded['public'],
+                list(loaded['members']), list(loaded['collaborators']))
+        _conf_cache[path] = (stamp, loaded)
+        return conf
+
+    def save(self, conf):
+        path = project_conf_path(conf.project)
+        with config_lock(conf.project):
+            write_atomic(path, yaml_dump(conf.as_dict()), keep_attrs=True)
+            _conf_cache.pop(path, None)
+            update_index(conf)
+
+    def exists(self, project_name):
+        return os.path.isfile(project_conf_path(project_name))
+
+    def rename(self, old, new):
+        os.rename(project_conf_path(old), project_conf_path(new))
+
+    def move_out(self, project_name, path):
+        os.rename(project_conf_path(project_name), path)
+
+    def move_in(self, project_name, path):
+        os.rename(path, project_conf_path(project_name))
+        update_index(load_conf(project_name))
+
+    def path(self, project_name):
+        return project_conf_path(project_name)
+
+    def location(self, project_name):
+        return project_conf_path(project_name)
+
+class SqliteStore(ConfigStore):
+    """ Every config in one SQLite database, PROJECT_ROOT/.projects.db, with
+    a row per project and per user of a project, indexed by user. Saves are
+    transactions, so readers never see half a config, and root-wide queries
+    (`load_index`, `projects_for_user`) are single indexed lookups. Each
+    thread has its own connection. The database is only readable by root;
+    users go through this program."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS projects (
+            name TEXT PRIMARY KEY,
+            public INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS users (
+            project TEXT NOT NULL REFERENCES projects (name)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            user TEXT NOT NULL,
+            role TEXT NOT NULL,
+            PRIMARY KEY (project, position));
+        CREATE INDEX IF NOT EXISTS users_by_user ON users (user);
+    """
+
+    def __init__(self, path=None):
+        self.db = path or config_db_path()
+        self.local = threading.local()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            # created readable by root only
+            os.close(os.open(self.db, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600))
+            conn = sqlite3.connect(self.db, timeout=60, isolation_level=None,
+                    check_same_thread=False)
+            conn.execute("PRAGMA foreign_keys = ON")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(self.SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self, begin="BEGIN IMMEDIATE"):
+        """ Runs the statements of the block in a transaction; the default
+        takes the database's write lock upfront, "BEGIN" reads a snapshot."""
+        conn = self.connect()
+        conn.execute(begin)
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def load(self, project_name):
+        with self.transaction("BEGIN") as conn:
+            row = conn.execute("SELECT public FROM projects WHERE name = ?",
+                    (project_name,)).fetchone()
+            users = conn.execute("SELECT user, role FROM users WHERE project = ? "
+                    "ORDER BY position", (project_name,)).fetchall()
+        if row is None:
+            raise IOError(errno.ENOENT, "No such project in %s" % self.db, project_name)
+        conf = ProjectDB(project_name, None, bool(row[0]), [], [])
+        for user, role in users:
+            if role == OWNER_ROLE:
+                conf.owner = user
+            elif role == MEMBER_ROLE:
+                conf.members.append(user)
+            else:
+                conf.collaborators.append(user)
+        if conf.owner is None:
+            raise ValueError("Project %s has no owner" % project_name)
+        return conf
+
+    def save(self, conf):
+        with config_lock(conf.project), self.transaction() as conn:
+            self.write(conn, conf)
+
+    def write(self, conn, conf):
+        """ Writes `conf` within a transaction of `conn`."""
+        rows = [(conf.project, 0, conf.owner, OWNER_ROLE)]
+        for role, users in ((MEMBER_ROLE, conf.members), (COLLAB_ROLE, conf.collaborators)):
+            for user in users:
+                rows.append((conf.project, len(rows), user, role))
+        if not conn.execute("UPDATE projects SET public = ? WHERE name = ?",
+                (bool(conf.public), conf.project)).rowcount:
+            conn.execute("INSERT INTO projects (name, public) VALUES (?, ?)",
+                    (conf.project, bool(conf.public)))
+        conn.execute("DELETE FROM users WHERE project = ?", (conf.project,))
+        conn.executemany("INSERT INTO users (project, position, user, role) "
+                "VALUES (?, ?, ?, ?)", rows)
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def exists(self, project_name):
+        return self.connect().execute("SELECT 1 FROM projects WHERE name = ?",
+                (project_name,)).fetchone() is not None
+
+    def rename(self, old, new):
+        with self.transaction() as conn:
+            conn.execute("UPDATE projects SET name = ? WHERE name = ?", (new, old))
+
+    def move_out(self, project_name, path):
+        conf = self.load(project_name)
+        write_atomic(path, yaml_dump(conf.as_dict()))
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM projects WHERE name = ?", (project_name,))
+
+    def move_in(self, project_name, path):
         with open(path) as fobj:
+            loaded = yaml_load(fobj.read())
+        self.save(ProjectDB(project_name, loaded['owner'], loaded['public'],
+                list(loaded['members']), list(loaded['collaborators'])))
+        os.remove(path)
+
+    def location(self, project_name):
+        return "%s (%s)" % (self.db, project_name)
+
+    def stamp(self):
+        stamp = []
+        for path in (self.db, self.db + '-wal'):
+            try:
+                stamp.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def names(self):
+        return set(name for name, in self.connect().execute("SELECT name FROM projects"))
+
+    def index(self, names):
+        """ Returns the reverse index (see `load_index`) of projects `names`."""
+        projects = {}
+        users = {}
+        with self.transaction("BEGIN") as conn:
+            for name, public in conn.execute("SELECT name, public FROM projects"):
+                if name in names:
+                    projects[name] = {'owner': None, 'members': [],
+                            'collaborators': [], 'public': bool(public)}
+            for name, user, role in conn.execute("SELECT project, user, role FROM users "
+                    "ORDER BY project, position"):
+                entry = projects.get(name)
+                if entry is None:
+                    continue
+                if role == OWNER_ROLE:
+                    entry['owner'] = user
+                else:
+                    entry['members' if role == MEMBER_ROLE else 'collaborators'].append(user)
+                users.setdefault(user, set()).add(name)
+        return {'version': INDEX_VERSION, 'projects': projects,
+                'users': dict((u, sorted(p)) for u, p in users.items())}
+
+    def projects_for_user(self, username):
+        return [name for name, in self.connect().execute("SELECT DISTINCT project "
+                "FROM users WHERE user = ? ORDER BY project", (username,))]
+
+def migrate_config(args):
+    """ Moves the config of every project from its .NAME.yml file into the
+    database of the 'sqlite' config store, which PROJECT_ROOT then uses.
+    The YAML files are kept in PROJECT_ROOT/.config-backup-TIMESTAMP."""
+    require_root(args)
+    db = config_db_path()
+    if os.path.exists(db):
+        fail("%s already exists" % db)
+    names = sorted(name[1:-len('.yml')] for name in os.listdir(PROJECT_ROOT)
+            if name.startswith('.') and name.endswith('.yml'))
+    yaml_store = YamlStore()
+    confs, bad = [], []
+    for projname in names:
+        try:
+            confs.append(yaml_store.load(projname))
+        except Exception:
+            bad.append(projname)
+    if bad:
+        fail("Fix or remove these configs first: %s" % ", ".join(bad))
+
+    # built aside, so that the store changes at once when it's renamed
+    tmp = db + '.tmp'
+    for path in (tmp, tmp + '-wal', tmp + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    store = SqliteStore(tmp)
+    with store.transaction() as conn:
+        for conf in confs:
+            store.write(conn, conf)
+    store.close()
+    os.rename(tmp, db)
+
+    backup = os.path.join(PROJECT_ROOT, ".config-backup-%s" %
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime()))
+    os.mkdir(backup, 0o700)
+    for projname in names:
+        os.rename(project_conf_path(projname),
+                os.path.join(backup, os.path.basename(project_conf_path(projname))))
+    if os.path.exists(index_path()):
+        os.remove(index_path())
+    print("Moved %d project configs into %s; the YAML files are in %s" % (
+            len(confs), db, backup))
+
+def edit_conf(project_name, change):
+    """ Loads a project's config, calls `change(conf)` and saves it, under
+    the project's `config_lock`. Returns the saved config."""
+    with config_lock(project_name):
+        conf = load_conf(project_name)
+        change(conf)
+        conf.save()
+    return conf
+
+def root_stamp():
+    """ Returns a stamp of PROJECT_ROOT that changes whenever a project is
+    created, renamed or deleted, or a config is saved."""
+    return [os.stat(PROJECT_ROOT).st_mtime_ns] + config_store().stamp()
+
+def load_manifest(project_name):
+    """ Reads the manifest recorded by the last successful permissions update
+    of a project. Returns None if there is no (readable) manifest."""
+    try:
+        with open(project_manifest_path(project_name)) as fobj:
             contents = fobj.read()
-    except IOError:
-        fail("Failed to read project config file: %s" % path)
+    except (IOError, OSError):
+        return None
+    try:
+        manifest = yaml_load(contents)
+    except:
+        return None
+    if not isinstance(manifest, dict):
+        return None
+    return manifest
+
+def save_manifest(project_name, manifest):
+    """ Atomically writes a project's manifest to disk."""
+    write_atomic(project_manifest_path(project_name),
+            yaml_dump(manifest))
+
+def load_checkpoint(project_name):
+    """ Reads the checkpoint of an unfinished permissions update of a project
+    (see `refresh_perms`). Returns None if there is no (readable) checkpoint."""
+    try:
+        with open(project_checkpoint_path(project_name)) as fobj:
+            checkpoint = json.load(fobj)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(checkpoint, dict) or not isinstance(checkpoint.get('pending'), list):
+        return None
+    return checkpoint
+
+def save_checkpoint(project_name, checkpoint):
+    """ Atomically writes the checkpoint of a project's update. It's JSON
+    rather than YAML because it holds paths, which needn't be valid UTF-8."""
+    write_atomic(project_checkpoint_path(project_name), json.dumps(checkpoint))
+
+def remove_checkpoint(project_name):
+    try:
+        os.remove(project_checkpoint_path(project_name))
+    except OSError:
+        pass
+
+def load_du_cache(project_name):
+    """ Reads the directory sizes recorded by a project's last `du_project`,
+    a dict keyed by path relative to the project. Returns an empty one if
+    there is no (readable) cache."""
+    try:
+        with open(project_du_path(project_name)) as fobj:
+            cache = json.load(fobj)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('version') != INDEX_VERSION:
+        return {}
+    return cache.get('dirs', {})
+
+def save_du_cache(project_name, dirs):
+    """ Atomically writes the directory sizes of a project. Only root may
+    read them, as they name the project's directories."""
+    write_atomic(project_du_path(project_name),
+            json.dumps({'version': INDEX_VERSION, 'dirs': dirs}), mode=0o600)
+
+def mark_for_update(project_name, incremental=False):
+    """ Leaves the marker saying a project's permissions need an update (see
+    `update_perms`), which stays incremental only if every request asked
+    for an `incremental` one. Must be called holding the project's
+    `config_lock`."""
+    marker = take_update_marker(project_name)
+    if marker is not None:
+        incremental = incremental and marker['incremental']
+    write_atomic(project_update_marker_path(project_name),
+            json.dumps({'incremental': incremental}))
+
+def take_update_marker(project_name):
+    """ Removes and returns the marker left by `mark_for_update`, or None if
+    there is none. Must be called holding the project's `config_lock`."""
+    path = project_update_marker_path(project_name)
+    try:
+        with open(path) as fobj:
+            marker = json.load(fobj)
+    except (IOError, OSError, ValueError):
+        marker = None
+    try:
+        os.remove(path)
+    except OSError:
+        return None
+    if not isinstance(marker, dict):
+        marker = {}
+    return {'incremental': bool(marker.get('incremental'))}
+
+def yaml_load(contents):
+    """ Parses YAML with a safe loader, libyaml's (much faster) C
+    implementation when available."""
+    import yaml
+    return yaml.load(contents, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+def yaml_dump(data):
+    """ Serializes `data` to block style YAML with a safe dumper."""
+    import yaml
+    return yaml.dump(data, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper),
+            default_flow_style=False)
 
+def write_atomic(path, contents, keep_attrs=False, mode=None):
+    """ Writes `contents` to a temporary file next to `path` then renames it
+    over `path`, so readers never see a partially written file. With
+    `keep_attrs`, the new file gets the owner, mode and ACL of the old one;
+    `mode` gives it that mode instead."""
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
     try:
-        loaded = yaml.load(contents, Loader=yaml.FullLoader)
-        return ProjectDB(project_name, loaded['owner'], loaded['public'],
-                loaded['members'], loaded['collaborators'])
+        with open(tmp, 'w') as fobj:
+            if mode is not None:
+                os.fchmod(fobj.fileno(), mode)
+            fobj.write(contents)
+            if keep_attrs:
+                copy_attrs(path, fobj.fileno())
+        os.rename(tmp, path)
     except:
-        fail("Invalid config file: %s" % path)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def copy_attrs(path, fd):
+    """ Gives open file `fd` the owner, mode and access ACL of `path`, if
+    it exists."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    os.fchown(fd, st.st_uid, st.st_gid)
+    os.fchmod(fd, stat.S_IMODE(st.st_mode))
+    if hasattr(os, 'getxattr'):
+        try:
+            os.setxattr(fd, 'system.posix_acl_access',
+                    os.getxattr(path, 'system.posix_acl_access'))
+        except OSError:
+            pass    # no ACL, or not supported
+
+def build_parser(command=None):
+    """ Builds the command line parser. Returns the parser and its
+    subparsers action, whose `choices` map command names to subparsers.
+    If `command` is given, only its subparser is built (see
+    `requested_command`)."""
+    import argparse
+    def wanted(name):
+        return command is None or command == name
 
-def main():
-    global DEBUG, PROJECT_ROOT
     parser = argparse.ArgumentParser(
             prog="project",
             description="Manage projects",
@@ -98,92 +771,276 @@ def main():
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parent_parser.add_argument("project", metavar="project-name", help="name of project")
 
-    create_parser = subparsers.add_parser("create",
-            help="create new project",
-            epilog="Note that projects are 'private' by default",
-            parents=[parent_parser],
+    jobs_parser = argparse.ArgumentParser(add_help=False,
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    create_parser.add_argument("--public", action="store_true",
-            help="make project publicly readable")
-    create_parser.set_defaults(func=create_project)
+    # left out unless given, so that batch commands default to the batch's
+    jobs_parser.add_argument("-j", "--jobs", metavar="N", type=int,
+            default=argparse.SUPPRESS,
+            help="number of parallel workers used to update ACLs (default: %d)" % JOBS)
 
-    rename_parser = subparsers.add_parser("rename",
-            help="rename project",
-            parents=[parent_parser],
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    rename_parser.add_argument("new_name", metavar="new-name", help="new name for project")
-    rename_parser.set_defaults(func=rename_project)
+    if wanted("create"):
+        create_parser = subparsers.add_parser("create",
+                help="create new project",
+                epilog="Note that projects are 'private' by default",
+                parents=[parent_parser, jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        create_parser.add_argument("--public", action="store_true",
+                help="make project publicly readable")
+        create_parser.set_defaults(func=create_project)
 
-    delete_parser = subparsers.add_parser("delete",
-            help="delete existing project",
-            epilog="This will permanently delete the project directory!",
-            parents=[parent_parser],
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    delete_parser.set_defaults(func=delete_project)
+    if wanted("rename"):
+        rename_parser = subparsers.add_parser("rename",
+                help="rename project",
+                parents=[parent_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        rename_parser.add_argument("new_name", metavar="new-name", help="new name for project")
+        rename_parser.set_defaults(func=rename_project)
 
-    info_parser = subparsers.add_parser("info",
-            help="print information about project",
-            epilog="Prints information about a project",
-            parents=[parent_parser],
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    info_parser.set_defaults(func=print_info)
+    if wanted("delete"):
+        delete_parser = subparsers.add_parser("delete",
+                help="delete existing project",
+                epilog="The project is moved to the trash, where it's kept for %d "
+                    "days (see 'trash'); expired trash is then removed in the "
+                    "background." % (TRASH_RETENTION // 86400),
+                parents=[parent_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        delete_parser.set_defaults(func=delete_project)
 
-    update_parser = subparsers.add_parser("update",
-            help="update permissions on project",
-            epilog="Updates file permissions on the entire project",
-            parents=[parent_parser],
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    update_parser.set_defaults(func=refresh_permissions)
+    if wanted("info"):
+        info_parser = subparsers.add_parser("info",
+                help="print information about project",
+                epilog="Prints information about a project",
+                parents=[parent_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        info_parser.set_defaults(func=print_info)
+
+    if wanted("update"):
+        update_parser = subparsers.add_parser("update",
+                help="update permissions on project",
+                epilog="Updates file permissions on the entire project, or on "
+                "several projects at once with --all or --user",
+                parents=[jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        update_parser.add_argument("project", metavar="project-name", nargs="?",
+                help="name of project")
+        update_parser.add_argument("-a", "--all", action="store_true",
+                help="update every project, sharing the --jobs workers")
+        update_parser.add_argument("-u", "--user", metavar="USERNAME",
+                help="update every project of USERNAME, sharing the --jobs workers")
+        update_parser.add_argument("-i", "--incremental", action="store_true",
+                help="only update entries of directories changed since the last update")
+        update_parser.add_argument("--resume", action="store_true",
+                help="carry on from where an interrupted update stopped")
+        update_parser.add_argument("--wait", action="store_true",
+                help="if the project is already being updated, wait for that "
+                "update and the one following it; through the daemon, wait "
+                "for the update and return its status")
+        update_parser.add_argument("--max-ops", metavar="N", type=float,
+                help="update at most N entries per second")
+        update_parser.add_argument("--nice", action="store_true",
+                help="run with the lowest CPU and (idle) I/O priority")
+        update_parser.add_argument("--stats", action="store_true",
+                help="report the time spent in each phase and what was done")
+        update_parser.add_argument("--stats-json", action="store_true",
+                help="report the same as --stats as a JSON object")
+        update_parser.add_argument("--stats-top", metavar="N", type=int, default=10,
+                help="number of slowest directories to report")
+        update_parser.set_defaults(func=refresh_permissions, change=None)
 
     user_parser = argparse.ArgumentParser(add_help=False,
-            parents=[parent_parser],
+            parents=[parent_parser, jobs_parser],
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     user_parser.add_argument("role", choices=ROLE_NAMES,
             #metavar="role",
             help="new user role")
     user_parser.add_argument("username", nargs='+', help="user's UNIX username")
 
-    add_user_parser = subparsers.add_parser("adduser",
-            help="add user to project",
-            parents=[user_parser],
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    add_user_parser.set_defaults(func=mod_user)
+    if wanted("adduser"):
+        add_user_parser = subparsers.add_parser("adduser",
+                help="add user to project",
+                parents=[user_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        add_user_parser.set_defaults(func=mod_user, change=change_role)
 
-    mod_user_parser = subparsers.add_parser("moduser",
-            help="modify user permissions",
-            parents=[user_parser],
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    mod_user_parser.set_defaults(func=mod_user)
+    if wanted("moduser"):
+        mod_user_parser = subparsers.add_parser("moduser",
+                help="modify user permissions",
+                parents=[user_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        mod_user_parser.set_defaults(func=mod_user, change=change_role)
 
-    del_user_parser = subparsers.add_parser("deluser",
-            help="remove user from project",
-            parents=[parent_parser],
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    del_user_parser.add_argument("username", nargs='+', help="user's UNIX username")
-    del_user_parser.set_defaults(func=del_user)
+    if wanted("deluser"):
+        del_user_parser = subparsers.add_parser("deluser",
+                help="remove user from project",
+                parents=[parent_parser, jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        del_user_parser.add_argument("username", nargs='+', help="user's UNIX username")
+        del_user_parser.set_defaults(func=del_user, change=remove_users)
 
-    list_parser = subparsers.add_parser("list",
-            help="list projects",
-            epilog="Lists all projects to which you have access",
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    list_parser.add_argument("-a", "--all", action="store_true",
-            help="list ALL projects in PROJECT_ROOT")
-    list_parser.set_defaults(func=list_projects)
+    if wanted("purge-user"):
+        purge_user_parser = subparsers.add_parser("purge-user",
+                help="remove user from every project",
+                epilog="Removes a user (e.g. one who left, whose account may "
+                    "already be gone) from every project, then updates their "
+                    "permissions. Only root can do this.",
+                parents=[jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        purge_user_parser.add_argument("username", help="user's UNIX username")
+        purge_user_parser.set_defaults(func=purge_user)
 
-    check_parser = subparsers.add_parser("check",
-            help="check project permissions",
-            epilog="Lists projects for which permissions should be fixed",
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    check_parser.add_argument("-a", "--all", action="store_true",
-            help="check ALL projects in PROJECT_ROOT")
-    check_parser.set_defaults(func=check_projects)
+    if wanted("replace-user"):
+        replace_user_parser = subparsers.add_parser("replace-user",
+                help="replace user by another in every project",
+                epilog="Gives a user's role in every project to another user "
+                    "(e.g. a renamed account), then updates their permissions. "
+                    "Only root can do this.",
+                parents=[jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        replace_user_parser.add_argument("username", help="user's (old) UNIX username")
+        replace_user_parser.add_argument("new_username", metavar="new-username",
+                help="UNIX username of the user taking over")
+        replace_user_parser.set_defaults(func=replace_user)
 
-    help_parser = subparsers.add_parser('help',
-            help="print help info for command",
-            epilog="Prints the help information for the given command.",
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    help_parser.add_argument("command", nargs='?', default=None, help="project command")
+    if wanted("migrate-config"):
+        migrate_parser = subparsers.add_parser("migrate-config",
+                help="move project configs into an SQLite database",
+                epilog="Moves the config of every project from its .NAME.yml "
+                    "file into PROJECT_ROOT/.projects.db, which is used from then "
+                    "on. Run it while no other project command is running. Only "
+                    "root can do this.",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        migrate_parser.set_defaults(func=migrate_config)
+
+    if wanted("list"):
+        list_parser = subparsers.add_parser("list",
+                help="list projects",
+                epilog="Lists all projects to which you have access",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        list_parser.add_argument("-a", "--all", action="store_true",
+                help="list ALL projects in PROJECT_ROOT")
+        list_parser.set_defaults(func=list_projects)
+
+    if wanted("check"):
+        check_parser = subparsers.add_parser("check",
+                help="check project permissions",
+                epilog="Lists projects for which permissions should be fixed",
+                parents=[jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        check_parser.add_argument("-a", "--all", action="store_true",
+                help="check ALL projects in PROJECT_ROOT")
+        depth_group = check_parser.add_mutually_exclusive_group()
+        depth_group.add_argument("--deep", action="store_true",
+                help="check the ACL of every file in each project")
+        depth_group.add_argument("--sample", metavar="N|P%", type=sample_arg,
+                help="check the ACL of N (or P%% of the) entries of each project, "
+                "picked at random, and estimate how many drifted")
+        check_parser.add_argument("--json", action="store_true",
+                help="print each problem found as a line of JSON")
+        check_parser.set_defaults(func=check_projects)
+
+    if wanted("du"):
+        du_parser = subparsers.add_parser("du",
+                help="report disk usage of projects",
+                epilog="Reports the bytes and inodes used by your projects (or "
+                    "the ones given) and by their largest top-level directories. "
+                    "Directories unchanged since the last report aren't listed "
+                    "again. Only root can use --all.",
+                parents=[jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        du_parser.add_argument("project", metavar="project-name", nargs="*",
+                help="name of project")
+        du_parser.add_argument("-a", "--all", action="store_true",
+                help="report on ALL projects in PROJECT_ROOT")
+        du_parser.add_argument("--top", metavar="N", type=int, default=5,
+                help="number of largest top-level directories to report")
+        du_parser.add_argument("--refresh", action="store_true",
+                help="list every directory again, ignoring the recorded sizes")
+        du_parser.add_argument("--json", action="store_true",
+                help="print the usage of each project as a line of JSON")
+        du_parser.set_defaults(func=du_projects)
+
+    if wanted("trash"):
+        trash_parser = subparsers.add_parser("trash",
+                help="list, restore or purge deleted projects",
+                epilog="Deleted projects are kept in the trash for %d days. "
+                    "'purge' without entries removes the ones older than that; "
+                    "the daemon does so every hour, and 'delete' in the background."
+                    % (TRASH_RETENTION // 86400),
+                parents=[jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        trash_parser.add_argument("action", choices=["list", "restore", "purge"])
+        trash_parser.add_argument("entry", nargs="*",
+                help="trash entry, or project name for its latest entry")
+        trash_parser.add_argument("--max-ops", metavar="N", type=float,
+                help="remove at most N entries per second (default: %d)" % PURGE_MAX_OPS)
+        trash_parser.set_defaults(func=manage_trash)
+
+    if wanted("watch"):
+        watch_parser = subparsers.add_parser("watch",
+                help="apply ACLs to new files as they appear",
+                epilog="Watches projects (all of them by default, including "
+                    "new ones) with inotify and applies ACLs to the entries "
+                    "created or moved into them, until interrupted. Only root "
+                    "can do this. Linux only.",
+                parents=[jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        watch_parser.add_argument("project", metavar="project-name", nargs="*",
+                help="name of project")
+        watch_parser.set_defaults(func=watch_projects)
+
+    if wanted("help"):
+        help_parser = subparsers.add_parser('help',
+                help="print help info for command",
+                epilog="Prints the help information for the given command.",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        help_parser.add_argument("command", nargs='?', default=None, help="project command")
+
+    if wanted("batch"):
+        batch_parser = subparsers.add_parser("batch",
+                help="run many commands in one process",
+                epilog="Reads one command per line from standard input, either in "
+                    "command line syntax (e.g. 'adduser demo member jack') or as "
+                    "JSON. Consecutive user changes to the same project are "
+                    "merged into a single permissions update.",
+                parents=[jobs_parser],
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        batch_parser.add_argument("--json", action="store_true",
+                help="print the result of each command as a line of JSON")
+        batch_parser.set_defaults(func=run_batch)
+
+    if wanted("daemon"):
+        daemon_parser = subparsers.add_parser("daemon",
+                help="serve project commands over a Unix socket",
+                epilog="Runs the (privileged) project daemon. The setuid "
+                    "'project' binary forwards commands to it when it is running, "
+                    "and runs this program directly otherwise.",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        daemon_parser.add_argument("--socket", metavar="<path>", default=SOCKET_PATH,
+                help="path of the Unix socket to listen on")
+        daemon_parser.set_defaults(func=run_daemon)
+
+    return parser, subparsers
 
+def requested_command(argv):
+    """ Returns the command named in command line `argv`, or None if it's
+    missing, unknown or 'help', in which case all subparsers are needed."""
+    args = iter(argv)
+    for arg in args:
+        if arg in ('-P', '--project-root'):
+            next(args, None)
+        elif not arg.startswith('-'):
+            if arg in COMMANDS and arg != 'help':
+                return arg
+            return None
+    return None
+
+def main():
+    global DEBUG, PROJECT_ROOT
+    # fast path for the shell completion scripts, skipping the parser
+    if sys.argv[1:2] == ['__complete']:
+        sys.exit(complete(sys.argv[2:], pwd.getpwuid(os.getuid()).pw_name))
+
+    parser, subparsers = build_parser(requested_command(sys.argv[1:]))
     args = parser.parse_args()
 
     # set up logging (i.e. fancy console output)
@@ -202,20 +1059,12 @@ def main():
         logger.setLevel(logging.WARNING)
 
     if args.which == 'help':
-        # print main help
-        if args.command is None:
-            parser.print_help()
-        else:
-            try:
-                subp = subparsers.choices[args.command]
-                subp.print_help()
-            except KeyError:
-                logger.error("Invalid command: %s" % args.command)
-                sys.exit(1)
-        sys.exit(0)
-
-    # determine username of user running this program (Unix)
-    args.executer = pwd.getpwuid(os.getuid()).pw_name
+        sys.exit(show_help(parser, subparsers, args.command))
+
+    # determine the user running this program (Unix): the real uid, as the
+    # wrapper is setuid root
+    args.uid = os.getuid()
+    args.executer = pwd.getpwuid(args.uid).pw_name
     logger.debug("You are: %s" % args.executer)
 
     if not os.path.isdir(args.project_root):
@@ -223,45 +1072,181 @@ def main():
     PROJECT_ROOT = args.project_root
     logger.info("PROJECT_ROOT: %s" % PROJECT_ROOT)
 
-    # strip all preceding directories from project name
-    # e.g. if user typed full path to project
-    if hasattr(args, 'project'):
-        args.project = os.path.basename(args.project)
-
     # dispatch to user-specified command
-    args.func(args)
+    try:
+        dispatch(args)
+    except ProjectError as e:
+        logger.error(e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        # an interrupted update has recorded a checkpoint to --resume from
+        logger.error("Interrupted")
+        sys.exit(130)
+
+def show_help(parser, subparsers, command):
+    """ Prints the main help, or the help of `command`. Returns the exit status."""
+    # print main help
+    if command is None:
+        parser.print_help()
+    else:
+        try:
+            subp = subparsers.choices[command]
+            subp.print_help()
+        except KeyError:
+            logger.error("Invalid command: %s" % command)
+            return 1
+    return 0
+
+def dispatch(args):
+    """ Runs the command selected by parsed arguments `args`."""
+    jobs = getattr(args, 'jobs', None)
+    if jobs is not None and jobs < 1:
+        fail("Number of jobs must be at least 1")
+
+    strip_project_dirs(args)
+    previous = getattr(_request, 'jobs', None)
+    use_jobs(jobs or previous)
+    try:
+        args.func(args)
+    finally:
+        use_jobs(previous)
+
+def strip_project_dirs(args):
+    """ Strips all preceding directories from the project name(s) in `args`,
+    e.g. if the user typed the full path to a project. Commands such as
+    `update --all` have none, and `du` takes several."""
+    if isinstance(getattr(args, 'project', None), list):
+        args.project = [os.path.basename(p) for p in args.project]
+    elif getattr(args, 'project', None):
+        args.project = os.path.basename(args.project)
 
 
 def fail(msg):
-    logger.error(msg)
-    sys.exit(1)
+    raise ProjectError(msg)
 
 def all_projects():
-    """ Yields each project name user `username` has access to,
-    or all project names if `all` is True."""
-    for dirname in sorted(glob.glob(os.path.join(PROJECT_ROOT, '*'))):
-        projname = os.path.basename(dirname)
-        pdir = project_dir_path(projname)
-        pconf = project_conf_path(projname)
-        if not os.path.isdir(pdir):
-            logger.debug("Project dir does not exist: %s" % pdir)
-            continue
-        if not os.path.isfile(pconf):
-            logger.debug("Project config does not exist: %s" % pconf)
-            continue
+    """ Yields the name of every project in PROJECT_ROOT."""
+    for projname in sorted(scan_root()):
         yield projname
 
-def projects_for_user(username):
-    for proj in all_projects():
-        # only yield projects for which user has access
+def scan_root():
+    """ Lists PROJECT_ROOT once and returns a dict mapping the name of each
+    project (a directory with a config file) to the (mtime, size) of its
+    config file."""
+    store = config_store()
+    yaml = isinstance(store, YamlStore)
+    dirs, confs = set(), {}
+    for entry in os.scandir(PROJECT_ROOT):
         try:
-            conf = load_conf(proj)
-        except IOError:
-            logger.debug("can't load config for %s" % proj)
-            continue    # no permission to read YAML
-        users = [conf.owner] + conf.members + conf.collaborators
-        if username in users:
-            yield proj
+            if not entry.name.startswith('.'):
+                if entry.is_dir():
+                    dirs.add(entry.name)
+            elif yaml and entry.name.endswith('.yml') and entry.is_file():
+                st = entry.stat()
+                confs[entry.name[1:-len('.yml')]] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            continue
+    if not yaml:
+        confs = dict((name, None) for name in store.names())
+    for projname in dirs - set(confs):
+        logger.debug("Project config does not exist: %s" % project_conf_path(projname))
+    for projname in set(confs) - dirs:
+        logger.debug("Project dir does not exist: %s" % project_dir_path(projname))
+    return dict((p, confs[p]) for p in dirs & set(confs))
+
+def projects_for_user(username):
+    """ Returns the names of the projects `username` is part of."""
+    store = config_store()
+    if isinstance(store, SqliteStore):
+        return store.projects_for_user(username)
+    return load_index()['users'].get(username, [])
+
+def load_index():
+    """ Returns the reverse index of PROJECT_ROOT, a dict with:
+
+        projects: project name -> {owner, members, collaborators, public,
+                                   stamp: [mtime, size] of its config file}
+        users:    username -> sorted list of the user's projects
+
+    The index is checked against the config files' mtimes and sizes; stale
+    entries are re-read from their config file and the index is rewritten.
+    With the 'sqlite' config store, it's queried from the database instead.
+    """
+    store = config_store()
+    if isinstance(store, SqliteStore):
+        return store.index(set(scan_root()))
+    stored = read_index()
+    projects = {}
+    changed = False
+    for projname, stamp in scan_root().items():
+        entry = stored['projects'].get(projname)
+        if entry is None or tuple(entry['stamp']) != stamp:
+            changed = True
+            try:
+                entry = index_entry(parse_conf(projname), stamp)
+            except IOError:
+                logger.debug("can't load config for %s" % projname)
+                continue    # no permission to read YAML
+            except:
+                logger.debug("invalid config for %s" % projname)
+                continue
+        projects[projname] = entry
+
+    if changed or set(projects) != set(stored['projects']):
+        logger.debug("Rebuilding project index")
+        stored = write_index(projects)
+    return stored
+
+def update_index(conf):
+    """ Records a freshly saved project config in the reverse index."""
+    try:
+        st = os.stat(project_conf_path(conf.project))
+        projects = dict(read_index()['projects'])
+        projects[conf.project] = index_entry(conf, (st.st_mtime_ns, st.st_size))
+        write_index(projects)
+    except (IOError, OSError) as e:
+        # a stale index is detected and rebuilt by `load_index`
+        logger.debug("Failed to update project index: %s" % e)
+
+def index_entry(conf, stamp):
+    return {'owner': conf.owner, 'members': conf.members,
+            'collaborators': conf.collaborators, 'public': conf.public,
+            'stamp': list(stamp)}
+
+def read_index():
+    """ Reads the index as stored on disk, without checking it. The parsed
+    index is kept for as long as the file doesn't change, and must not be
+    modified by callers."""
+    path = index_path()
+    try:
+        with open(path) as fobj:
+            st = os.fstat(fobj.fileno())
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+            cached = _index_cache.get(path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            index = json.load(fobj)
+        if index.get('version') == INDEX_VERSION:
+            _index_cache[path] = (stamp, index)
+            return index
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    return {'version': INDEX_VERSION, 'projects': {}, 'users': {}}
+
+def write_index(projects):
+    """ Atomically writes the index for `projects`, returning the index. If
+    it can't be written (e.g. PROJECT_ROOT is read-only) it's only logged."""
+    users = {}
+    for projname, entry in projects.items():
+        for user in [entry['owner']] + entry['members'] + entry['collaborators']:
+            users.setdefault(user, set()).add(projname)
+    index = {'version': INDEX_VERSION, 'projects': projects,
+            'users': dict((u, sorted(p)) for u, p in users.items())}
+    try:
+        write_atomic(index_path(), json.dumps(index, sort_keys=True))
+    except (IOError, OSError) as e:
+        logger.debug("Failed to write project index: %s" % e)
+    return index
 
 def list_projects(args):
     """ Prints the name of each project the user has access to,
@@ -274,296 +1259,2362 @@ def list_projects(args):
     for proj in projects:
         print(proj)
 
-def check_projects(args):
-    if args.all:
-        projects = all_projects()
-    else:
-        projects = projects_for_user(args.executer)
+def complete(argv, executer):
+    """ Serves `project __complete <kind> [project]` for the shell completion
+    scripts, printing one candidate per line:
 
-    for proj in projects:
-        pdir = project_dir_path(proj)
-        pconf = project_conf_path(proj)
-        conf = load_conf(proj)
+        projects          every project
+        mine              the projects `executer` is part of
+        members PROJECT   the owner, members and collaborators of PROJECT
+        users             every username
+        roles             the role names
 
-        # check ACL on project config file
-        acl = posix1e.ACL(file=pconf)
-        if not acl.valid():
-            print(conf.project)
-            logger.debug("%s needs fixed, invalid ACL" % conf.project)
-            continue
-        text = acl.to_any_text()
-        if 'user:%s:rw-' % conf.owner not in text:
-            print(conf.project)
-            logger.debug("%s needs fixed, owner doesn't have permissions" % conf.project)
-            continue
-        # check access ACL on project directory
-        acl = posix1e.ACL(file=pdir)
-        ok, msg = _check_acl(acl, conf)
-        if not ok:
-            print(conf.project)
-            logger.debug(msg)
-            continue
-        # check default ACL on project directory
-        acl = posix1e.ACL(filedef=pdir)
-        ok, msg = _check_acl(acl, conf)
-        if not ok:
-            print(conf.project)
-            logger.debug(msg)
-            continue
+    This runs before (and instead of) the argument parser, and reads a small
+    cache (see `completion_cache`). Returns the exit status."""
+    kind = argv[0] if argv else None
+    if kind == 'roles':
+        words = ROLE_NAMES
+    elif kind in ('projects', 'mine', 'users') or (kind == 'members' and len(argv) == 2):
+        cache = completion_cache()
+        if kind == 'projects':
+            words = sorted(cache['projects'])
+        elif kind == 'mine':
+            words = sorted(p for p, users in cache['projects'].items() if executer in users)
+        elif kind == 'members':
+            words = cache['projects'].get(os.path.basename(argv[1].rstrip('/')), [])
+        else:
+            words = cache['users']
+    else:
+        sys.stderr.write("usage: project __complete {projects,mine,users,roles} | "
+                "__complete members <project>\n")
+        return 2
+    for word in words:
+        print(word)
+    return 0
 
-def _check_acl(acl, conf):
-    """Returns  (True, "") if everything is good, otherwise
-                (False, debug message) """
-    def member(u): return 'user:%s:rwx' % u
-    def collab(u): return 'user:%s:r-x' % u
-    public = 'other::r-x'
-    private = 'other::---'
-
-    if not acl.valid():
-        return False, "%s needs fixed, invalid ACL" % conf.project
-    text = acl.to_any_text()
-    if not member(conf.owner) in text:
-        return False, "%s needs fixed, owner doesn't have permissions" % conf.project
-    for m in conf.members:
-        if not member(m) in text:
-            return False, "%s needs fixed, %s doesn't have permissions" % (conf.project, m)
-    for c in conf.collaborators:
-        if not collab(c) in text:
-            return False, "%s needs fixed, %s doesn't have permissions" % (conf.project, c)
+def completion_cache():
+    """ Returns the completion data of PROJECT_ROOT, a dict with:
 
-    if conf.public and not public in text:
-        return False, "%s needs fixed, world doesn't have access" % conf.project
-    elif not conf.public and not private in text:
-        return False, "%s needs fixed, world access not blocked" % conf.project
-    return True, ""
+        projects: project name -> sorted usernames of its owner, members
+                  and collaborators
+        users:    sorted usernames from the passwd database
 
-def create_project(args):
-    pdir = project_dir_path(args.project)
-    pconf = project_conf_path(args.project)
-    if os.path.isdir(pdir):
-        fail("Project directory '%s' already exists" % pdir)
-    if os.path.isfile(pconf):
-        fail("Project config '%s' already exists" % pconf)
+    The cached copy is used while it's younger than COMPLETE_TTL and
+    PROJECT_ROOT hasn't changed (creating, renaming or deleting a project or
+    saving a config rewrites the index, which changes PROJECT_ROOT's mtime;
+    see `root_stamp`).
+    Otherwise it's rebuilt from the index and rewritten."""
+    path = complete_cache_path()
+    try:
+        with open(path) as fobj:
+            cache = json.load(fobj)
+        if (cache['version'] == INDEX_VERSION
+                and cache['root'] == root_stamp()
+                and 0 <= time.time() - cache['time'] < COMPLETE_TTL):
+            return cache
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
 
-    logger.info("Creating directory: %s" % pdir)
+    index = load_index()
+    projects = dict((projname, sorted(set([entry['owner']] + entry['members']
+            + entry['collaborators']))) for projname, entry in index['projects'].items())
+    users = sorted(set(pw.pw_name for pw in pwd.getpwall()))
     try:
-        os.mkdir(pdir)
-    except OSError as e:
-        fail(e)
-    logger.info("Creating config file: %s" % pconf)
-    conf = ProjectDB(args.project, args.executer, args.public)
+        # the cache lives in a subdirectory so that writing it doesn't
+        # change PROJECT_ROOT's mtime, which is stamped after the index
+        # is brought up to date
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cache = {'version': INDEX_VERSION, 'time': time.time(),
+                'root': root_stamp(),
+                'projects': projects, 'users': users}
+        write_atomic(path, json.dumps(cache, sort_keys=True))
+    except (IOError, OSError) as e:
+        logger.debug("Failed to write completion cache: %s" % e)
+    return {'projects': projects, 'users': users}
 
-    # this is the only place where we save the project config BEFORE updating permissions
-    conf.save()
-    update_perms(conf)
+def du_projects(args):
+    """ Prints the disk usage of the user's projects, of `args.project` or,
+    with `args.all` (root only), of every project, as a table or with
+    `args.json` as a JSON object per project (see `du_project`)."""
+    if args.all:
+        require_root(args)
+        projects = list(all_projects())
+    elif args.project:
+        projects = args.project
+        for projname in projects:
+            check_project_exists(projname)
+            conf = load_conf(projname)
+            if args.uid != 0 and args.executer not in (
+                    [conf.owner] + conf.members + conf.collaborators):
+                fail("Only the users of %s can see its disk usage" % projname)
+    else:
+        projects = projects_for_user(args.executer)
 
-def rename_project(args):
-    check_project_exists(args.project)
+    if not args.json:
+        print("%-24s %10s %12s %9s %9s" % ("project", "size", "inodes",
+                "scanned", "cached"))
+    for projname in projects:
+        usage = du_project(projname, refresh=args.refresh, top=args.top)
+        if args.json:
+            usage['project'] = projname
+            print(json.dumps(usage, sort_keys=True))
+            continue
+        print("%-24s %10s %12d %9d %9d" % (projname, human_size(usage['bytes']),
+                usage['inodes'], usage['scanned'], usage['cached']))
+        for sub in usage['largest']:
+            print("  %-22s %10s %12d" % (sub['path'], human_size(sub['bytes']),
+                    sub['inodes']))
 
-    conf = load_conf(args.project)
-    if conf.owner != args.executer:
-        fail("Only the project owner can rename a project")
+def du_project(project_name, refresh=False, top=5):
+    """ Totals the bytes (allocated, as `du` counts them, but counting hard
+    links once per link) and inodes of a project, walking it with `walk_tree`.
 
-    # strip directories from new project name
-    args.new_name = os.path.basename(args.new_name)
+    The totals of each directory's own entries are recorded, along with its
+    subdirectories and mtime, in PROJECT_ROOT/.NAME.du. A directory's mtime
+    changes when an entry is added to, removed from or renamed in it, so the
+    next walk reuses the totals of the directories whose mtime is the same
+    rather than listing them and stat'ing their entries, unless `refresh` is
+    True. Files that grow in place are only noticed once their directory
+    changes (or with `refresh`).
 
-    new_project_dir = project_dir_path(args.new_name)
-    new_project_conf = project_conf_path(args.new_name)
-    logger.debug("Renaming project directory")
-    os.rename(project_dir_path(args.project), new_project_dir)
-    logger.debug("Renaming project config file")
-    os.rename(project_conf_path(args.project), new_project_conf)
+    Returns a dict with the project's 'bytes' and 'inodes', the `top`
+    largest of its top-level directories ('largest', a list of dicts with
+    their 'path', 'bytes' and 'inodes'), and the number of directories
+    'scanned' and reused from the cache ('cached').
+    """
+    pdir = project_dir_path(project_name)
+    cache = {} if refresh else load_du_cache(project_name)
+    began = time.time_ns()
+    # relative path -> (own totals as recorded in the cache, the bytes of
+    # the directory itself)
+    sizes = {}
+    lock = threading.Lock()
 
-def delete_project(args):
-    check_project_exists(args.project)
+    def scan(dirfd, top, visit, counts, descend, since):
+        st = os.fstat(dirfd)
+        relpath = os.path.relpath(top, pdir)
+        own = cache.get(relpath)
+        if own is not None and own['mtime'] == st.st_mtime_ns:
+            counts['cached'] += 1
+            for name in own['dirs']:
+                try:
+                    fd = open_dir(name, dirfd)
+                except OSError:
+                    logger.debug("Can't open directory: %s" % os.path.join(top, name))
+                    continue
+                descend(fd, os.path.join(top, name))
+        else:
+            counts['scanned'] += 1
+            own = {'mtime': st.st_mtime_ns, 'bytes': 0, 'inodes': 0, 'dirs': []}
+            try:
+                entries = os.scandir(dirfd)
+            except OSError:
+                logger.debug("Can't list directory: %s" % top)
+                counts['failed'] += 1
+                own['mtime'] = None     # not to be reused
+                entries = ()
+            for entry in entries:
+                try:
+                    est = entry.stat(follow_symlinks=False)
+                except OSError:
+                    logger.debug("Can't stat: %s" % os.path.join(top, entry.name))
+                    own['mtime'] = None
+                    counts['failed'] += 1
+                    continue
+                own['bytes'] += est.st_blocks * 512
+                own['inodes'] += 1
+                if stat.S_ISDIR(est.st_mode):
+                    own['dirs'].append(entry.name)
+                    try:
+                        fd = open_dir(entry.name, dirfd)
+                    except OSError:
+                        logger.debug("Can't open directory: %s" %
+                                os.path.join(top, entry.name))
+                        continue
+                    descend(fd, os.path.join(top, entry.name))
+        with lock:
+            sizes[relpath] = (own, st.st_blocks * 512)
 
-    conf = load_conf(args.project)
-    if conf.owner != args.executer:
-        fail("Only the project owner can delete a project")
+    counts = walk_tree(pdir, None, scanner=scan)
+    if counts['failed']:
+        logger.warning("%s: %d entries couldn't be counted" % (project_name,
+                counts['failed']))
 
-    logger.debug("Removing project directory")
-    shutil.rmtree(project_dir_path(args.project))
-    logger.debug("Removing project config file")
-    os.remove(project_conf_path(args.project))
+    total = {'bytes': sizes['.'][1], 'inodes': 1}
+    subtrees = collections.defaultdict(lambda: {'bytes': 0, 'inodes': 0})
+    for relpath, (own, size) in sizes.items():
+        total['bytes'] += own['bytes']
+        total['inodes'] += own['inodes']
+        if relpath != '.':
+            subtree = subtrees[relpath.split(os.sep)[0]]
+            subtree['bytes'] += own['bytes']
+            subtree['inodes'] += own['inodes']
+            if os.sep not in relpath:
+                subtree['bytes'] += size
+                subtree['inodes'] += 1
+    largest = sorted(subtrees.items(), key=lambda item: (-item[1]['bytes'], item[0]))[:top]
 
-def print_info(args):
-    """ Display the contents of a project's configuration file."""
-    check_project_exists(args.project)
-    conf = load_conf(args.project)
-    print(conf)
+    # directories changed too recently may change again within the same
+    # mtime tick without it showing, so they are listed again next time
+    recent = began - 2 * 10 ** 9
+    try:
+        save_du_cache(project_name, dict((relpath, own) for relpath, (own, size)
+                in sizes.items() if own['mtime'] is not None and own['mtime'] < recent))
+    except (IOError, OSError) as e:
+        logger.warning("Failed to record directory sizes: %s" % e)
 
-def refresh_permissions(args):
-    """ Refresh the permissions on a project.
+    return {'bytes': total['bytes'], 'inodes': total['inodes'],
+            'largest': [dict(path=path, **subtree) for path, subtree in largest],
+            'scanned': counts['scanned'], 'cached': counts['cached']}
 
-    Note: anyone can refresh the permissions on any project because
-    the operation does not affect the project's owner/members/etc.
-    """
-    check_project_exists(args.project)
-    conf = load_conf(args.project)
-    update_perms(conf)
+def human_size(size):
+    """ Formats `size` bytes with a binary unit, like `du -h`."""
+    if size < 1024:
+        return "%d B" % size
+    for unit in ('KiB', 'MiB', 'GiB', 'TiB'):
+        size /= 1024.0
+        if size < 1024:
+            break
+    else:
+        size /= 1024.0
+        unit = 'PiB'
+    return "%.1f %s" % (size, unit)
 
-def update_perms(conf):
-    """ Sets the UNIX owner/group of the project directory/config to the owner
-    of the project (chown). Recursively sets the ACLs on the config and entire
-    project directory.
-    """
-    pdir = project_dir_path(conf.project)
-    pconf = project_conf_path(conf.project)
+def check_projects(args):
+    """ Prints the name of each project whose permissions should be fixed,
+    or with `args.json` a JSON object (project, path, reason) for each problem.
+    With `args.sample`, prints what `sample_project` found for each project
+    instead, as a table or as a JSON object per project.
+    Projects are checked concurrently, but reported in order."""
+    import concurrent.futures
+    if args.all:
+        projects = list(all_projects())
+    else:
+        projects = projects_for_user(args.executer)
+    prefetch_users(projects)
 
-    uid, gid = 0, 0
-    try:
-        pw = pwd.getpwnam(conf.owner)
-        uid = pw.pw_uid
-        gid = pw.pw_gid
-    except KeyError:
-        fail("Failed to lookup user information for owner")
+    output, jobs = current_output(), current_jobs()
+    def init():
+        use_output(output)
+        use_jobs(jobs)
 
-    logger.info("Chown project directory: %s" % pdir)
+    # a deep check walks its project with workers of its own: the projects
+    # being checked share the `jobs` workers (see `WorkerBudget`)
+    budget = WorkerBudget(jobs)
+    waiting = [len(projects)]
+    lock = threading.Lock()
+    def check(projname):
+        with lock:
+            share = budget.acquire(waiting[0])
+            waiting[0] -= 1
+        use_jobs(share)
+        try:
+            return check_project(projname, args.deep)
+        finally:
+            budget.release(share)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs, initializer=init) as pool:
+        if args.sample is not None:
+            if not args.json:
+                print("%-24s %-7s %8s %8s %10s" % ("project", "status", "sampled",
+                        "drifting", "upper 95%"))
+            for result in pool.map(lambda p: sample_project(p, args.sample), projects):
+                for problem in result['problems']:
+                    logger.debug("%s needs fixed, %s: %s" % problem)
+                if args.json:
+                    print(json.dumps(dict(result, problems=[problem._asdict()
+                            for problem in result['problems']]), sort_keys=True))
+                else:
+                    print("%-24s %-7s %8d %8d %9.2f%%" % (result['project'],
+                            "DRIFT" if result['problems'] else "ok", result['sampled'],
+                            result['drifting'], 100 * result['upper']))
+            return
+        for problems in pool.map(check, projects):
+            for problem in problems:
+                logger.debug("%s needs fixed, %s: %s" % problem)
+                if args.json:
+                    print(json.dumps(problem._asdict()))
+            if problems and not args.json:
+                print(problems[0].project)
+
+def check_project(proj, deep=False):
+    """ Checks the ACLs of a project's config file and directory (and of
+    every file in the project if `deep` is True).
+    Returns a list of Problems, which is empty if the project is fine."""
+    pdir = project_dir_path(proj)
+    store = config_store()
+    pconf = store.path(proj)
     try:
-        os.chown(pdir, uid, gid)
-    except OSError:
-        fail("Failed to chown project directory")
+        conf = parse_conf(proj)
+    except:
+        return [Problem(proj, store.location(proj), "invalid config file")]
 
-    logger.info("Chown project config file: %s" % pconf)
+    backend = acl_backend()
     try:
-        os.chown(pconf, uid, gid)
-    except OSError:
-        fail("Failed to chown project config file")
+        # check ACL on project config file
+        if pconf is not None:
+            entries = backend.read(pconf)
+            if not valid_entries(entries):
+                return [Problem(proj, pconf, "invalid ACL")]
+            if not has_user_entry(entries, conf.owner, 'rw-'):
+                return [Problem(proj, pconf, "owner doesn't have permissions")]
+        # check access and default ACLs on project directory
+        for entries in (backend.read(pdir), backend.read(pdir, default=True)):
+            ok, msg = _check_acl(entries, conf)
+            if not ok:
+                return [Problem(proj, pdir, msg)]
+    except (IOError, OSError, ValueError) as e:
+        return [Problem(proj, pdir, "can't read ACL: %s" % e)]
 
-    # first update ACL on project config
-    logger.info("Updating ACL on project config file")
-    set_access(pconf, conf.owner, [], [], conf.public)
+    if not deep:
+        return []
 
-    # update ACL on project directory and files
-    logger.info("Recursively updating ACL on project directory")
-    set_access(pdir, conf.owner, conf.members, conf.collaborators, conf.public)
+    try:
+        ro, rw, rx, rwx = generate_acls(conf.owner, conf.members,
+                conf.collaborators, conf.public)
+    except ProjectError as e:
+        return [Problem(proj, store.location(proj), str(e))]
 
-    # save the config file on disk
-    conf.save()
+    problems = []
+    def visit(path, st, fd):
+        reason = verify_acl(path, ro, rw, rx, rwx, st, fd)
+        if reason is None:
+            return 'ok'
+        problems.append(Problem(proj, path, reason))
+        return 'drift'
+    walk_tree(pdir, visit)
+    return sorted(problems)
 
-def is_subdir(path, subdir):
-    """Tested in `test_project_manager.py` but be wary"""
-    path = os.path.realpath(os.path.expanduser(path))
-    subdir = os.path.realpath(os.path.expanduser(subdir))
-    if subdir == path:
-        return True
-    elif subdir == '/':
-        return False
-    return is_subdir(path, os.path.dirname(subdir))
+def sample_project(proj, sample):
+    """ Checks a project like `check_project`, then a random sample of its
+    entries (see `sample_tree`) against the exact ACLs `update` would give
+    them, stopping at the first one that differs. `sample` is a number of
+    entries and a percentage of the entries the last update counted, one
+    of them None (see `sample_arg`).
 
-def set_access(root, owner, read_write, read_only, public):
-    """
-    Recursively changes the owner of all files to the current user, since
-    only a file's owner can set its ACL.
-    Clears and resets the ACL for each file/directory in the project.
-    Recursively changes the owner of all files to the project's owner.
+    Returns a dict with the 'project', the 'problems' found, the entries
+    'sampled' and 'drifting' (the project's top directory or config counts
+    as one when it's wrong), the estimated drift 'rate' and the 'upper'
+    bound of its 95% confidence interval (see `wilson_interval`), and for
+    each 'depths' sampled the entries sampled and drifting there.
+    """
+    import math
+    result = {'project': proj, 'problems': check_project(proj), 'depths': {}}
+    if result['problems']:
+        result['sampled'] = result['drifting'] = 1
+    else:
+        entries, percent = sample
+        if percent is not None:
+            manifest = load_manifest(proj)
+            if manifest and manifest.get('entries'):
+                entries = max(1, int(math.ceil(manifest['entries'] * percent / 100.0)))
+            else:
+                logger.warning("The size of %s isn't known until it's updated, "
+                        "sampling %d entries" % (proj, SAMPLE_UNKNOWN_SIZE))
+                entries = SAMPLE_UNKNOWN_SIZE
+        try:
+            conf = parse_conf(proj)
+            ro, rw, rx, rwx = generate_acls(conf.owner, conf.members,
+                    conf.collaborators, conf.public)
+        except Exception as e:
+            result['problems'].append(Problem(proj, config_store().location(proj), str(e)))
+            result['sampled'] = result['drifting'] = 1
+        else:
+            depths, drift = sample_tree(project_dir_path(proj), entries,
+                    lambda path, st: verify_acl(path, ro, rw, rx, rwx, st))
+            if drift is not None:
+                result['problems'].append(Problem(proj, drift[0], drift[1]))
+            result['depths'] = depths
+            result['sampled'] = sum(sampled for sampled, drifting in depths.values())
+            result['drifting'] = sum(drifting for sampled, drifting in depths.values())
+    result['rate'] = result['drifting'] / float(result['sampled'] or 1)
+    result['upper'] = wilson_interval(result['drifting'], result['sampled'])[1]
+    return result
+
+def sample_tree(root, size, check, rng=None):
+    """ Calls `check(path, st)` on up to `size` entries below directory
+    `root` picked by a random walk stratified by depth: in turns, each depth
+    reached so far gets an entry drawn from a random directory of the depth
+    above, so that deep entries get their share however many shallow ones
+    there are. A directory is listed when it's first drawn from, keeping a
+    random reservoir of SAMPLE_RESERVOIR of its entries; the subdirectories
+    found at each depth are kept the same way, so memory use doesn't grow
+    with the tree. Symbolic links aren't sampled, and no entry is checked
+    twice.
+
+    `check` returns None if the entry is fine, otherwise the reason why not,
+    and the walk stops at the first such entry. Returns a dict mapping each
+    depth (1 for the entries of `root`) to the [number of entries checked,
+    number wrong] there, and the (path, reason) of the wrong entry or None.
+    `rng` is the random.Random to draw with.
+    """
+    if rng is None:
+        import random
+        rng = random.Random()
+    # directories (relative to `root`) of each depth that may still be
+    # drawn from, and how many were found at that depth
+    dirs = {0: ['.']}
+    found = collections.Counter({0: 1})
+    # directory -> names of its entries that may still be drawn
+    listed = {}
+    depths = {}
+
+    def keep(reservoir, seen, item):
+        """ Keeps `item`, the `seen`th offered to `reservoir`, with the same
+        odds as the others; returns the item it replaces, if any."""
+        if len(reservoir) < SAMPLE_RESERVOIR:
+            reservoir.append(item)
+            return None
+        i = rng.randrange(seen)
+        if i < SAMPLE_RESERVOIR:
+            reservoir[i], item = item, reservoir[i]
+            return item
+        return None
+
+    def list_dir(relpath, depth):
+        names, seen = [], 0
+        try:
+            fd = open_path(root, relpath)
+        except OSError:
+            logger.debug("Can't open directory: %s" % os.path.join(root, relpath))
+            return names
+        try:
+            with os.scandir(fd) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        continue
+                    seen += 1
+                    keep(names, seen, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        found[depth + 1] += 1
+                        dropped = keep(dirs.setdefault(depth + 1, []), found[depth + 1],
+                                os.path.normpath(os.path.join(relpath, entry.name)))
+                        listed.pop(dropped, None)
+        except OSError:
+            logger.debug("Can't list directory: %s" % os.path.join(root, relpath))
+        finally:
+            os.close(fd)
+        return names
+
+    checked = 0
+    while checked < size:
+        progress = False
+        for depth in sorted(dirs):
+            pool = dirs[depth]
+            while pool:
+                i = rng.randrange(len(pool))
+                relpath = pool[i]
+                if relpath not in listed:
+                    listed[relpath] = list_dir(relpath, depth)
+                if listed[relpath]:
+                    break
+                # nothing left to draw from it
+                pool[i] = pool[-1]
+                pool.pop()
+                del listed[relpath]
+            else:
+                continue
+            names = listed[relpath]
+            path = os.path.normpath(os.path.join(root, relpath,
+                    names.pop(rng.randrange(len(names)))))
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue    # removed since
+            tally = depths.setdefault(depth + 1, [0, 0])
+            tally[0] += 1
+            checked += 1
+            progress = True
+            reason = check(path, st)
+            if reason is not None:
+                tally[1] += 1
+                return depths, (path, reason)
+            if checked >= size:
+                break
+        if not progress:
+            break
+    return depths, None
+
+def wilson_interval(successes, trials, z=1.96):
+    """ Returns the Wilson score interval of a proportion of `successes` in
+    `trials`, at the confidence level of normal quantile `z` (95% by
+    default). Unlike the usual normal approximation, it stays meaningful
+    for proportions near 0, such as a drift rate when no drift was found."""
+    import math
+    if not trials:
+        return 0.0, 1.0
+    p = successes / float(trials)
+    denominator = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denominator
+    half = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, center - half), min(1.0, center + half)
+
+def sample_arg(text):
+    """ Parses the argument of `check --sample`: a number of entries, or a
+    percentage of them such as '2.5%'. Returns (entries, percent), one of
+    them None."""
+    import argparse
+    try:
+        if text.endswith('%'):
+            percent = float(text[:-1])
+            if 0 < percent <= 100:
+                return None, percent
+        else:
+            entries = int(text)
+            if entries > 0:
+                return entries, None
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError("expected a number of entries or a "
+            "percentage, not %r" % text)
+
+def _check_acl(entries, conf):
+    """Returns  (True, "") if ACL `entries` are good, otherwise
+                (False, debug message) """
+    if not valid_entries(entries):
+        return False, "invalid ACL"
+    if not has_user_entry(entries, conf.owner, 'rwx'):
+        return False, "owner doesn't have permissions"
+    for m in conf.members:
+        if not has_user_entry(entries, m, 'rwx'):
+            return False, "%s doesn't have permissions" % m
+    for c in conf.collaborators:
+        if not has_user_entry(entries, c, 'r-x'):
+            return False, "%s doesn't have permissions" % c
+
+    if conf.public and (ACL_OTHER, None, 'r-x') not in entries:
+        return False, "world doesn't have access"
+    elif not conf.public and (ACL_OTHER, None, '---') not in entries:
+        return False, "world access not blocked"
+    return True, ""
+
+def has_user_entry(entries, username, perms):
+    """ Returns True if ACL `entries` grant `username` exactly `perms`."""
+    ids = user_resolver().lookup(username)
+    if ids is None:
+        return False
+    return (ACL_USER, ids[0], perms) in entries
+
+def create_project(args):
+    pdir = project_dir_path(args.project)
+    store = config_store()
+    with config_lock(args.project):
+        if os.path.isdir(pdir):
+            fail("Project directory '%s' already exists" % pdir)
+        if store.exists(args.project):
+            fail("Project config '%s' already exists" % store.location(args.project))
+
+        logger.info("Creating directory: %s" % pdir)
+        try:
+            os.mkdir(pdir)
+        except OSError as e:
+            fail(e)
+        logger.info("Creating config: %s" % store.location(args.project))
+        conf = ProjectDB(args.project, args.executer, args.public)
+        conf.save()
+    update_perms(conf)
+
+def rename_project(args):
+    # strip directories from new project name
+    args.new_name = os.path.basename(args.new_name)
+
+    # locked in name order, so that renames of two projects into each other
+    # can't each wait for the lock the other holds
+    with contextlib.ExitStack() as locks:
+        for name in sorted({args.project, args.new_name}):
+            locks.enter_context(config_lock(name))
+        check_project_exists(args.project)
+        conf = load_conf(args.project)
+        if conf.owner != args.executer:
+            fail("Only the project owner can rename a project")
+        store = config_store()
+        if os.path.exists(project_dir_path(args.new_name)) or \
+                store.exists(args.new_name):
+            fail("Project %s already exists" % args.new_name)
+
+        logger.debug("Renaming project directory")
+        os.rename(project_dir_path(args.project), project_dir_path(args.new_name))
+        logger.debug("Renaming project config")
+        store.rename(args.project, args.new_name)
+        if os.path.isfile(project_manifest_path(args.project)):
+            os.rename(project_manifest_path(args.project),
+                    project_manifest_path(args.new_name))
+        # the checkpoint's paths are relative to the project, so it still
+        # applies, as do the directory sizes
+        if os.path.isfile(project_checkpoint_path(args.project)):
+            os.rename(project_checkpoint_path(args.project),
+                    project_checkpoint_path(args.new_name))
+        if os.path.isfile(project_du_path(args.project)):
+            os.rename(project_du_path(args.project),
+                    project_du_path(args.new_name))
+
+def delete_project(args):
+    with config_lock(args.project):
+        check_project_exists(args.project)
+        conf = load_conf(args.project)
+        if conf.owner != args.executer:
+            fail("Only the project owner can delete a project")
+        entry = trash_project(conf, args.executer)
+    print("Moved %s to the trash; 'project trash restore %s' brings it back "
+            "within %d days" % (args.project, entry, TRASH_RETENTION // 86400))
+    # the daemon's own purger takes care of it there
+    if current_output() is None:
+        purge_in_background()
+
+def trash_project(conf, executer):
+    """ Moves the directory and config of project `conf` into a new entry of
+    the trash (see `trash_path`), returning the entry's name. Both are
+    renamed, so this is instant however large the project; its files are
+    removed once the entry expires (see `purge_trash`)."""
+    trash = trash_path()
+    try:
+        os.mkdir(trash, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    deleted = time.time()
+    name = "%s-%s" % (conf.project, time.strftime('%Y%m%dT%H%M%S', time.gmtime(deleted)))
+    for suffix in [''] + ['.%d' % i for i in range(1, 100)]:
+        try:
+            os.mkdir(os.path.join(trash, name + suffix), 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            continue
+        name += suffix
+        break
+    else:
+        fail("Too many deletions of %s at once" % conf.project)
+    entry = os.path.join(trash, name)
+    write_atomic(os.path.join(entry, 'info.json'), json.dumps({'project': conf.project,
+            'owner': conf.owner, 'deleted_by': executer, 'deleted': deleted}))
+
+    logger.debug("Moving project directory and config file to %s" % entry)
+    os.rename(project_dir_path(conf.project), os.path.join(entry, 'project'))
+    config_store().move_out(conf.project, os.path.join(entry, 'config.yml'))
+    for path in (project_manifest_path(conf.project), project_du_path(conf.project)):
+        if os.path.isfile(path):
+            os.remove(path)
+    remove_checkpoint(conf.project)
+    return name
+
+def trash_entries():
+    """ Returns the entries of the trash, oldest first, as dicts with their
+    'name', 'path', and the 'project', 'owner', 'deleted_by' and 'deleted'
+    (time) recorded by `trash_project`; the latter are None if unknown."""
+    entries = []
+    try:
+        names = os.listdir(trash_path())
+    except OSError:
+        return entries
+    for name in names:
+        path = os.path.join(trash_path(), name)
+        info = {'project': None, 'owner': None, 'deleted_by': None, 'deleted': None}
+        try:
+            with open(os.path.join(path, 'info.json')) as fobj:
+                info.update(json.load(fobj))
+        except (IOError, OSError, ValueError):
+            pass
+        if info['deleted'] is None:
+            try:
+                info['deleted'] = os.lstat(path).st_mtime
+            except OSError:
+                continue
+        info.update(name=name, path=path)
+        entries.append(info)
+    return sorted(entries, key=lambda e: (e['deleted'], e['name']))
+
+def manage_trash(args):
+    """ Lists, restores or removes deleted projects. Users see (and may
+    restore or purge) the projects they owned; root sees all of them.
+    Anyone may purge the entries older than TRASH_RETENTION."""
+    root = args.uid == 0
+    entries = [e for e in trash_entries() if root or e['owner'] == args.executer]
+
+    if args.action == 'list':
+        if args.entry:
+            entries = [e for e in entries if e['name'] in args.entry or
+                    e['project'] in args.entry]
+        for e in entries:
+            print("%-40s %-12s deleted %s, expires %s" % (e['name'], e['owner'] or '?',
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(e['deleted'])),
+                    time.strftime('%Y-%m-%d %H:%M',
+                        time.localtime(e['deleted'] + TRASH_RETENTION))))
+        return
+
+    if args.max_ops is not None and args.max_ops <= 0:
+        fail("The maximum number of operations per second must be positive")
+    if args.action == 'restore':
+        if len(args.entry) != 1:
+            fail("Give the trash entry (or project) to restore")
+        restore_project(find_trash_entry(entries, args.entry[0]))
+        return
+
+    if args.entry:
+        chosen = [find_trash_entry(entries, name) for name in args.entry]
+    else:
+        chosen = expired_trash()
+    purge_trash(chosen, RateLimiter(args.max_ops or PURGE_MAX_OPS))
+
+def expired_trash():
+    """ Returns the entries of the trash older than TRASH_RETENTION."""
+    now = time.time()
+    return [e for e in trash_entries() if e['deleted'] + TRASH_RETENTION <= now]
+
+def purge_expired(limiter=None):
+    """ Removes expired trash, unless another process is doing so already
+    (holding PROJECT_ROOT/.locks/trash.purge). Returns whether it did."""
+    import fcntl
+    fd = open_lock(trash_purge_lock_path())
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            logger.info("Expired trash is already being removed")
+            return False
+        purge_trash(expired_trash(), limiter)
+        return True
+    finally:
+        os.close(fd)
+
+def purge_in_background():
+    """ Removes expired trash in a detached process with the lowest
+    priority, for sites that don't run the daemon (which does so every
+    TRASH_PURGE_INTERVAL seconds), without keeping the caller waiting."""
+    if not expired_trash():
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    # the child starts the purge in a new session and exits at once, so
+    # that it outlives the command and its terminal
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            lower_priority()
+            purge_expired(RateLimiter(PURGE_MAX_OPS))
+    except Exception as e:
+        logger.error("Failed to remove expired trash: %s" % e)
+    finally:
+        os._exit(0)
+
+def find_trash_entry(entries, name):
+    """ Returns the trash entry called `name`, or else the latest entry of
+    project `name`, among `entries`."""
+    for e in entries:
+        if e['name'] == name:
+            return e
+    latest = [e for e in entries if e['project'] == name]
+    if not latest:
+        fail("No project %s in the trash" % name)
+    return latest[-1]
+
+def restore_project(entry):
+    """ Moves a project back out of trash `entry`, under its original name."""
+    name = entry['project']
+    if name is None:
+        fail("Don't know which project %s was" % entry['name'])
+    store = config_store()
+    with config_lock(name):
+        if os.path.exists(project_dir_path(name)) or store.exists(name):
+            fail("Project %s exists, rename it first" % name)
+        store.move_in(name, os.path.join(entry['path'], 'config.yml'))
+        os.rename(os.path.join(entry['path'], 'project'), project_dir_path(name))
+    os.remove(os.path.join(entry['path'], 'info.json'))
+    os.rmdir(entry['path'])
+    print("Restored %s" % name)
+
+def purge_trash(entries, limiter=None):
+    """ Removes trash `entries` for good (see `remove_tree`). An entry that
+    can't be removed is logged and left for the next purge."""
+    failed = 0
+    for e in entries:
+        logger.info("Removing %s from the trash" % e['name'])
+        try:
+            remove_tree(e['path'], limiter=limiter)
+        except OSError as err:
+            logger.error("Failed to remove %s: %s" % (e['path'], err))
+            failed += 1
+    if failed:
+        fail("%d of %d trash entries could not be removed" % (failed, len(entries)))
+
+def remove_tree(path, jobs=None, limiter=None):
+    """ Removes directory `path` and everything below it, like shutil.rmtree,
+    but with the directories scanned by `walk_tree` with `jobs` threads and,
+    if `limiter` (a RateLimiter) is given, the removals spaced out.
+    Files are removed as the directories are scanned, which are then
+    removed deepest first. Everything is removed by name relative to a
+    descriptor of its directory, opened without following symbolic links
+    (the directories by reopening their parents with `open_path`): a former
+    member still in the project when it was deleted can swap a directory for
+    a symbolic link meanwhile, which is then removed or makes the removal
+    fail, but never followed."""
+    # directories below `path`, relative to it
+    dirs = []
+
+    def scan(dirfd, top, visit, counts, descend, since):
+        with os.scandir(dirfd) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(os.path.relpath(os.path.join(top, entry.name), path))
+                    descend(open_dir(entry.name, dirfd), os.path.join(top, entry.name))
+                    continue
+                if limiter is not None:
+                    limiter.wait()
+                os.unlink(entry.name, dir_fd=dirfd)
+
+    walk_tree(path, None, jobs=jobs, scanner=scan)
+    children = collections.defaultdict(list)
+    for relpath in dirs:
+        parent, name = os.path.split(relpath)
+        children[parent].append(name)
+    # the subdirectories of deeper parents first, so that every directory is
+    # empty by the time it's removed
+    for parent in sorted(children, reverse=True,
+            key=lambda relpath: len(relpath.split(os.sep)) if relpath else 0):
+        fd = open_path(path, parent)
+        try:
+            for name in children[parent]:
+                if limiter is not None:
+                    limiter.wait()
+                os.rmdir(name, dir_fd=fd)
+        finally:
+            os.close(fd)
+    os.rmdir(path)
+
+def print_info(args):
+    """ Display the contents of a project's configuration file."""
+    check_project_exists(args.project)
+    conf = load_conf(args.project)
+    print(conf)
+
+def refresh_permissions(args):
+    """ Refresh the permissions on a project, or with `args.all` (or
+    `args.user`) on every project (or every project of that user).
+
+    Note: anyone can refresh the permissions on any project because
+    the operation does not affect the project's owner/members/etc.
+    """
+    if [bool(args.project), args.all, args.user is not None].count(True) != 1:
+        fail("Give one of a project name, --all or --user")
+    if args.project:
+        check_project_exists(args.project)
+    if args.max_ops is not None and args.max_ops <= 0:
+        fail("The maximum number of operations per second must be positive")
+    limiter = RateLimiter(args.max_ops) if args.max_ops else None
+    if args.nice:
+        lower_priority()
+    stats = None
+    if args.stats or args.stats_json:
+        stats = Stats(args.stats_top)
+    use_stats(stats)
+    try:
+        if not args.project:
+            projects = list(all_projects()) if args.all else projects_for_user(args.user)
+            update_projects(projects, incremental=args.incremental,
+                    resume=args.resume, limiter=limiter, wait=args.wait)
+            return
+        start = time.perf_counter()
+        conf = load_conf(args.project)
+        if stats is not None:
+            stats.time('config', time.perf_counter() - start)
+        update_perms(conf, incremental=args.incremental, resume=args.resume,
+                limiter=limiter, wait=args.wait)
+    finally:
+        use_stats(None)
+        if stats is not None:
+            print_stats(stats, args.stats_json)
+
+def update_projects(projects, incremental=False, resume=False, limiter=None,
+        wait=False):
+    """ Updates the permissions of `projects` concurrently, sharing
+    `current_jobs()` workers between them (see `WorkerBudget`), then prints a summary.
+    Projects already being updated are 'queued' for that update to update
+    again, unless `wait` is True (see `update_perms`).
+
+    The largest projects (by the entries their last update's manifest
+    recorded) start first so that they don't finish last; projects never
+    updated before count as largest. A project that fails to update doesn't
+    stop the others, but the command fails once they are all done.
+    """
+    prefetch_users(projects)
+    sizes = {}
+    for projname in projects:
+        manifest = load_manifest(projname)
+        sizes[projname] = manifest.get('entries') if manifest else None
+    waiting = collections.deque(sorted(projects,
+            key=lambda p: (sizes[p] is not None, -(sizes[p] or 0), p)))
+    total = current_jobs()
+    budget = WorkerBudget(total)
+    results = {}
+    lock = threading.Lock()
+    output = current_output()
+    stats = current_stats()
+
+    def run():
+        use_output(output)
+        use_stats(stats)
+        while True:
+            with lock:
+                if not waiting:
+                    return
+                projname = waiting.popleft()
+                jobs = budget.acquire(len(waiting) + 1)
+            start = time.perf_counter()
+            try:
+                conf = load_conf(projname)
+                if stats is not None:
+                    stats.time('config', time.perf_counter() - start)
+                counts, error = update_perms(conf, incremental=incremental,
+                        resume=resume, limiter=limiter, jobs=jobs, wait=wait), None
+            except Exception as e:
+                logger.error("Failed to update %s: %s" % (projname, e))
+                counts, error = collections.Counter(), e
+            finally:
+                budget.release(jobs)
+            results[projname] = (counts, error, time.perf_counter() - start)
+
+    threads = [threading.Thread(target=run) for _ in range(min(total, len(waiting)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print("%-24s %-7s %10s %10s %8s %9s" % ("project", "status", "written",
+            "skipped", "failed", "seconds"))
+    for projname in sorted(results):
+        counts, error, seconds = results[projname]
+        status = "FAILED" if error is not None else "ok" if counts is not None else "queued"
+        counts = counts or collections.Counter()
+        print("%-24s %-7s %10d %10d %8d %9.1f" % (projname, status,
+                counts['written'], counts['skipped'], counts['failed'], seconds))
+    failed = [p for p in results if results[p][1] is not None]
+    if failed:
+        fail("%d of %d projects failed to update: %s" % (len(failed),
+                len(results), ", ".join(sorted(failed))))
+
+class WorkerBudget(object):
+    """ Shares `total` workers between tasks running concurrently, such as
+    the project updates of `update_projects`."""
+    def __init__(self, total):
+        self.free = total
+        self.cond = threading.Condition()
+
+    def acquire(self, tasks):
+        """ Waits for a worker to be free, then takes an even share of the
+        free workers between `tasks` tasks yet to start (the caller's
+        included). Returns the number taken, to be given back to `release`."""
+        with self.cond:
+            while not self.free:
+                self.cond.wait()
+            share = max(1, self.free // tasks)
+            self.free -= share
+            return share
+
+    def release(self, count):
+        with self.cond:
+            self.free += count
+            self.cond.notify_all()
+
+def print_stats(stats, as_json=False):
+    """ Prints the report of `stats`, as a JSON object if `as_json` is True."""
+    report = stats.report()
+    if as_json:
+        print(json.dumps(report, sort_keys=True))
+        return
+    print("Elapsed: %.3fs" % report['elapsed'])
+    for phase in Stats.phases:
+        print("  %-10s %10.3fs" % (phase, report['seconds'][phase]))
+    counts = report['counts']
+    print(", ".join("%s: %d" % (name, counts[name]) for name in sorted(counts)))
+    if report['slowest']:
+        print("Slowest directories:")
+        for slow in report['slowest']:
+            print("  %10.3fs %s" % (slow['seconds'], slow['path']))
+
+def update_perms(conf, incremental=False, resume=False, limiter=None, jobs=None,
+        wait=False):
+    """ Updates the permissions of project `conf` (see `refresh_perms`), as
+    re-read from its saved config, unless they are already being updated.
+
+    Only one update of a project runs at a time, holding an exclusive flock
+    on PROJECT_ROOT/.locks/NAME.update. Callers first leave a marker
+    (PROJECT_ROOT/.locks/NAME.dirty) saying the project needs an update.
+    Whoever holds the lock takes the marker and updates the project with the
+    config saved at that time, then starts over as long as a marker was left
+    meanwhile. However many requests come in while an update runs, they are
+    served by a single follow-up update, which is a full one unless they all
+    asked for an `incremental` one. If another update is running, this
+    returns None straight away, or once it's done if `wait` is True.
+
+    `resume` only applies to the first update, `limiter` and `jobs` to all.
+    Returns the sum of the Counters of the updates run.
+    """
+    import fcntl
+    name = conf.project
+    with config_lock(name):
+        mark_for_update(name, incremental)
+    fd = open_lock(project_update_lock_path(name))
+    try:
+        total = None
+        while True:
+            if not lock_update(fd, wait):
+                logger.warning("Permissions of %s are already being updated; the "
+                        "change is queued and will be applied by the update that "
+                        "follows it" % name)
+                return total
+            try:
+                with config_lock(name):
+                    marker = take_update_marker(name)
+                    if marker is None:
+                        # served by an update that was running
+                        return total
+                    conf = load_conf(name)
+                counts = refresh_perms(conf, incremental=marker['incremental'],
+                        resume=resume and total is None, limiter=limiter, jobs=jobs)
+                total = counts if total is None else total + counts
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            if not os.path.exists(project_update_marker_path(name)):
+                return total
+            logger.info("Config of %s changed during the update, updating again" % name)
+    finally:
+        os.close(fd)
+
+def lock_update(fd, wait):
+    """ Takes the update lock `fd`, waiting for it if `wait` is True; returns
+    whether it was taken."""
+    import fcntl
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+def refresh_perms(conf, incremental=False, resume=False, limiter=None, jobs=None):
+    """ Sets the UNIX owner/group of the project directory/config to the owner
+    of the project (chown). Recursively sets the ACLs on the config and entire
+    project directory. The config itself must already be saved: commands
+    that change it save it first (see `edit_conf`). Callers go through
+    `update_perms`, which keeps updates of a project from overlapping.
+
+    If `incremental` is True and the project's membership hasn't changed since
+    the last successful update, only entries of directories modified since then
+    are updated. A manifest is recorded after every successful update.
+
+    While the tree is walked, a checkpoint of its progress is recorded every
+    CHECKPOINT_INTERVAL seconds and when the update is interrupted. If
+    `resume` is True and the membership hasn't changed since, the update
+    carries on from the checkpoint of an unfinished one. `limiter` and
+    `jobs` are passed on to `set_access`.
+
+    Returns the Counter of entries returned by `set_access`.
+    """
+    pdir = project_dir_path(conf.project)
+    pconf = config_store().path(conf.project)
+
+    ids = user_resolver().lookup(conf.owner)
+    if ids is None:
+        fail("Failed to lookup user information for owner")
+    uid, gid = ids
+
+    stats = current_stats()
+    start = time.perf_counter()
+    logger.info("Chown project directory: %s" % pdir)
+    try:
+        os.chown(pdir, uid, gid)
+    except OSError:
+        fail("Failed to chown project directory")
+
+    if pconf is not None:
+        logger.info("Chown project config file: %s" % pconf)
+        try:
+            os.chown(pconf, uid, gid)
+        except OSError:
+            fail("Failed to chown project config file")
+    if stats is not None:
+        stats.time('chown', time.perf_counter() - start)
+
+    if pconf is not None:
+        # first update ACL on project config
+        logger.info("Updating ACL on project config file")
+        set_access(pconf, conf.owner, [], [], conf.public)
+
+    fingerprint = conf.fingerprint()
+    checkpoint = load_checkpoint(conf.project) if resume else None
+    if resume and checkpoint is None:
+        logger.info("No checkpoint of an unfinished update to resume from")
+    elif checkpoint is not None and checkpoint.get('fingerprint') != fingerprint:
+        logger.info("Project membership changed since the checkpoint, not resuming")
+        checkpoint = None
+    manifest = load_manifest(conf.project) if incremental else None
+    since = None
+    if checkpoint is not None:
+        since = checkpoint.get('since')
+        logger.info("Resuming the update of %d directories" % len(checkpoint['pending']))
+    elif manifest is None:
+        if incremental:
+            logger.info("No manifest from a previous update, doing a full update")
+    elif manifest.get('fingerprint') != fingerprint:
+        logger.info("Project membership changed, doing a full update")
+    else:
+        since = manifest.get('since')
+
+    # progress made by the runs this one resumes
+    done = collections.Counter(checkpoint and checkpoint.get('counts') or {})
+    # the next incremental update looks at directories changed since this
+    # one (or the first of those it resumes) began: taken from the directory
+    # ctimes seen instead, it would be bumped by the ACLs written and miss
+    # entries added to directories scanned earlier
+    began = checkpoint and checkpoint.get('began') or \
+            filesystem_time(project_update_lock_path(conf.project))
+    def record(pending, counts):
+        try:
+            save_checkpoint(conf.project, {'fingerprint': fingerprint,
+                    'since': since, 'pending': pending, 'counts': dict(done + counts),
+                    'began': began})
+        except (IOError, OSError) as e:
+            logger.warning("Failed to record checkpoint: %s" % e)
+
+    # update ACL on project directory and files
+    logger.info("Recursively updating ACL on project directory")
+    counts = set_access(pdir, conf.owner, conf.members,
+            conf.collaborators, conf.public, since=since,
+            start=checkpoint['pending'] if checkpoint is not None else None,
+            checkpoint=record, limiter=limiter, jobs=jobs)
+    counts += done
+    remove_checkpoint(conf.project)
+
+    start = time.perf_counter()
+    if counts['failed']:
+        logger.debug("Not recording manifest, %d entries failed" % counts['failed'])
+    else:
+        entries = counts['written'] + counts['skipped']
+        if since is not None:
+            previous = manifest or load_manifest(conf.project) or {}
+            entries = previous.get('entries', entries)
+        try:
+            save_manifest(conf.project, {'fingerprint': fingerprint,
+                    'since': began, 'entries': entries})
+        except (IOError, OSError) as e:
+            logger.warning("Failed to record manifest: %s" % e)
+    if stats is not None:
+        stats.time('save', time.perf_counter() - start)
+    return counts
+
+def is_subdir(path, subdir):
+    """Tested in `test_project_manager.py` but be wary"""
+    path = os.path.realpath(os.path.expanduser(path))
+    subdir = os.path.realpath(os.path.expanduser(subdir))
+    if subdir == path:
+        return True
+    elif subdir == '/':
+        return False
+    return is_subdir(path, os.path.dirname(subdir))
+
+def set_access(root, owner, read_write, read_only, public, since=None,
+        start=None, checkpoint=None, limiter=None, jobs=None):
+    """
+    Recursively changes the owner of all files to the current user, since
+    only a file's owner can set its ACL.
+    Clears and resets the ACL for each file/directory in the project whose
+    ACL differs from the expected one, leaving the others untouched.
+    Recursively changes the owner of all files to the project's owner.
+
+    If `since` is given, only the entries of directories whose ctime (in
+    nanoseconds) is not older than `since` are updated. Subdirectories are
+    still descended into, because a directory's ctime doesn't change when
+    something deeper in its tree does.
+
+    `start` and `checkpoint` are passed on to `walk_tree`, to resume an
+    interrupted update and record its progress, as is `jobs`. If `limiter`
+    (a RateLimiter) is given, it spaces out the entries updated.
+
+    Returns a Counter of entries 'written', 'skipped', 'failed' and
+    'rejected' (symbolic links pointing outside PROJECT_ROOT).
     """
     # Don't allow top-level files/dirs to be symbolic links
     if os.path.islink(root):
         fail("%s is a symbolic link. Cannot update ACL")
 
-    texts = []
+    stats = current_stats()
+    begin = time.perf_counter()
+    ro, rw, rx, rwx = generate_acls(owner, read_write, read_only, public)
+    if stats is not None:
+        stats.time('generate', time.perf_counter() - begin)
+
+    def visit(path, st, fd):
+        if limiter is not None:
+            limiter.wait()
+        return apply_acl(path, ro, rw, rx, rwx, st, fd)
+
+    counts = collections.Counter()
+    counts[visit(root, None, None)] += 1
+    isdir = os.path.isdir(root)
+
+    if isdir:
+        begin = time.perf_counter()
+        counts += walk_tree(root, visit, jobs=jobs, since=since, start=start,
+                checkpoint=checkpoint)
+        if stats is not None:
+            stats.time('walk', time.perf_counter() - begin)
+    if stats is not None:
+        stats.count('dirs' if isdir else 'files')
+        for status in ('written', 'skipped', 'failed', 'rejected'):
+            stats.count(status, counts[status])
+
+    logger.info("%s: updated %d entries, %d already up to date, %d failed" %
+            (root, counts['written'], counts['skipped'], counts['failed']))
+    return counts
+
+def user_resolver():
+    """ Returns the UserResolver of PROJECT_ROOT, creating it on first use."""
+    resolver = _resolvers.get(PROJECT_ROOT)
+    if resolver is None:
+        resolver = _resolvers.setdefault(PROJECT_ROOT,
+                UserResolver(user_cache_path() if USER_CACHE_PERSIST else None))
+    return resolver
+
+def prefetch_users(projects):
+    """ Looks up all the users of `projects`, as recorded in the index, in
+    one batch, so that commands going through many projects don't look
+    their users up one project at a time."""
+    index = load_index()['projects']
+    users = set()
+    for projname in projects:
+        entry = index.get(projname)
+        if entry is not None:
+            users.add(entry['owner'])
+            users.update(entry['members'] + entry['collaborators'])
+    user_resolver().resolve(users)
+
+class UserResolver(object):
+    """ Looks users up through NSS, which may mean slow LDAP or SSSD round
+    trips, and caches their uid and gid for USER_CACHE_TTL seconds (and
+    users that don't exist for USER_CACHE_MISS_TTL seconds), so that each
+    user is looked up once however many projects and ACLs they are in.
+    Found users are also kept in the JSON file `path`, if given, for the
+    commands that follow. It may be used by several threads at once."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = path is None
+        # username -> (uid, gid, time looked up), uid and gid None if unknown
+        self.users = {}
+
+    def lookup(self, name):
+        """ Returns the (uid, gid) of user `name`, or None if there's no
+        such user."""
+        return self.resolve([name]).get(name)
+
+    def resolve(self, names):
+        """ Returns a dict of the (uid, gid) of each of users `names` that
+        exists. The ones not cached are looked up concurrently."""
+        now = time.time()
+        found, missing = {}, []
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            for name in set(names):
+                cached = self.users.get(name)
+                if cached is not None and 0 <= now - cached[2] < (
+                        USER_CACHE_TTL if cached[0] is not None else USER_CACHE_MISS_TTL):
+                    if cached[0] is not None:
+                        found[name] = cached[:2]
+                else:
+                    missing.append(name)
+        if not missing:
+            return found
+        if len(missing) == 1 or USER_LOOKUP_THREADS <= 1:
+            fetched = [self.fetch(name) for name in missing]
+        else:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(USER_LOOKUP_THREADS, len(missing))) as pool:
+                fetched = list(pool.map(self.fetch, missing))
+        with self.lock:
+            for name, ids in zip(missing, fetched):
+                self.users[name] = (ids or (None, None)) + (now,)
+                if ids is not None:
+                    found[name] = ids
+            if any(ids is not None for ids in fetched):
+                self.save()
+        return found
+
+    def fetch(self, name):
+        """ Looks user `name` up through NSS; returns their (uid, gid), or
+        None if there's no such user."""
+        try:
+            pw = pwd.getpwnam(name)
+        except KeyError:
+            return None
+        return pw.pw_uid, pw.pw_gid
+
+    def load(self):
+        self.loaded = True
+        try:
+            with open(self.path) as fobj:
+                users = json.load(fobj)['users']
+            for name, (uid, gid, looked_up) in users.items():
+                self.users[name] = (int(uid), int(gid), float(looked_up))
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug("Not using the user cache: %s" % e)
+
+    def save(self):
+        if self.path is None:
+            return
+        now = time.time()
+        users = dict((name, list(cached)) for name, cached in self.users.items()
+                if cached[0] is not None and 0 <= now - cached[2] < USER_CACHE_TTL)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_atomic(self.path, json.dumps({'users': users}, sort_keys=True))
+        except (IOError, OSError) as e:
+            logger.debug("Failed to save the user cache: %s" % e)
+
+def generate_acls(owner, read_write, read_only, public):
+    """ Returns the four TargetACLs applied to project entries: read-only,
+    read-write, read-execute and read-write-execute. They are made of
+    numeric uids, all looked up in one batch (see `UserResolver`)."""
+    backend = acl_backend()
+    users = read_write + read_only + [owner]
+    found = user_resolver().resolve(users)
+    uids = {}
+    for user in users:
+        if user in found:
+            uids[user] = found[user][0]
+        elif user.isdigit():
+            uids[user] = int(user)
+        else:
+            fail("Failed to create ACL. Check project config file for non-existent users")
+
+    gen = []
     for x in ('-', 'x'):
         for w in ('-', 'w'):
-            pieces = ['u::r%s%s,g::r%s%s' % (w, x, w, x)]
+            entries = [(ACL_USER_OBJ, None, 'r%s%s' % (w, x)),
+                    (ACL_GROUP_OBJ, None, 'r%s%s' % (w, x))]
             if public:
-                pieces.append(',o::r-%s' % x)
+                entries.append((ACL_OTHER, None, 'r-%s' % x))
             else:
-                pieces.append(',o::---')
+                entries.append((ACL_OTHER, None, '---'))
 
             # Owners and Members have read/write
             writers = read_write + [owner]
             for user in writers:
-                pieces.append(',u:%s:r%s%s' % (user, w, x))
+                entries.append((ACL_USER, uids[user], 'r%s%s' % (w, x)))
             # Collaborators have read-only
             for user in read_only:
-                pieces.append(',u:%s:r-%s' % (user, x))
+                entries.append((ACL_USER, uids[user], 'r-%s' % x))
+            entries.append(acl_mask(entries))
 
-            texts.append(''.join(pieces))
+            if not valid_entries(entries):
+                logger.debug("Bad ACL: %s" % sorted(entries, key=str))
+                fail("Error generating ACL. Please notify system administrator.")
+            entries = frozenset(entries)
+            gen.append(TargetACL(backend.prepare(entries), entries))
 
-    gen = []
-    for text in texts:
+    return gen[0], gen[1], gen[2], gen[3]
+
+def acl_mask(entries):
+    """ Returns the mask entry for ACL `entries`: the union of the
+    permissions of the group class (named users, owning group, named groups)."""
+    perms = [p for tag, qualifier, p in entries
+            if tag in (ACL_USER, ACL_GROUP_OBJ, ACL_GROUP)]
+    return (ACL_MASK, None, ''.join(c if any(p[i] == c for p in perms) else '-'
+            for i, c in enumerate('rwx')))
+
+def valid_entries(entries):
+    """ Returns True if ACL `entries` make a valid ACL, as acl_valid(3) does:
+    one owner, owning group and other entry, no user or group listed twice,
+    and a mask if (and only if) there are named users or groups."""
+    tags = collections.Counter(tag for tag, qualifier, perms in entries)
+    named = [(tag, qualifier) for tag, qualifier, perms in entries
+            if tag in (ACL_USER, ACL_GROUP)]
+    return (tags[ACL_USER_OBJ] == tags[ACL_GROUP_OBJ] == tags[ACL_OTHER] == 1
+            and len(set(named)) == len(named)
+            and tags[ACL_MASK] == (1 if named else 0))
+
+def open_dir(name, dir_fd=None):
+    """ Opens directory `name` (relative to `dir_fd`) for scanning, refusing
+    to follow a symbolic link."""
+    return os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+            dir_fd=dir_fd)
+
+def open_entry(path):
+    """ Opens `path` as an O_PATH descriptor for `apply_acl` and `verify_acl`,
+    resolving it first and then opening it one component at a time from
+    PROJECT_ROOT without following symbolic links, so that a link swapped in
+    along the way makes the open fail rather than lead out of the tree.
+    Raises OSError if it can't be opened or isn't inside PROJECT_ROOT."""
+    root = os.path.realpath(PROJECT_ROOT)
+    relpath = os.path.relpath(os.path.realpath(path), root)
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+        raise OSError(errno.EXDEV, "Not in $PROJECT_ROOT", path)
+    parent, name = os.path.split(relpath)
+    dirfd = open_path(root, parent)
+    try:
+        return os.open(name or '.', os.O_PATH | os.O_NOFOLLOW, dir_fd=dirfd)
+    finally:
+        os.close(dirfd)
+
+def fd_path(fd):
+    """ Returns a path that refers to whatever descriptor `fd` is open on,
+    for the ACL backends, which take paths."""
+    return '/proc/self/fd/%d' % fd
+
+def scan_dir(dirfd, top, visit, counts, descend, since=None):
+    """ Calls `visit(path, st, fd)` on each entry of the directory open as
+    `dirfd` (whose path is `top`), tallying its return values in `counts`.
+    `fd` is an O_PATH descriptor of the entry, opened relative to `dirfd`
+    without following symbolic links, and `st` its fstat result; ACLs are
+    read and written through `fd`, so an entry replaced by a symbolic link
+    once listed is skipped rather than followed. For a symbolic link, `st`
+    and `fd` are None and it's only visited if it resolves to a path inside
+    PROJECT_ROOT (`apply_acl` then opens it with `open_entry`).
+
+    Each subdirectory is opened relative to `dirfd` without following
+    symbolic links and handed to `descend(fd, path)`, which takes ownership
+    of the descriptor. The walk therefore never leaves the tree and needs no
+    containment check for anything but symbolic links.
+
+    If `since` is given and `top` hasn't changed since then, its entries
+    are not visited.
+    """
+    try:
+        ctime = os.fstat(dirfd).st_ctime_ns
+        entries = os.scandir(dirfd)
+    except OSError:
+        logger.debug("Can't list directory: %s" % top)
+        return
+
+    changed = since is None or ctime >= since
+    stats = current_stats()
+    with entries:
+        for entry in entries:
+            path = os.path.join(top, entry.name)
+            try:
+                if entry.is_symlink():
+                    if stats is not None and changed:
+                        stats.count('symlinks')
+                    if changed:
+                        realpath = os.path.realpath(path)
+                        if is_subdir(PROJECT_ROOT, realpath):
+                            counts[visit(path, None, None)] += 1
+                        else:
+                            logger.warning(
+                                    "%s is actually %s, which is not in $PROJECT_ROOT" %
+                                    (path, realpath))
+                            counts['rejected'] += 1
+                    continue
+                isdir = entry.is_dir(follow_symlinks=False)
+                if changed:
+                    start = time.perf_counter()
+                    fd = os.open(entry.name, os.O_PATH | os.O_NOFOLLOW, dir_fd=dirfd)
+                    try:
+                        st = os.fstat(fd)
+                        if stats is not None:
+                            stats.time('stat', time.perf_counter() - start)
+                            stats.count('dirs' if isdir else 'files')
+                        if st.st_ino != entry.inode() or stat.S_ISLNK(st.st_mode):
+                            logger.warning("%s changed while being scanned, skipping it" % path)
+                            counts['failed'] += 1
+                            continue
+                        counts[visit(path, st, fd)] += 1
+                    finally:
+                        os.close(fd)
+            except OSError:
+                logger.error("Can't determine permissions of: %s" % path)
+                counts['failed'] += 1
+                continue
+
+            if isdir:
+                try:
+                    fd = open_dir(entry.name, dirfd)
+                except OSError:
+                    logger.debug("Can't open directory: %s" % path)
+                    continue
+                descend(fd, path)
+
+def walk_tree(root, visit, jobs=None, since=None, start=None, checkpoint=None,
+        scanner=None):
+    """ Walks the directory tree below `root` using a pool of `jobs` worker
+    threads (defaults to `current_jobs()`). Each worker scans one directory
+    at a time and hands the subdirectories it finds back to the pool, so
+    large trees are spread across all workers regardless of their shape.
+    Queued directories stay open; once `max_pending_dirs()` of them are,
+    workers close the subdirectories they find and push their paths on a
+    stack of their own, to reopen (with `open_path`) and scan depth first
+    once done with the directory they found them in. That bounds the number
+    of open descriptors, however deep the tree. Entries are visited as
+    `scandir` reads them, so memory use doesn't grow with the number of
+    entries in a directory either.
+    If `since` is given, only directories changed since then are visited
+    (see `scan_dir`).
+
+    `start` lists directories (relative to `root`) to walk instead of all of
+    `root`. If `checkpoint` is given, it's called as
+    `checkpoint(pending, counts)` every CHECKPOINT_INTERVAL seconds and
+    when the walk stops early (an error or an interrupt). `pending` lists
+    the directories (relative to `root`) whose entries haven't all been
+    visited, so walking them as `start` finishes the walk; `counts` is what
+    the walk returns, so far.
+
+    Directories are scanned by `scan_dir`, or by `scanner` if given, which
+    takes the same arguments and must hand each subdirectory to `descend`.
+
+    Returns a Counter of the values returned by `visit`.
+    """
+    import queue
+    jobs = jobs or current_jobs()
+    scanner = scanner or scan_dir
+    limit = max_pending_dirs()
+    work = queue.Queue()
+    errors = []
+    tallies = []
+    output = current_output()
+    stats = current_stats()
+    # directories queued, stacked or being scanned: a directory is done with
+    # once its entries have all been visited and its subdirectories queued
+    pending = set()
+    # descriptors of the directories in `work`
+    queued = [0]
+    lock = threading.Lock()
+
+    def worker():
+        use_output(output)
+        use_stats(stats)
+        # the statuses `apply_acl` returns are there from the start, so that
+        # `snapshot` can copy the counts while they're being updated
+        counts = collections.Counter(written=0, skipped=0, failed=0, rejected=0)
+        with lock:
+            tallies.append(counts)
+        # paths of the subdirectories found past the descriptor budget
+        stack = []
+
+        def scan(fd, top):
+            begin = time.perf_counter()
+            try:
+                scanner(fd, top, visit, counts, descend, since)
+            finally:
+                os.close(fd)
+                if stats is not None:
+                    stats.directory(top, time.perf_counter() - begin)
+            with lock:
+                pending.discard(top)
+
+        def descend(fd, path):
+            with lock:
+                pending.add(path)
+                share = queued[0] < limit
+                if share:
+                    queued[0] += 1
+            if share:
+                work.put((fd, path))
+            else:
+                os.close(fd)
+                stack.append(path)
+
+        def unstack():
+            while stack:
+                path = stack.pop()
+                try:
+                    fd = open_path(root, os.path.relpath(path, root))
+                except OSError:
+                    logger.debug("Can't open directory: %s" % path)
+                    with lock:
+                        pending.discard(path)
+                    continue
+                scan(fd, path)
+
+        while True:
+            item = work.get()
+            if item is None:
+                work.task_done()
+                return
+            with lock:
+                queued[0] -= 1
+            try:
+                scan(*item)
+                unstack()
+            except Exception as e:
+                logger.debug("Unexpected error in %s: %s" % (item[1], e))
+                errors.append(e)
+                # left in `pending`, for the checkpoint
+                del stack[:]
+            finally:
+                work.task_done()
+
+    def snapshot():
+        with lock:
+            dirs = sorted(os.path.relpath(path, root) for path in pending)
+            counts = sum((collections.Counter(dict(tally)) for tally in tallies),
+                    collections.Counter())
+        return dirs, counts
+
+    if start is None:
+        pending.add(root)
+        queued[0] += 1
+        work.put((open_dir(root), root))
+    else:
+        for relpath in outermost(start):
+            path = os.path.normpath(os.path.join(root, relpath))
+            try:
+                fd = open_path(root, relpath)
+            except OSError:
+                logger.debug("Can't open directory: %s" % path)
+                continue
+            pending.add(path)
+            queued[0] += 1
+            work.put((fd, path))
+
+    threads = [threading.Thread(target=worker) for _ in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    done = threading.Event()
+    waiter = threading.Thread(target=lambda: (work.join(), done.set()))
+    waiter.daemon = True
+    waiter.start()
+    try:
+        while not done.wait(CHECKPOINT_INTERVAL if checkpoint else None):
+            checkpoint(*snapshot())
+    except BaseException:
+        if checkpoint is not None:
+            checkpoint(*snapshot())
+        raise
+    for thread in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+    if errors:
+        if checkpoint is not None:
+            checkpoint(*snapshot())
+        raise errors[0]
+    return sum(tallies, collections.Counter())
+
+def max_pending_dirs():
+    """ Returns how many directories `walk_tree` may queue: MAX_PENDING_DIRS,
+    but no more than a quarter of the descriptors this process may open, as
+    the directories being scanned and the ACL backend need some too."""
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return MAX_PENDING_DIRS
+    return max(1, min(MAX_PENDING_DIRS, soft // 4))
+
+def outermost(relpaths):
+    """ Returns the paths in `relpaths` that aren't below another one."""
+    relpaths = set(os.path.normpath(relpath) for relpath in relpaths)
+    if '.' in relpaths:
+        return ['.']
+    kept = []
+    for relpath in sorted(relpaths):
+        parts = relpath.split(os.sep)
+        if not any(os.sep.join(parts[:i]) in relpaths for i in range(1, len(parts))):
+            kept.append(relpath)
+    return kept
+
+def open_path(root, relpath):
+    """ Opens directory `relpath` below `root` one component at a time,
+    refusing to follow a symbolic link anywhere along the way (unlike the
+    tree walked by `scan_dir`, the path may have changed since it was seen)."""
+    fd = open_dir(root)
+    try:
+        for name in relpath.split(os.sep):
+            if name in ('', '.'):
+                continue
+            if name == '..':
+                raise OSError(errno.EINVAL, "Not below %s" % root, relpath)
+            child = open_dir(name, fd)
+            os.close(fd)
+            fd = child
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+class RateLimiter(object):
+    """ Spaces out operations, possibly from several threads, to at most
+    `rate` per second. Callers sleep once they are more than a millisecond
+    ahead, rather than before every operation."""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            when = max(self.next, now)
+            self.next = when + self.interval
+        if when - now > 0.001:
+            time.sleep(when - now)
+
+def lower_priority():
+    """ Gives the calling thread (and the threads it starts) the lowest CPU
+    priority and the idle I/O scheduling class, like `nice -n 19 ionice -c 3`.
+    The I/O class only matters to local disks whose scheduler supports it."""
+    import ctypes
+    os.nice(19)
+    # ioprio_set(IOPRIO_WHO_PROCESS, 0 (this thread), IOPRIO_CLASS_IDLE << 13)
+    numbers = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+            'riscv64': 30, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+    number = numbers.get(os.uname().machine)
+    if number is None:
+        logger.warning("Can't lower the I/O priority on %s" % os.uname().machine)
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, 1, 0, 3 << 13) != 0:
+        logger.warning("Can't lower the I/O priority: %s" % os.strerror(ctypes.get_errno()))
+
+def watch_projects(args):
+    """ Applies ACLs to the entries created in or moved into the given
+    projects (or every project) as they appear, until interrupted."""
+    require_root(args)
+    projects = args.project or list(all_projects())
+    for projname in projects:
+        check_project_exists(projname)
+    watcher = Watcher(projects, every=not args.project)
+    logger.info("Watching %d directories of %d projects" % (len(watcher.paths) - 1,
+            len(projects)))
+    try:
+        while True:
+            watcher.poll()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+class Watcher(object):
+    """ Watches project directories with Linux inotify (through ctypes) and
+    applies the ACL `set_access` would give each entry created, moved in or
+    whose mode changes, recursively for new directories. Configs are
+    reloaded when they are saved. When the kernel's event queue overflows,
+    only the entries of the watched directories changed since the last
+    catch-up are rescanned, WATCH_CATCH_UP_DIRS per poll (see `catch_up`),
+    rather than whole trees.
+
+    Renames within a project are followed; a directory moved out of the
+    watched projects is no longer watched. With `every`, projects created
+    meanwhile are watched too.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    IN_EXCL_UNLINK = 0x4000000
+    IN_ISDIR = 0x40000000
+    DIR_MASK = IN_ATTRIB | IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO | \
+            IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+    ROOT_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+            IN_ONLYDIR | IN_DONT_FOLLOW
+
+    def __init__(self, projects, every=False):
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise self.error("inotify_init1")
+        self.every = every
+        self.paths = {}     # watch descriptor -> directory
+        self.acls = {}      # project name -> (ro, rw, rx, rwx)
+        self.lock = threading.Lock()
+        self.full = False
+        self.reload = False
+        # directories changed since then are rescanned after an overflow,
+        # from `backlog`
+        self.synced = filesystem_time(watch_clock_path())
+        self.backlog = collections.deque()
+        self.add_watch(PROJECT_ROOT, self.ROOT_MASK)
+        for projname in projects:
+            self.add_project(projname, apply=False)
+
+    def error(self, call):
+        import ctypes
+        err = ctypes.get_errno()
+        return OSError(err, "%s: %s" % (call, os.strerror(err)))
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask=DIR_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = self.error("inotify_add_watch")
+            if err.errno == errno.ENOSPC and not self.full:
+                logger.error("Out of inotify watches, raise fs.inotify.max_user_watches")
+                self.full = True
+            elif err.errno != errno.ENOSPC:
+                logger.debug("Can't watch %s: %s" % (path, err))
+            return
+        with self.lock:
+            self.paths[wd] = path
+
+    def add_project(self, projname, apply=True, since=None):
+        """ Loads the ACLs of a project and watches its tree; with `apply`,
+        also applies them to its entries (of directories changed `since`)."""
         try:
-            acl = posix1e.ACL(text=text)
-        except:
-            fail("Failed to create ACL. Check project config file for non-existent users")
-        acl.calc_mask()
+            conf = load_conf(projname)
+            self.acls[projname] = generate_acls(conf.owner, conf.members,
+                    conf.collaborators, conf.public)
+        except ProjectError as e:
+            logger.error("Not watching %s: %s" % (projname, e))
+            return
+        self.watch_tree(project_dir_path(projname), apply, since)
 
-        if not acl.valid():
-            logger.debug("Bad ACL: %s" % text)
-            fail("Error generating ACL. Please notify system administrator.")
-        gen.append(acl)
+    def watch_tree(self, top, apply=True, since=None):
+        """ Watches directory `top` and every directory below it, applying
+        ACLs to their entries if `apply` is True (see `walk_tree`)."""
+        def visit(path, st, fd):
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                self.add_watch(path)
+            return self.apply(path, st, fd) if apply else 'skipped'
+        self.add_watch(top)
+        if apply:
+            self.apply(top)
+        walk_tree(top, visit, since=since)
 
-    ro, rw, rx, rwx = gen[0], gen[1], gen[2], gen[3]
+    def project(self, path):
+        """ Returns the name of the project `path` is in."""
+        return os.path.relpath(path, PROJECT_ROOT).split(os.sep)[0]
 
-    apply_acl(root, ro, rw, rx, rwx)
+    def apply(self, path, st=None, fd=None):
+        acls = self.acls.get(self.project(path))
+        if acls is None:
+            return 'skipped'
+        return apply_acl(path, *acls, st=st, fd=fd)
 
-    for top, dirs, files in os.walk(root):
-        for name in dirs + files:
-            path = os.path.join(top, name)
-            realpath = os.path.realpath(os.path.expanduser(path))
+    def poll(self, timeout=None):
+        """ Waits up to `timeout` seconds (forever if None) for events and
+        handles them, then carries on with the catch-up if there's one.
+        Returns the number of events handled and directories rescanned."""
+        import select
+        import struct
+        if self.backlog:
+            timeout = 0
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return self.rescan()
+        buf = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = struct.unpack_from('iIII', buf, offset)
+            name = os.fsdecode(buf[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            events.append((wd, mask, cookie, name))
+
+        # a rename within the watched tree is a MOVED_FROM/MOVED_TO pair
+        moved = dict((cookie, (wd, name)) for wd, mask, cookie, name in events
+                if mask & self.IN_MOVED_FROM and mask & self.IN_ISDIR)
+        for wd, mask, cookie, name in events:
+            if mask & self.IN_Q_OVERFLOW:
+                self.catch_up()
+                continue
+            if mask & self.IN_IGNORED:
+                with self.lock:
+                    self.paths.pop(wd, None)
+                continue
+            top = self.paths.get(wd)
+            if top is None or mask & self.IN_MOVED_FROM:
+                continue
+            path = os.path.join(top, name) if name else top
+            if top == PROJECT_ROOT:
+                self.root_event(mask, cookie, name, moved)
+            elif mask & self.IN_MOVED_TO and cookie in moved:
+                source, oldname = moved.pop(cookie)
+                old = os.path.join(self.paths.get(source, ''), oldname)
+                self.moved(old, path)
+                if self.project(old) != self.project(path):
+                    self.watch_tree(path)
+            else:
+                self.created(path, mask)
+        # directories moved out of the watched tree
+        for wd, name in moved.values():
+            self.forget(os.path.join(self.paths.get(wd, ''), name))
+        # the 'sqlite' config store changed: reload all configs, once
+        if self.reload:
+            self.reload = False
+            for projname in set(self.acls) | (set(scan_root()) if self.every else set()):
+                self.load(projname)
+        return len(events) + self.rescan()
+
+    def created(self, path, mask):
+        """ Applies the ACL of a new (or changed) entry."""
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return      # gone already
+        if stat.S_ISLNK(st.st_mode):
+            realpath = os.path.realpath(path)
             if is_subdir(PROJECT_ROOT, realpath):
-                apply_acl(path, ro, rw, rx, rwx)
+                self.apply(path)
             else:
-                logger.warning(
-                        "%s is actually %s, which is not in $PROJECT_ROOT" %
+                logger.warning("%s is actually %s, which is not in $PROJECT_ROOT" %
                         (path, realpath))
+        elif stat.S_ISDIR(st.st_mode) and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+            # entries may have been created before the watch was added
+            self.watch_tree(path)
+        else:
+            self.apply(path)
 
-def stats(path):
-    mode = os.stat(path).st_mode
+    def root_event(self, mask, cookie, name, moved):
+        """ Handles an event in PROJECT_ROOT: a config saved, or a project
+        renamed or moved away."""
+        if mask & self.IN_ISDIR:
+            if mask & self.IN_MOVED_TO and cookie in moved:
+                old = moved.pop(cookie)[1]
+                if old in self.acls:
+                    self.acls[name] = self.acls.pop(old)
+                self.moved(project_dir_path(old), project_dir_path(name))
+            return
+        store = config_store()
+        if isinstance(store, SqliteStore):
+            if name.startswith(os.path.basename(store.db)) and mask & self.IN_MODIFY:
+                self.reload = True
+            return
+        if not (name.startswith('.') and name.endswith('.yml')) or mask & self.IN_MODIFY:
+            return
+        self.load(name[1:-len('.yml')])
+
+    def load(self, projname):
+        """ Reloads the config of a project, or starts watching it."""
+        if projname in self.acls:
+            try:
+                conf = load_conf(projname)
+                acls = generate_acls(conf.owner, conf.members,
+                        conf.collaborators, conf.public)
+                if acls != self.acls[projname]:
+                    logger.info("Reloaded the config of %s" % projname)
+                self.acls[projname] = acls
+            except ProjectError as e:
+                logger.error("Keeping the previous ACLs of %s: %s" % (projname, e))
+        elif self.every and os.path.isdir(project_dir_path(projname)) and \
+                config_store().exists(projname):
+            logger.info("Watching new project %s" % projname)
+            self.add_project(projname)
+
+    def moved(self, old, path):
+        """ Follows directory `old` renamed to `path`."""
+        with self.lock:
+            for watched, top in list(self.paths.items()):
+                if top == old or top.startswith(old + os.sep):
+                    self.paths[watched] = path + top[len(old):]
+
+    def forget(self, old):
+        """ Stops watching directory `old`, and the directories below it."""
+        if os.path.dirname(old) == PROJECT_ROOT:
+            self.acls.pop(os.path.basename(old), None)
+        with self.lock:
+            gone = [wd for wd, top in self.paths.items()
+                    if top == old or top.startswith(old + os.sep)]
+        for wd in gone:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def catch_up(self):
+        """ Queues the watched directories changed since the last catch-up
+        for `rescan`, as events were lost. Finding them takes a stat of
+        each watched directory, but no directory is read; configs are
+        reloaded, in case they were saved meanwhile."""
+        logger.warning("Too many changes at once, rescanning changed directories")
+        since, self.synced = self.synced, filesystem_time(watch_clock_path())
+        with self.lock:
+            watched = set(self.paths.values())
+        watched.discard(PROJECT_ROOT)
+        queued = set(self.backlog)
+        for top in sorted(watched - queued):
+            try:
+                if os.lstat(top).st_ctime_ns >= since:
+                    self.backlog.append(top)
+            except OSError:
+                pass    # gone, its watch is too
+        self.reload = True
+
+    def rescan(self):
+        """ Applies ACLs to the entries of up to WATCH_CATCH_UP_DIRS queued
+        directories (see `catch_up`), watching the subdirectories that
+        aren't yet, with everything below them. Returns the number of
+        directories rescanned."""
+        if not self.backlog:
+            return 0
+        with self.lock:
+            watched = set(self.paths.values())
+        count = 0
+        while self.backlog and count < WATCH_CATCH_UP_DIRS:
+            top = self.backlog.popleft()
+            count += 1
+            pdir = project_dir_path(self.project(top))
+            try:
+                fd = open_path(pdir, os.path.relpath(top, pdir))
+                try:
+                    names = os.listdir(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(top, name)
+                if path in watched:
+                    self.apply(path)
+                else:
+                    self.created(path, self.IN_CREATE)
+        if self.backlog:
+            logger.info("%d directories left to rescan" % len(self.backlog))
+        else:
+            logger.info("Caught up")
+        return count
+
+def mode_stats(mode):
     isdir = stat.S_ISDIR(mode)
     readable = mode & (stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH) != 0
     writable = mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH) != 0
     executable = mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH) != 0
     return isdir, readable, writable, executable
 
-def apply_acl(path, ro, rw, rx, rwx):
-    logger.debug("Applying ACL to %s" % path)
-    try:
-        isdir, readable, writable, executable = stats(path)
-    except OSError:
-        logger.error("Can't determine permissions of: %s" % path)
-        return
+def acl_backend():
+    """ Returns the ACL backend named by ACL_BACKEND, creating it on first use."""
+    backend = _backends.get(ACL_BACKEND)
+    if backend is None:
+        classes = {'xattr': XattrBackend, 'posix1e': Posix1eBackend,
+                'memory': MemoryBackend}
+        if ACL_BACKEND not in classes:
+            fail("Unknown ACL backend: %s" % ACL_BACKEND)
+        backend = _backends.setdefault(ACL_BACKEND, classes[ACL_BACKEND]())
+    return backend
+
+class AclBackend(abc.ABC):
+    """ Reads and writes the ACLs of files for `apply_acl` and `check`.
+    ACLs are compared as entries (see TargetACL), regardless of their order
+    and of how the backend stores them."""
+
+    def prepare(self, entries):
+        """ Returns what `write` needs to set ACL `entries`, computed once
+        per TargetACL rather than once per file."""
+        return entries
+
+    @abc.abstractmethod
+    def read(self, path, default=False, st=None):
+        """ Returns the entries of the access (or default) ACL of `path`.
+        Raises IOError or OSError if they can't be read."""
+
+    @abc.abstractmethod
+    def write(self, path, acl, default=False):
+        """ Sets the access (or default) ACL of `path` to TargetACL `acl`."""
+
+    def matches(self, path, acl, default=False, st=None):
+        """ Returns True if `path` already has TargetACL `acl` (False if its
+        ACL can't be read). `st` is the result of stat'ing `path`, if any."""
+        try:
+            return self.read(path, default, st) == acl.entries
+        except (IOError, OSError, ValueError):
+            return False
 
-    acl = None
+class Posix1eBackend(AclBackend):
+    """ ACLs through pylibacl."""
+
+    def __init__(self):
+        import posix1e
+        self.posix1e = posix1e
+
+    def prepare(self, entries):
+        # built entry by entry rather than parsed from text, which would
+        # have libacl look the numeric qualifiers up as user names first
+        acl = self.posix1e.ACL()
+        for tag, qualifier, perms in entries:
+            entry = acl.append()
+            entry.tag_type = tag
+            if qualifier is not None:
+                entry.qualifier = qualifier
+            entry.permset.read = perms[0] == 'r'
+            entry.permset.write = perms[1] == 'w'
+            entry.permset.execute = perms[2] == 'x'
+        return acl
+
+    def read(self, path, default=False, st=None):
+        if default:
+            acl = self.posix1e.ACL(filedef=path)
+        else:
+            acl = self.posix1e.ACL(file=path)
+        entries = set()
+        for entry in acl:
+            qualifier = None
+            if entry.tag_type in (ACL_USER, ACL_GROUP):
+                qualifier = entry.qualifier
+            perms = entry.permset
+            entries.add((entry.tag_type, qualifier, '%s%s%s' % (
+                    'r' if perms.read else '-',
+                    'w' if perms.write else '-',
+                    'x' if perms.execute else '-')))
+        return frozenset(entries)
+
+    def write(self, path, acl, default=False):
+        if default:
+            try:
+                self.posix1e.delete_default(path)
+            except (IOError, OSError):
+                logger.warning("Can't reset ACL on directory: %s" % path)
+            acl.acl.applyto(path, self.posix1e.ACL_TYPE_DEFAULT)
+        else:
+            acl.acl.applyto(path)
+
+class XattrBackend(AclBackend):
+    """ ACLs read and written directly as the extended attributes that hold
+    them on Linux (the same ones libacl reads and writes). Each TargetACL is
+    encoded once; applying it is then a single setxattr per ACL, and
+    checking one compares the attribute with it byte for byte.
+
+    The format (linux/posix_acl_xattr.h) is a little-endian 32-bit version
+    (2) followed by (16-bit tag, 16-bit permissions, 32-bit id) entries
+    sorted by tag and id, the id being 0xFFFFFFFF for unnamed entries."""
+    names = ('system.posix_acl_access', 'system.posix_acl_default')
+    version = 2
+    undefined_id = 0xFFFFFFFF
+
+    def __init__(self):
+        import struct
+        self.header = struct.Struct('<I')
+        self.entry = struct.Struct('<HHI')
+
+    def prepare(self, entries):
+        entries = sorted((tag, self.undefined_id if qualifier is None else qualifier,
+                perms_bits(perms)) for tag, qualifier, perms in entries)
+        return self.header.pack(self.version) + b''.join(
+                self.entry.pack(tag, bits, qualifier) for tag, qualifier, bits in entries)
+
+    def decode(self, blob):
+        """ Returns the entries of an ACL extended attribute."""
+        if len(blob) < self.header.size or self.header.unpack_from(blob)[0] != self.version:
+            raise ValueError("Unsupported ACL format")
+        entries = set()
+        for tag, bits, qualifier in self.entry.iter_unpack(blob[self.header.size:]):
+            if tag not in (ACL_USER, ACL_GROUP):
+                qualifier = None
+            entries.add((tag, qualifier, perms_text(bits)))
+        return frozenset(entries)
+
+    def get(self, path, default):
+        """ Returns the ACL extended attribute of `path`, or None if it has
+        none (a file without an extended ACL, or a filesystem without ACLs)."""
+        try:
+            return os.getxattr(path, self.names[default])
+        except OSError as e:
+            if e.errno in (errno.ENODATA, errno.ENOTSUP, errno.EOPNOTSUPP):
+                return None
+            raise
+
+    def read(self, path, default=False, st=None):
+        blob = self.get(path, default)
+        if blob is not None:
+            return self.decode(blob)
+        if default:
+            return frozenset()
+        if st is None:
+            st = os.stat(path)
+        return mode_entries(st.st_mode)
+
+    def matches(self, path, acl, default=False, st=None):
+        try:
+            blob = self.get(path, default)
+        except OSError:
+            return False
+        if blob is None:
+            return AclBackend.matches(self, path, acl, default, st)
+        return blob == acl.acl
+
+    def write(self, path, acl, default=False):
+        os.setxattr(path, self.names[default], acl.acl)
+
+class MemoryBackend(AclBackend):
+    """ ACLs kept in memory, in `acls` keyed by (path, default), for tests
+    and benchmarks. Files without an ACL have the one from their mode.
+    Paths from `fd_path` are keyed by the path their descriptor is open on."""
+
+    def __init__(self):
+        self.acls = {}
+
+    def key(self, path, default):
+        if path.startswith('/proc/self/fd/'):
+            path = os.readlink(path)
+        return (path, default)
+
+    def read(self, path, default=False, st=None):
+        entries = self.acls.get(self.key(path, default))
+        if entries is not None:
+            return entries
+        if default:
+            return frozenset()
+        if st is None:
+            st = os.stat(path)
+        return mode_entries(st.st_mode)
+
+    def write(self, path, acl, default=False):
+        os.stat(path)   # fail like the other backends if it's gone
+        self.acls[self.key(path, default)] = acl.entries
+
+def mode_entries(mode):
+    """ Returns the entries of the minimal ACL equivalent to `mode`."""
+    return frozenset([(ACL_USER_OBJ, None, perms_text(mode >> 6 & 7)),
+            (ACL_GROUP_OBJ, None, perms_text(mode >> 3 & 7)),
+            (ACL_OTHER, None, perms_text(mode & 7))])
+
+def perms_text(bits):
+    """ Returns permission bits (4 read, 2 write, 1 execute) as e.g. 'r-x'."""
+    return '%s%s%s' % ('r' if bits & 4 else '-', 'w' if bits & 2 else '-',
+            'x' if bits & 1 else '-')
+
+def perms_bits(text):
+    """ Returns permissions such as 'r-x' as bits (4 read, 2 write, 1 execute)."""
+    return (4 if text[0] == 'r' else 0) | (2 if text[1] == 'w' else 0) | \
+            (1 if text[2] == 'x' else 0)
+
+def choose_acl(isdir, writable, executable, ro, rw, rx, rwx):
+    """ Picks the ACL for an entry based on its type and mode bits."""
     if isdir:
-        acl = rwx
+        return rwx
     elif writable:
         if executable:
-            acl = rwx
+            return rwx
         else:
-            acl = rw
+            return rw
     elif executable:
-        acl = rx
+        return rx
     else:
-        acl = ro
+        return ro
 
-    if isdir:
+def verify_acl(path, ro, rw, rx, rwx, st=None, fd=None):
+    """ Returns None if `path` has exactly the ACL(s) `apply_acl` would give
+    it, otherwise the reason why not. `st` and `fd` are as for `apply_acl`."""
+    if fd is None:
         try:
-            posix1e.delete_default(path)
-        except:
-            logger.warning("Can't reset ACL on directory: %s" % path)
+            fd = open_entry(path)
+        except OSError:
+            return "can't determine permissions"
         try:
-            acl.applyto(path, posix1e.ACL_TYPE_DEFAULT)
-        except:
-            logger.warning("Can't update ACL on directory: %s" % path)
+            return verify_acl(path, ro, rw, rx, rwx, None, fd)
+        finally:
+            os.close(fd)
     try:
-        acl.applyto(path)
-    except:
-        logger.warning("Can't update ACL on file: %s" % path)
+        if st is None:
+            st = os.fstat(fd)
+        isdir, readable, writable, executable = mode_stats(st.st_mode)
+    except OSError:
+        return "can't determine permissions"
+    acl = choose_acl(isdir, writable, executable, ro, rw, rx, rwx)
+    backend = acl_backend()
+    target = fd_path(fd)
+    if not backend.matches(target, acl, st=st):
+        return "access ACL differs"
+    if isdir and not backend.matches(target, acl, default=True):
+        return "default ACL differs"
+    return None
+
+def apply_acl(path, ro, rw, rx, rwx, st=None, fd=None):
+    """ Applies the appropriate TargetACL to `path`, only writing ACLs that
+    differ from the ones already on disk. The ACLs are read and written
+    through `fd`, an O_PATH descriptor of `path` (see `scan_dir`), and `st`
+    is its fstat result, if the caller already has them. Otherwise `path`
+    is opened with `open_entry`, which won't follow a symbolic link out of
+    PROJECT_ROOT.
+    Returns 'written', 'skipped' (already up to date) or 'failed'.
+    """
+    if fd is None:
+        try:
+            fd = open_entry(path)
+        except OSError as e:
+            logger.error("Can't open %s: %s" % (path, e))
+            return 'failed'
+        try:
+            return apply_acl(path, ro, rw, rx, rwx, None, fd)
+        finally:
+            os.close(fd)
+
+    logger.debug("Applying ACL to %s" % path)
+    try:
+        if st is None:
+            st = os.fstat(fd)
+        isdir, readable, writable, executable = mode_stats(st.st_mode)
+    except OSError:
+        logger.error("Can't determine permissions of: %s" % path)
+        return 'failed'
+
+    acl = choose_acl(isdir, writable, executable, ro, rw, rx, rwx)
+    backend = acl_backend()
+    target = fd_path(fd)
+    stats = current_stats()
+    if stats is not None:
+        return apply_acl_timed(path, target, acl, isdir, st, backend, stats)
+
+    status = 'skipped'
+    if isdir and not backend.matches(target, acl, default=True):
+        status = 'written'
+        try:
+            backend.write(target, acl, default=True)
+        except (IOError, OSError):
+            logger.warning("Can't update ACL on directory: %s" % path)
+            status = 'failed'
+    if not backend.matches(target, acl, st=st):
+        if status == 'skipped':
+            status = 'written'
+        try:
+            backend.write(target, acl)
+        except (IOError, OSError):
+            logger.warning("Can't update ACL on file: %s" % path)
+            status = 'failed'
+    return status
+
+def apply_acl_timed(path, target, acl, isdir, st, backend, stats):
+    """ `apply_acl` recording the time spent reading and writing ACLs in
+    `stats`; kept apart so that updates without --stats don't pay for it."""
+    clock = time.perf_counter
+    status = 'skipped'
+    for default in ((True, False) if isdir else (False,)):
+        start = clock()
+        matches = backend.matches(target, acl, default=default, st=st)
+        written = clock()
+        stats.time('acl_read', written - start)
+        if matches:
+            continue
+        status = 'written' if status == 'skipped' else status
+        try:
+            backend.write(target, acl, default=default)
+        except (IOError, OSError):
+            logger.warning("Can't update ACL on %s: %s" % (
+                    'directory' if default else 'file', path))
+            status = 'failed'
+        stats.time('acl_write', clock() - written)
+    return status
 
 def mod_user(args):
     check_project_exists(args.project)
-    conf = load_conf(args.project)
+    conf = edit_conf(args.project, lambda conf: change_role(conf, args))
+    update_perms(conf)
 
+def change_role(conf, args):
+    """ Gives `args.username` the role `args.role` in project `conf`,
+    without updating permissions."""
     if args.executer != conf.owner and args.executer not in conf.members:
         fail("Only a project owner/member can add/modify users")
 
+    found = user_resolver().resolve(args.username)
     for username in args.username:
-        try:
-            # "Look up" user
-            pwd.getpwnam(username)
-        except KeyError:
+        if username not in found:
             fail("User %s is not a valid user" % username)
 
         if username == conf.owner:
@@ -597,20 +3648,21 @@ def mod_user(args):
             logger.info("Setting %s as collaborator" % username)
             conf.collaborators.append(username)
 
-    update_perms(conf)
-
 def del_user(args):
     check_project_exists(args.project)
-    conf = load_conf(args.project)
+    conf = edit_conf(args.project, lambda conf: remove_users(conf, args))
+    update_perms(conf)
 
+def remove_users(conf, args):
+    """ Removes `args.username` from project `conf`, without updating
+    permissions."""
     if args.executer != conf.owner and args.executer not in conf.members:
         fail("Only a project owner/member can delete users")
 
+    found = user_resolver().resolve(args.username)
     for username in args.username:
-        try:
-            # "Look up" user
-            pwd.getpwnam(username)
-        except KeyError:
+        # accounts deleted since they were added can still be removed
+        if username not in found and username not in conf.members + conf.collaborators:
             fail("User %s is not a valid user" % username)
 
         if username == conf.owner:
@@ -622,17 +3674,550 @@ def del_user(args):
             logger.info("Removing %s from members" % username)
             conf.collaborators.remove(username)
 
-    update_perms(conf)
+def purge_user(args):
+    """ Removes `args.username` from every project (see `rewrite_users`)."""
+    require_root(args)
+    rewrite_users(args.username, None)
+
+def replace_user(args):
+    """ Gives the role of `args.username` in every project to
+    `args.new_username` (see `rewrite_users`)."""
+    require_root(args)
+    if user_resolver().lookup(args.new_username) is None:
+        fail("User %s is not a valid user" % args.new_username)
+    if args.new_username == args.username:
+        fail("Can't replace a user by themselves")
+    rewrite_users(args.username, args.new_username)
+
+def require_root(args):
+    """ Fails unless the user running command `args` is root. That's decided
+    by the uid the user runs as (`args.uid`), never by looking the user's
+    name up: the user cache is below PROJECT_ROOT, which the user chooses."""
+    if args.uid != 0:
+        fail("Only root can run %s" % args.which)
+
+def rewrite_users(old, new):
+    """ Replaces user `old` by `new` (or removes it if `new` is None) in the
+    config of every project `old` is part of, then updates the permissions
+    of those projects together (see `update_projects`).
+
+    `old` is looked up in the project index only, so its account may
+    already be gone. A project whose config can't be changed (e.g. `old`
+    owns it and there's no `new`) is reported and left as it was.
+    """
+    projects = projects_for_user(old)
+    if not projects:
+        fail("%s is not part of any project" % old)
+    changed, failed = [], []
+    for projname in projects:
+        try:
+            edit_conf(projname, lambda conf: substitute_user(conf, old, new))
+        except (ProjectError, IOError, OSError) as e:
+            logger.error("Failed to change %s: %s" % (projname, e))
+            failed.append(projname)
+        else:
+            changed.append(projname)
+
+    if changed:
+        update_projects(changed)
+    if failed:
+        fail("%d of %d project configs could not be changed: %s" % (len(failed),
+                len(projects), ", ".join(failed)))
+
+def substitute_user(conf, old, new):
+    """ Gives the role of `old` in project `conf` to `new` (who keeps their
+    own role if it's higher), or removes `old` if `new` is None, without
+    updating permissions."""
+    if old == conf.owner:
+        if new is None:
+            fail("%s owns the project. Set a new owner first, or use replace-user"
+                    % old)
+        logger.info("%s: setting %s as new owner" % (conf.project, new))
+        conf.owner = new
+    elif old in conf.members:
+        conf.members.remove(old)
+        if new is not None and new != conf.owner and new not in conf.members:
+            logger.info("%s: setting %s as member" % (conf.project, new))
+            conf.members.append(new)
+    elif old in conf.collaborators:
+        conf.collaborators.remove(old)
+        if new is not None and new not in [conf.owner] + conf.members + \
+                conf.collaborators:
+            logger.info("%s: setting %s as collaborator" % (conf.project, new))
+            conf.collaborators.append(new)
+    else:
+        fail("%s is not part of the project" % old)
+    # `new` may have been a member or collaborator before
+    if new == conf.owner:
+        conf.members = [m for m in conf.members if m != new]
+    if new == conf.owner or new in conf.members:
+        conf.collaborators = [c for c in conf.collaborators if c != new]
+    logger.info("%s: removed %s" % (conf.project, old))
+
+def run_batch(args):
+    """ Runs the commands read from standard input, one per line, and reports
+    the result of each one. A line is either in command line syntax, a JSON
+    list of arguments or a JSON object such as
+        {"command": "adduser", "project": "demo", "role": "member", "username": ["jack"]}
+
+    Consecutive adduser/moduser/deluser/update commands on the same project
+    are applied to its config one after the other and followed by a single
+    permissions update, instead of one full tree walk per command.
+    """
+    parser, subparsers = build_parser()
+    results = []
+    group = []
+
+    def report(lineno, argv, error=None):
+        results.append(error is None)
+        if args.json:
+            print(json.dumps({"line": lineno, "command": argv,
+                    "status": "ok" if error is None else "error",
+                    "message": "" if error is None else str(error)}))
+        elif error is None:
+            print("%d: ok" % lineno)
+        else:
+            print("%d: error: %s" % (lineno, error))
+        sys.stdout.flush()
+
+    def flush():
+        if group:
+            run_membership_group(group, report)
+            del group[:]
+
+    for lineno, line in enumerate(sys.stdin, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            argv = batch_argv(line)
+            op = parse_operation(argv, subparsers)
+        except (ValueError, ProjectError) as e:
+            flush()
+            report(lineno, line, e)
+            continue
+        op.uid, op.executer = args.uid, args.executer
+
+        if groupable(op):
+            if group and group[0][2].project != op.project:
+                flush()
+            group.append((lineno, argv, op))
+            continue
+
+        flush()
+        try:
+            dispatch(op)
+        except (ProjectError, IOError, OSError) as e:
+            report(lineno, argv, e)
+        else:
+            report(lineno, argv)
+    flush()
+
+    if not all(results):
+        sys.exit(1)
+
+def batch_argv(line):
+    """ Converts a line of batch input to a list of command line arguments."""
+    import shlex
+    if not line.startswith(('[', '{')):
+        return shlex.split(line)
+    op = json.loads(line)
+    if isinstance(op, list):
+        return [str(arg) for arg in op]
+    if not isinstance(op, dict) or 'command' not in op:
+        raise ValueError("JSON command must be a list or have a 'command' key")
+
+    argv = [op.pop('command')]
+    for key in ('project', 'new_name', 'role', 'username'):
+        value = op.pop(key, None)
+        if isinstance(value, list):
+            argv.extend(value)
+        elif value is not None:
+            argv.append(value)
+    for key, value in sorted(op.items()):
+        if value is True:
+            argv.append('--' + key.replace('_', '-'))
+        elif value not in (False, None):
+            raise ValueError("Unsupported option: %s" % key)
+    return [str(arg) for arg in argv]
+
+def parse_operation(argv, subparsers):
+    """ Parses the arguments of one batch command. Raises ProjectError for
+    invalid commands instead of exiting."""
+    if not argv or argv[0] not in subparsers.choices or argv[0] in ('batch', 'help'):
+        raise ProjectError("Invalid command: %s" % ' '.join(argv))
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        op = subparsers.choices[argv[0]].parse_args(argv[1:])
+    except SystemExit:
+        raise ProjectError(sys.stderr.getvalue().strip().splitlines()[-1])
+    finally:
+        sys.stderr = stderr
+    op.which = argv[0]
+    if getattr(op, 'jobs', 1) < 1:
+        raise ProjectError("Number of jobs must be at least 1")
+    strip_project_dirs(op)
+    return op
+
+def groupable(op):
+    """ Returns whether batch command `op` can join the consecutive commands
+    on its project that `run_membership_group` applies: a user change, or
+    an update with no options but --incremental and --jobs. Updates of
+    several projects (--all, --user) and ones with options of their own,
+    such as --stats or --max-ops, run on their own."""
+    if not hasattr(op, 'change') or op.project is None:
+        return False
+    return op.change is not None or not (op.resume or op.wait or op.nice or
+            op.stats or op.stats_json or op.max_ops is not None)
+
+def run_membership_group(group, report):
+    """ Applies consecutive user changes to one project, then updates its
+    permissions once. A change that fails leaves the config as it was.
+    Results are reported in the order of the commands."""
+    import copy
+    project = group[0][2].project
+    errors = {}
+    # an incremental update only if every update command asked for one
+    incremental = None
+
+    def change(conf):
+        nonlocal incremental
+        for lineno, argv, op in group:
+            if op.change is None:
+                incremental = op.incremental and incremental is not False
+                continue
+            before = copy.deepcopy(conf.as_dict())
+            try:
+                op.change(conf, op)
+            except ProjectError as e:
+                conf.__init__(conf.project, **before)
+                errors[lineno] = e
+
+    try:
+        check_project_exists(project)
+        conf = edit_conf(project, change)
+    except (ProjectError, IOError, OSError) as e:
+        errors = dict((lineno, e) for lineno, argv, op in group)
+    else:
+        done = [lineno for lineno, argv, op in group if lineno not in errors]
+        if done:
+            logger.info("Updating permissions on %s for %d command(s)" %
+                    (project, len(done)))
+            # as many workers as any of the commands asked for
+            jobs = max([getattr(op, 'jobs', 0) for lineno, argv, op in group]) or None
+            try:
+                update_perms(conf, incremental=bool(incremental), jobs=jobs)
+            except (ProjectError, IOError, OSError) as e:
+                errors.update((lineno, e) for lineno in done)
+
+    for lineno, argv, op in group:
+        report(lineno, argv, errors.get(lineno))
+
+def run_daemon(args):
+    """ Serves project commands over a Unix socket until interrupted.
+
+    Callers are identified by the kernel (SO_PEERCRED) rather than trusted,
+    so the daemon can run as root while the socket is open to everyone.
+    Parsed configs and the project index stay cached between requests.
+    """
+    import signal
+    if os.geteuid() != 0:
+        logger.warning("Not running as root, commands run with your permissions")
+    server = make_server(args.socket)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    purger = threading.Thread(target=purge_expired_trash)
+    purger.daemon = True
+    purger.start()
+    logger.info("Listening on %s" % args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+def purge_expired_trash():
+    """ Removes expired trash every TRASH_PURGE_INTERVAL seconds, for the
+    daemon."""
+    limiter = RateLimiter(PURGE_MAX_OPS)
+    while True:
+        try:
+            purge_expired(limiter)
+        except (ProjectError, IOError, OSError) as e:
+            logger.error(e)
+        time.sleep(TRASH_PURGE_INTERVAL)
+
+def make_server(path):
+    """ Creates the daemon's server listening on Unix socket `path`, and routes
+    standard output/error and logging to whichever request is being served
+    by the current thread."""
+    import socket
+    import socketserver
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.remove(path)     # left behind by a daemon that died
+        else:
+            fail("A daemon is already listening on %s" % path)
+        finally:
+            probe.close()
+
+    if not isinstance(sys.stdout, RoutedStream):
+        sys.stdout = RoutedStream(sys.stdout, b'1')
+        sys.stderr = RoutedStream(sys.stderr, b'2')
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    for handler in logger.handlers:
+        handler.setStream(sys.stderr)
+        handler.addFilter(RequestLevelFilter(logger.getEffectiveLevel()))
+    logger.setLevel(logging.DEBUG)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            serve_connection(self.request)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    server = Server(path, Handler)
+    os.chmod(path, 0o666)
+    return server
+
+def serve_connection(sock):
+    """ Serves one command. The client sends its arguments, each terminated
+    by a NUL byte, and shuts down its side of the connection. The daemon
+    replies with frames of a channel byte ('1' for stdout, '2' for stderr,
+    'x' for the exit status), a 4 byte big-endian length and the payload."""
+    import socket
+    import struct
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    argv = [arg.decode('utf-8', 'surrogateescape')
+            for arg in data.split(b'\0')[:-1]]
+
+    output = DaemonOutput(sock)
+    use_output(output)
+    try:
+        status = serve_request(argv, uid)
+    except Exception:
+        logger.exception("Unexpected error serving %s" % argv)
+        status = 1
+    finally:
+        use_output(None)
+    output.send(b'x', str(status).encode('ascii'))
+
+def serve_request(argv, uid):
+    """ Runs command line `argv` on behalf of user `uid`, returning the exit
+    status. Output goes to the current thread's DaemonOutput."""
+    if argv[:1] == ['__complete']:
+        try:
+            return complete(argv[1:], pwd.getpwuid(uid).pw_name)
+        except KeyError:
+            logger.error("Unknown user: %d" % uid)
+            return 1
+
+    parser, subparsers = build_parser(requested_command(argv))
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return e.code
+
+    output = current_output()
+    if args.debug:
+        output.level = logging.DEBUG
+    elif args.verbose:
+        output.level = logging.INFO
+
+    if args.which in (None, 'help'):
+        return show_help(parser, subparsers, getattr(args, 'command', None))
+    if args.which in ('daemon', 'batch'):
+        logger.error("The %s command can't be run by the daemon" % args.which)
+        return 1
+    if os.path.realpath(args.project_root) != os.path.realpath(PROJECT_ROOT):
+        logger.error("The daemon only serves %s" % PROJECT_ROOT)
+        return 1
+
+    args.uid = uid
+    try:
+        args.executer = pwd.getpwuid(uid).pw_name
+    except KeyError:
+        logger.error("Unknown user: %d" % uid)
+        return 1
+    logger.debug("You are: %s" % args.executer)
+
+    try:
+        # unless the caller waits for the outcome (or a report), long
+        # commands return at once with status 0 and their failures are only
+        # logged by the daemon
+        if args.which in BACKGROUND_COMMANDS and not (getattr(args, 'wait', False)
+                or getattr(args, 'stats', False) or getattr(args, 'stats_json', False)):
+            if args.project:
+                check_project_exists(os.path.basename(args.project))
+            job = threading.Thread(target=run_background, args=(args,))
+            job.daemon = True
+            job.start()
+            print("Running %s of %s in the background (see the daemon's log for "
+                    "its outcome, or use --wait)" % (args.which, target_name(args)))
+        else:
+            dispatch(args)
+    except ProjectError as e:
+        logger.error(e)
+        return 1
+    return 0
+
+def run_background(args):
+    """ Runs a long command detached from the client that requested it;
+    its messages, including whether it failed, go to the daemon's log (its
+    standard error)."""
+    target = target_name(args)
+    logger.info("%s started %s of %s" % (args.executer, args.which, target))
+    try:
+        dispatch(args)
+    except ProjectError as e:
+        logger.error("%s of %s failed: %s" % (args.which, target, e))
+    else:
+        logger.info("%s of %s done" % (args.which, target))
+
+def target_name(args):
+    """ Describes the project(s) a background command applies to."""
+    if args.project:
+        return args.project
+    if getattr(args, 'user', None) is not None:
+        return "the projects of %s" % args.user
+    return "all projects"
+
+def call_daemon(argv, path=None):
+    """ Runs command line `argv` through the daemon listening on `path`.
+    Returns the exit status and the standard output and error, as text."""
+    import socket
+    import struct
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or SOCKET_PATH)
+        sock.sendall(b''.join(arg.encode('utf-8') + b'\0' for arg in argv))
+        sock.shutdown(socket.SHUT_WR)
+        reply = sock.makefile('rb')
+        streams = {b'1': b'', b'2': b''}
+        while True:
+            header = reply.read(5)
+            if len(header) < 5:
+                raise IOError("Connection to the daemon closed unexpectedly")
+            channel, length = header[:1], struct.unpack('>I', header[1:])[0]
+            payload = reply.read(length)
+            if channel == b'x':
+                return (int(payload), streams[b'1'].decode('utf-8'),
+                        streams[b'2'].decode('utf-8'))
+            streams[channel] += payload
+    finally:
+        sock.close()
+
+class DaemonOutput(object):
+    """ Sends the output of one request back to its client."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.level = logging.WARNING
+        self.lock = threading.Lock()
+
+    def send(self, channel, data):
+        import socket
+        import struct
+        with self.lock:
+            try:
+                self.sock.sendall(channel + struct.pack('>I', len(data)) + data)
+            except socket.error:
+                pass    # client went away, let the command finish anyway
+
+class RoutedStream(object):
+    """ A file-like object writing to the output of the request served by the
+    current thread, or to `default` outside of requests."""
+    def __init__(self, default, channel):
+        self.default = default
+        self.channel = channel
+
+    def write(self, text):
+        output = current_output()
+        if output is None:
+            return self.default.write(text)
+        output.send(self.channel, text.encode('utf-8', 'surrogateescape'))
+        return len(text)
+
+    def flush(self):
+        if current_output() is None:
+            self.default.flush()
+
+    def isatty(self):
+        return False
+
+class RequestLevelFilter(logging.Filter):
+    """ Applies the log level of the request served by the current thread,
+    or `default` outside of requests."""
+    def __init__(self, default):
+        logging.Filter.__init__(self)
+        self.default = default
+
+    def filter(self, record):
+        output = current_output()
+        level = self.default if output is None else output.level
+        return record.levelno >= level
+
+def current_output():
+    """ Returns the DaemonOutput of the request served by this thread, if any."""
+    return getattr(_request, 'output', None)
+
+def use_output(output):
+    """ Sends this thread's output to `output` (a DaemonOutput or None).
+    Threads working on behalf of a request must call this first."""
+    _request.output = output
+
+def current_jobs():
+    """ Returns the number of parallel workers of the command run by this
+    thread: its -j, or JOBS."""
+    return getattr(_request, 'jobs', None) or JOBS
+
+def use_jobs(jobs):
+    """ Makes this thread's commands use `jobs` workers (None for JOBS).
+    Kept per thread so that concurrent daemon requests don't share it."""
+    _request.jobs = jobs
+
+def current_stats():
+    """ Returns the Stats this thread records into, if any."""
+    return getattr(_request, 'stats', None)
+
+def use_stats(stats):
+    """ Makes this thread record into `stats` (a Stats or None), including
+    the warnings and errors it logs."""
+    if stats is not None and count_problems not in logger.filters:
+        logger.addFilter(count_problems)
+    _request.stats = stats
+
+def count_problems(record):
+    """ Logging filter counting warnings and errors in the current Stats."""
+    stats = current_stats()
+    if stats is not None and record.levelno >= logging.WARNING:
+        stats.count('errors' if record.levelno >= logging.ERROR else 'warnings')
+    return True
 
 def check_project_exists(project_name):
     d = project_dir_path(project_name)
-    c = project_conf_path(project_name)
     if not os.path.isdir(d):
         fail("Project directory '%s' does not exist. %s is not a project" %
                 (d, project_name))
-    if not os.path.isfile(c):
+    store = config_store()
+    if not store.exists(project_name):
         fail("Project config '%s' does not exist. %s is not a project" % (
-            c, project_name))
+            store.location(project_name), project_name))
 
 def project_dir_path(project_name):
     """ Constructs the path to a project's directory. """
@@ -645,6 +4230,61 @@ def project_conf_path(project_name):
     """
     return os.path.join(PROJECT_ROOT, ".%s.yml" % project_name)
 
+def project_lock_path(project_name):
+    """ Constructs the path to the lock file of a project's config. """
+    return os.path.join(PROJECT_ROOT, ".locks", "%s.lock" % project_name)
+
+def config_db_path():
+    """ Constructs the path to the database of the 'sqlite' config store. """
+    return os.path.join(PROJECT_ROOT, ".projects.db")
+
+def project_update_lock_path(project_name):
+    """ Constructs the path to the lock held while a project's permissions
+    are updated. """
+    return os.path.join(PROJECT_ROOT, ".locks", "%s.update" % project_name)
+
+def project_update_marker_path(project_name):
+    """ Constructs the path to the marker of a project awaiting an update. """
+    return os.path.join(PROJECT_ROOT, ".locks", "%s.dirty" % project_name)
+
+def index_path():
+    """ Constructs the path to the reverse index of PROJECT_ROOT. """
+    return os.path.join(PROJECT_ROOT, ".project-index.json")
+
+def trash_path():
+    """ Constructs the path to the trash of PROJECT_ROOT, where deleted
+    projects are kept for TRASH_RETENTION seconds. """
+    return os.path.join(PROJECT_ROOT, ".trash")
+
+def trash_purge_lock_path():
+    """ Constructs the path to the lock held while expired trash is removed. """
+    return os.path.join(PROJECT_ROOT, ".locks", "trash.purge")
+
+def watch_clock_path():
+    """ Constructs the path to the file `watch` reads the filesystem's time
+    from (see `filesystem_time`). """
+    return os.path.join(PROJECT_ROOT, ".locks", "watch.clock")
+
+def user_cache_path():
+    """ Constructs the path to the cache of users looked up (see `UserResolver`). """
+    return os.path.join(PROJECT_ROOT, ".cache", "users.json")
+
+def complete_cache_path():
+    """ Constructs the path to the shell completion cache of PROJECT_ROOT. """
+    return os.path.join(PROJECT_ROOT, ".cache", "complete.json")
+
+def project_manifest_path(project_name):
+    """ Constructs the path to the manifest of a project's last update. """
+    return os.path.join(PROJECT_ROOT, ".%s.manifest" % project_name)
+
+def project_checkpoint_path(project_name):
+    """ Constructs the path to the checkpoint of a project's unfinished update. """
+    return os.path.join(PROJECT_ROOT, ".%s.checkpoint" % project_name)
+
+def project_du_path(project_name):
+    """ Constructs the path to the directory sizes of a project (see `du_project`). """
+    return os.path.join(PROJECT_ROOT, ".%s.du" % project_name)
+
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,71 @@
+import io
 import os
+import sys
+import json
+import argparse
 import shutil
+import time
+import fcntl
+import logging
+import threading
 import tempfile
-from project_manager import is_subdir
+import contextlib
+import project_manager
+from project_manager import is_subdir, ProjectDB, all_projects, \
+        projects_for_user, project_conf_path, batch_argv, make_server, call_daemon, \
+        complete, complete_cache_path, set_access, check_project, XattrBackend, \
+        Stats, use_stats, update_perms, save_checkpoint, load_checkpoint, \
+        load_manifest, acl_backend, outermost, update_projects, WorkerBudget, \
+        ProjectError, rewrite_users, load_conf, trash_project, trash_entries, \
+        restore_project, purge_trash, Watcher, edit_conf, migrate_config, \
+        config_store, SqliteStore, load_index, refresh_perms, \
+        UserResolver, user_cache_path, generate_acls, du_project, human_size, \
+        sample_project, sample_tree, wilson_interval, check_projects, run_batch, \
+        ACL_USER_OBJ, ACL_USER, ACL_GROUP_OBJ, ACL_MASK, ACL_OTHER
 
 def touch(path):
     with open(path, 'a'):
         os.utime(path, None)
 
+@contextlib.contextmanager
+def scratch_root(backend=None):
+    """ Runs a test in a new, empty PROJECT_ROOT, using ACL backend `backend`
+    if given. Afterwards, even if the test failed, removes it and restores
+    the globals of project_manager (which tests set or patch), the contents
+    of its caches (so no backend, store or resolver outlives its test), the
+    standard streams and project_manager's logger (which `make_server`
+    reroutes)."""
+    saved = dict(vars(project_manager))
+    caches = [(cache, dict(cache)) for cache in (project_manager._conf_cache,
+            project_manager._index_cache, project_manager._backends,
+            project_manager._stores, project_manager._resolvers)]
+    streams = sys.stdin, sys.stdout, sys.stderr
+    logger = project_manager.logger
+    handlers = [(handler, getattr(handler, 'stream', None), list(handler.filters))
+            for handler in logger.handlers]
+    level = logger.level
+    tmp = tempfile.mkdtemp()
+    project_manager.PROJECT_ROOT = tmp
+    if backend is not None:
+        project_manager.ACL_BACKEND = backend
+    try:
+        yield tmp
+    finally:
+        for name, value in saved.items():
+            if getattr(project_manager, name) is not value:
+                setattr(project_manager, name, value)
+        for cache, contents in caches:
+            cache.clear()
+            cache.update(contents)
+        sys.stdin, sys.stdout, sys.stderr = streams
+        for handler, stream, filters in handlers:
+            if stream is not None:
+                handler.setStream(stream)
+            handler.filters[:] = filters
+        logger.handlers[:] = [handler for handler, stream, filters in handlers]
+        logger.setLevel(level)
+        shutil.rmtree(tmp)
+
 def test_is_subdir():
     # prep
     tmp = tempfile.mkdtemp()
@@ -40,3 +99,731 @@ def test_is_subdir():
 
     # cleanup
     shutil.rmtree(tmp)
+
+def test_projects_for_user():
+    # prep
+    with scratch_root() as tmp:
+        for name, members in [('alpha', ['bob']), ('beta', []), ('gamma', ['bob'])]:
+            os.mkdir(os.path.join(tmp, name))
+            ProjectDB(name, 'alice', members=members).save()
+        os.mkdir(os.path.join(tmp, 'noconf'))
+
+        # test
+        assert(list(all_projects()) == ['alpha', 'beta', 'gamma'])
+        assert(projects_for_user('alice') == ['alpha', 'beta', 'gamma'])
+        assert(projects_for_user('bob') == ['alpha', 'gamma'])
+        assert(projects_for_user('carol') == [])
+
+        # config edited behind the index's back
+        with open(project_conf_path('beta'), 'w') as fobj:
+            fobj.write("owner: carol\npublic: false\nmembers: [bob]\ncollaborators: []\n")
+        os.remove(project_conf_path('gamma'))
+        assert(projects_for_user('bob') == ['alpha', 'beta'])
+        assert(projects_for_user('carol') == ['beta'])
+
+
+def completions(*argv):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        assert(complete(list(argv), 'bob') == 0)
+    return out.getvalue().split()
+
+def test_complete():
+    # prep
+    with scratch_root() as tmp:
+        for name, members in [('alpha', ['bob']), ('beta', [])]:
+            os.mkdir(os.path.join(tmp, name))
+            ProjectDB(name, 'alice', members=members).save()
+
+        # test
+        assert(completions('projects') == ['alpha', 'beta'])
+        assert(os.path.exists(complete_cache_path()))
+        assert(completions('mine') == ['alpha'])
+        assert(completions('members', 'alpha') == ['alice', 'bob'])
+        assert(completions('members', 'gamma') == [])
+        assert(completions('roles') == ['owner', 'member', 'collaborator'])
+        assert('root' in completions('users'))
+
+        # saving a config refreshes the cache
+        os.mkdir(os.path.join(tmp, 'gamma'))
+        ProjectDB('gamma', 'bob').save()
+        assert(completions('projects') == ['alpha', 'beta', 'gamma'])
+        assert(completions('mine') == ['alpha', 'gamma'])
+
+
+def test_acl_backends():
+    # prep
+    with scratch_root('memory') as tmp:
+        os.makedirs(os.path.join(tmp, 'alpha', 'data'))
+        touch(os.path.join(tmp, 'alpha', 'data', 'notes'))
+        conf = ProjectDB('alpha', 'root')
+        conf.save()
+
+        # test
+        counts = set_access(os.path.join(tmp, 'alpha'), 'root', [], [], False)
+        assert(counts['written'] == 3 and not counts['failed'])
+        set_access(project_conf_path('alpha'), 'root', [], [], False)
+        assert(check_project('alpha', deep=True) == [])
+        counts = set_access(os.path.join(tmp, 'alpha'), 'root', [], [], False)
+        assert(counts['skipped'] == 3 and not counts['written'])
+        conf.public = True
+        conf.save()
+        assert(check_project('alpha')[0].reason == "world doesn't have access")
+
+        # the xattr encoding round trips, with entries sorted by tag and id
+        entries = frozenset([(ACL_USER_OBJ, None, 'rwx'), (ACL_USER, 1001, 'r-x'),
+                (ACL_USER, 0, 'rwx'), (ACL_GROUP_OBJ, None, 'r--'),
+                (ACL_MASK, None, 'rwx'), (ACL_OTHER, None, '---')])
+        backend = XattrBackend()
+        blob = backend.prepare(entries)
+        assert(len(blob) == 4 + 6 * 8 and blob[:4] == b'\x02\x00\x00\x00')
+        assert(blob[12:20] == b'\x02\x00\x07\x00\x00\x00\x00\x00')
+        assert(backend.decode(blob) == entries)
+
+
+def test_symlink_swap():
+    # prep
+    with scratch_root('memory') as tmp:
+        outside = tempfile.mkdtemp()
+        data = os.path.join(tmp, 'alpha', 'data')
+        os.makedirs(data)
+        touch(os.path.join(data, 'a'))
+        touch(os.path.join(data, 'b'))
+        secret = os.path.join(outside, 'shadow')
+        touch(secret)
+
+        # a member replaces the entries of data/ with symbolic links once it's
+        # been listed: the one being updated and the one yet to be
+        class Swapper(object):
+            calls = 0
+            def wait(self):
+                self.calls += 1
+                if self.calls == 3:
+                    for name in ('a', 'b'):
+                        os.unlink(os.path.join(data, name))
+                        os.symlink(secret, os.path.join(data, name))
+
+        # test
+        counts = set_access(os.path.join(tmp, 'alpha'), 'root', [], [], False,
+                limiter=Swapper(), jobs=1)
+        assert(counts['written'] == 3 and counts['failed'] == 1)
+        assert(not [key for key in acl_backend().acls if key[0] == secret])
+
+        # cleanup
+        shutil.rmtree(outside)
+
+
+def test_stats():
+    # prep
+    with scratch_root('memory') as tmp:
+        os.makedirs(os.path.join(tmp, 'alpha', 'data', 'raw'))
+        touch(os.path.join(tmp, 'alpha', 'data', 'notes'))
+        os.symlink('/etc', os.path.join(tmp, 'alpha', 'data', 'etc'))
+        stats = Stats(top=2)
+
+        # test
+        use_stats(stats)
+        try:
+            set_access(os.path.join(tmp, 'alpha'), 'root', [], [], False)
+        finally:
+            use_stats(None)
+        report = stats.report()
+        counts = report['counts']
+        assert(counts['dirs'] == 3 and counts['files'] == 1 and counts['symlinks'] == 1)
+        assert(counts['written'] == 4 and counts['rejected'] == 1)
+        assert(counts['warnings'] == 1 and counts['errors'] == 0)
+        assert(len(report['slowest']) == 2 and report['seconds']['walk'] > 0)
+
+
+def test_deep_tree():
+    # prep: 600 levels, deeper than Python lets a function recurse
+    with scratch_root() as tmp:
+        path = top = os.path.join(tmp, 'alpha')
+        for level in range(600):
+            os.makedirs(os.path.join(path, 'b'))
+            path = os.path.join(path, 'a')
+        os.mkdir(path)
+        fds = len(os.listdir('/proc/self/fd'))
+
+        # test: past the descriptor budget, workers carry on from their stack
+        project_manager.MAX_PENDING_DIRS = 1
+        counts = project_manager.walk_tree(top,
+                lambda path, st, fd: 'seen', jobs=1)
+        assert(counts['seen'] == 1200)
+        assert(len(os.listdir('/proc/self/fd')) == fds)
+
+
+def test_resume():
+    # prep
+    with scratch_root('memory') as tmp:
+        os.makedirs(os.path.join(tmp, 'alpha', 'data', 'raw'))
+        os.makedirs(os.path.join(tmp, 'alpha', 'other'))
+        touch(os.path.join(tmp, 'alpha', 'data', 'raw', 'notes'))
+        conf = ProjectDB('alpha', 'root')
+        conf.save()
+
+        # test
+        assert(outermost(['data/raw', 'other', 'data']) == ['data', 'other'])
+        assert(outermost(['data', '.']) == ['.'])
+        save_checkpoint('alpha', {'fingerprint': conf.fingerprint(), 'since': None,
+                'pending': ['data/raw', 'data'], 'counts': {'written': 10}})
+        update_perms(conf, resume=True)
+        acls = acl_backend().acls
+        assert((os.path.join(tmp, 'alpha', 'data', 'raw', 'notes'), False) in acls)
+        assert((os.path.join(tmp, 'alpha', 'other'), False) not in acls)
+        assert(load_checkpoint('alpha') is None)
+        assert(load_manifest('alpha')['entries'] == 13)
+        # the membership changed since this one, so it's a full update
+        save_checkpoint('alpha', {'fingerprint': 'stale', 'since': None,
+                'pending': ['data'], 'counts': {'written': 10}})
+        update_perms(conf, resume=True)
+        assert((os.path.join(tmp, 'alpha', 'other'), False) in acls)
+        assert(load_manifest('alpha')['entries'] == 5)
+
+
+def test_incremental():
+    # prep
+    with scratch_root('memory') as tmp:
+        top = os.path.join(tmp, 'alpha')
+        for name in ('one', 'two'):
+            os.makedirs(os.path.join(top, name, 'sub'))
+            touch(os.path.join(top, name, 'notes'))
+        conf = ProjectDB('alpha', 'root')
+        conf.save()
+        acls = acl_backend().acls
+
+        # a file is added to the directory scanned first while the ACL of the
+        # other one's subdirectory is yet to be written (which changes its
+        # ctime, unlike with the memory backend)
+        apply_acl = project_manager.apply_acl
+        subs = []
+        def slow_apply_acl(path, *args, **kwargs):
+            if os.path.basename(path) == 'sub':
+                subs.append(os.path.dirname(path))
+                if len(subs) == 2:
+                    touch(os.path.join(subs[0], 'late'))
+                    time.sleep(0.02)
+                    os.utime(path)
+            return apply_acl(path, *args, **kwargs)
+
+        # test
+        project_manager.apply_acl = slow_apply_acl
+        try:
+            update_perms(conf, jobs=1)
+        finally:
+            project_manager.apply_acl = apply_acl
+        late = os.path.join(subs[0], 'late')
+        time.sleep(0.02)
+        update_perms(conf, incremental=True)
+        assert((late, False) in acls)
+
+        # only the directories changed since are updated
+        time.sleep(0.02)
+        notes = os.path.join(subs[0], 'notes')
+        del acls[(notes, False)]
+        touch(os.path.join(subs[1], 'new'))
+        counts = update_perms(conf, incremental=True)
+        assert((os.path.join(subs[1], 'new'), False) in acls)
+        assert((notes, False) not in acls)
+        # (the top directory's ctime changes as it's chowned)
+        assert(counts['written'] == 1 and counts['skipped'] == 5)
+        # unless the membership changed
+        conf.public = True
+        conf.save()
+        counts = update_perms(conf, incremental=True)
+        assert((notes, False) in acls and counts['written'] == 9)
+
+
+def test_update_projects():
+    # prep
+    with scratch_root('memory') as tmp:
+        for name in ('alpha', 'beta', 'broken'):
+            os.makedirs(os.path.join(tmp, name, 'data'))
+            ProjectDB(name, 'root').save()
+        with open(project_conf_path('broken'), 'w') as fobj:
+            fobj.write('owner: [')
+        out = io.StringIO()
+
+        # test
+        budget = WorkerBudget(8)
+        assert(budget.acquire(3) == 2 and budget.acquire(1) == 6)
+        budget.release(8)
+        project_manager.JOBS = 2
+        try:
+            with contextlib.redirect_stdout(out):
+                update_projects(['alpha', 'beta', 'broken'])
+            assert(False)
+        except ProjectError as e:
+            assert(str(e) == "1 of 3 projects failed to update: broken")
+        assert(load_manifest('alpha')['entries'] == 2)
+        assert(load_manifest('beta')['entries'] == 2)
+        lines = out.getvalue().splitlines()
+        assert(lines[0].split()[:2] == ['project', 'status'] and len(lines) == 4)
+        assert(lines[3].split()[:2] == ['broken', 'FAILED'])
+
+
+def test_update_coalescing():
+    # prep
+    with scratch_root('memory') as tmp:
+        os.makedirs(os.path.join(tmp, 'alpha', 'data'))
+        ProjectDB('alpha', 'root').save()
+        started, release = threading.Event(), threading.Event()
+        runs = []
+
+        def slow_refresh(conf, incremental=False, **kwargs):
+            runs.append((list(conf.members), incremental))
+            started.set()
+            release.wait(10)
+            return refresh_perms(conf, incremental=incremental, **kwargs)
+
+        # test: requests made during an update are served by one more update
+        lock_update = project_manager.lock_update
+        waiting = threading.Event()
+        def lock_update_waiting(fd, wait):
+            if wait:
+                waiting.set()
+            return lock_update(fd, wait)
+        project_manager.refresh_perms = slow_refresh
+        project_manager.lock_update = lock_update_waiting
+        try:
+            results = []
+            first = threading.Thread(target=lambda: results.append(
+                    update_perms(load_conf('alpha'), incremental=True)))
+            first.start()
+            assert(started.wait(10))
+            # each deferred request says so at the default level
+            deferred = logging.Handler(logging.WARNING)
+            deferred.emit = lambda record: queued.append(record.getMessage())
+            queued = []
+            project_manager.logger.addHandler(deferred)
+            try:
+                for user in ('daemon', 'bin'):
+                    conf = edit_conf('alpha', lambda conf: conf.members.append(user))
+                    assert(update_perms(conf, incremental=True) is None)
+            finally:
+                project_manager.logger.removeHandler(deferred)
+            assert(len(queued) == 2 and 'queued' in queued[0])
+            update_perms(conf)
+            waiter = threading.Thread(target=lambda: results.append(
+                    update_perms(conf, incremental=True, wait=True)))
+            waiter.start()
+            assert(waiting.wait(10))
+            release.set()
+            first.join()
+            waiter.join()
+        finally:
+            project_manager.refresh_perms = refresh_perms
+            project_manager.lock_update = lock_update
+        assert(runs == [([], True), (['daemon', 'bin'], False)])
+        # either thread may run the follow-up
+        assert(len(results) == 2 and any(result and result['written'] for result in results))
+        assert(not os.path.exists(os.path.join(tmp, '.locks', 'alpha.dirty')))
+
+
+def test_user_resolver():
+    # prep
+    with scratch_root('memory') as tmp:
+        resolver = UserResolver(user_cache_path())
+        fetched = []
+        fetch = resolver.fetch
+        resolver.fetch = lambda name: fetched.append(name) or fetch(name)
+
+        # test: each user is looked up once, and the found ones are saved
+        assert(resolver.resolve(['root', 'daemon', 'nobody-here']) ==
+                {'root': (0, 0), 'daemon': fetch('daemon')})
+        assert(resolver.lookup('root') == (0, 0) and resolver.lookup('nobody-here') is None)
+        assert(sorted(fetched) == ['daemon', 'nobody-here', 'root'])
+        saved = UserResolver(user_cache_path())
+        saved.fetch = None
+        assert(saved.resolve(['root', 'daemon']) == resolver.resolve(['root', 'daemon']))
+        project_manager.USER_CACHE_TTL = 0
+        resolver.lookup('root')
+        assert(fetched.count('root') == 2)
+        # ACLs are made of the uids, however the users appear
+        ro, rw, rx, rwx = generate_acls('root', ['daemon'], [], False)
+        assert((ACL_USER, fetch('daemon')[0], 'rwx') in rwx.entries)
+        # root is recognised by uid, never by a cache a user could plant
+        project_manager.USER_CACHE_TTL = 600
+        os.makedirs(os.path.dirname(user_cache_path()), exist_ok=True)
+        with open(user_cache_path(), 'w') as fobj:
+            json.dump({'users': {'daemon': [0, 0, time.time()]}}, fobj)
+        project_manager._resolvers.clear()
+        assert(project_manager.user_resolver().lookup('daemon') == (0, 0))
+        args = argparse.Namespace(uid=fetch('daemon')[0], executer='daemon',
+                which='purge-user')
+        try:
+            project_manager.require_root(args)
+            assert(False)
+        except ProjectError as e:
+            assert(str(e) == "Only root can run purge-user")
+
+
+def test_du():
+    # prep
+    with scratch_root() as tmp:
+        for path in ('big/a/b', 'small', 'empty'):
+            os.makedirs(os.path.join(tmp, 'alpha', path))
+        for path, size in (('big/a/b/x', 100000), ('big/y', 50000), ('small/z', 10), ('top', 1)):
+            with open(os.path.join(tmp, 'alpha', path), 'w') as fobj:
+                fobj.write('x' * size)
+        ProjectDB('alpha', 'root').save()
+        # the directories aren't reused while their mtime is this recent
+        old = time.time() - 60
+        for dirpath, dirnames, filenames in os.walk(os.path.join(tmp, 'alpha')):
+            os.utime(dirpath, (old, old))
+
+        # test
+        usage = du_project('alpha', top=2)
+        assert(usage['inodes'] == 10 and usage['scanned'] == 6 and usage['cached'] == 0)
+        assert([sub['path'] for sub in usage['largest']] == ['big', 'small'])
+        assert(usage['largest'][0]['inodes'] == 5)
+        again = du_project('alpha', top=2)
+        assert(again['scanned'] == 0 and again['cached'] == 6)
+        assert(again['bytes'] == usage['bytes'] and again['largest'] == usage['largest'])
+        # only the changed directory is listed again
+        with open(os.path.join(tmp, 'alpha', 'small', 'w'), 'w') as fobj:
+            fobj.write('x')
+        changed = du_project('alpha', top=2)
+        assert(changed['scanned'] == 1 and changed['inodes'] == 11)
+        assert(human_size(512) == '512 B' and human_size(3 * 1024 ** 3) == '3.0 GiB')
+
+
+def test_sample():
+    # prep
+    with scratch_root('memory') as tmp:
+        deep = os.path.join(tmp, 'alpha', 'a', 'b', 'c')
+        os.makedirs(deep)
+        for i in range(50):
+            touch(os.path.join(tmp, 'alpha', 'f%d' % i))
+        touch(os.path.join(deep, 'notes'))
+        ProjectDB('alpha', 'root').save()
+        update_perms(load_conf('alpha'))
+
+        # test: every depth gets its share, and nothing is checked twice
+        seen = []
+        depths, drift = sample_tree(os.path.join(tmp, 'alpha'), 8,
+                lambda path, st: seen.append(path))
+        assert(drift is None and sorted(depths) == [1, 2, 3, 4])
+        assert(depths[4] == [1, 0] and len(seen) == len(set(seen)) == 8)
+        result = sample_project('alpha', (1000, None))
+        assert(result['sampled'] == 54 and result['drifting'] == 0 and not result['problems'])
+        assert(0.05 < result['upper'] < 0.07)
+        # the walk stops at the first entry that drifted
+        del acl_backend().acls[(os.path.join(deep, 'notes'), False)]
+        result = sample_project('alpha', (None, 100.0))
+        assert(result['drifting'] == 1 and result['depths'][4] == [1, 1])
+        assert(result['problems'][0].path == os.path.join(deep, 'notes'))
+        low, high = wilson_interval(0, 100)
+        assert(low == 0 and 0.036 < high < 0.038)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            check_projects(argparse.Namespace(all=True, uid=0, executer='root', deep=False,
+                    sample=(10, None), json=True))
+        result = json.loads(out.getvalue())
+        assert(result['project'] == 'alpha' and result['problems'][0]['reason'])
+
+
+def test_check_projects():
+    # prep
+    with scratch_root('memory') as tmp:
+        for name in ('alpha', 'beta', 'gamma'):
+            os.makedirs(os.path.join(tmp, name, 'data'))
+            ProjectDB(name, 'root').save()
+            update_perms(load_conf(name))
+        del acl_backend().acls[(os.path.join(tmp, 'beta', 'data'), False)]
+        walk_tree = project_manager.walk_tree
+        lock = threading.Lock()
+        running, most = [0], [0]
+        def counting_walk_tree(root, visit, **kwargs):
+            jobs = project_manager.current_jobs()
+            with lock:
+                running[0] += jobs
+                most[0] = max(most[0], running[0])
+            time.sleep(0.05)
+            try:
+                return walk_tree(root, visit, **kwargs)
+            finally:
+                with lock:
+                    running[0] -= jobs
+        project_manager.walk_tree = counting_walk_tree
+        project_manager.JOBS = 4
+        out = io.StringIO()
+
+        # test: the projects checked at once share the --jobs workers
+        with contextlib.redirect_stdout(out):
+            check_projects(argparse.Namespace(all=True, uid=0, executer='root', deep=True,
+                    sample=None, json=False))
+        assert(out.getvalue() == 'beta\n')
+        assert(most[0] <= 4)
+
+
+def test_rewrite_users():
+    # prep
+    with scratch_root('memory') as tmp:
+        for name in ('alpha', 'beta'):
+            os.makedirs(os.path.join(tmp, name))
+        # 'ghost' left and their account is gone
+        ProjectDB('alpha', 'root', members=['ghost', 'daemon']).save()
+        ProjectDB('beta', 'ghost', collaborators=['daemon']).save()
+        out = io.StringIO()
+
+        # test
+        try:
+            with contextlib.redirect_stdout(out):
+                rewrite_users('ghost', None)
+            assert(False)
+        except ProjectError as e:
+            assert(str(e) == "1 of 2 project configs could not be changed: beta")
+        assert(load_conf('alpha').members == ['daemon'])
+        assert(load_conf('beta').owner == 'ghost')
+        with contextlib.redirect_stdout(out):
+            rewrite_users('ghost', 'daemon')
+        conf = load_conf('beta')
+        assert(conf.owner == 'daemon' and conf.collaborators == [])
+        assert(load_manifest('beta') is not None)
+
+
+def test_trash():
+    # prep
+    with scratch_root() as tmp:
+        outside = tempfile.mkdtemp()
+        touch(os.path.join(outside, 'keep'))
+        os.makedirs(os.path.join(tmp, 'alpha', 'data', 'raw'))
+        touch(os.path.join(tmp, 'alpha', 'data', 'raw', 'scan'))
+        os.symlink(outside, os.path.join(tmp, 'alpha', 'data', 'outside'))
+        conf = ProjectDB('alpha', 'root')
+        conf.save()
+        out = io.StringIO()
+
+        # test
+        name = trash_project(conf, 'root')
+        assert(not os.path.exists(os.path.join(tmp, 'alpha')))
+        assert(list(all_projects()) == [])
+        entries = trash_entries()
+        assert([e['name'] for e in entries] == [name] and entries[0]['project'] == 'alpha')
+        with contextlib.redirect_stdout(out):
+            restore_project(entries[0])
+        assert(os.path.isfile(os.path.join(tmp, 'alpha', 'data', 'raw', 'scan')))
+        assert(list(all_projects()) == ['alpha'] and trash_entries() == [])
+        trash_project(conf, 'root')
+        purge_trash(trash_entries())
+        assert(trash_entries() == [] and os.listdir(os.path.join(tmp, '.trash')) == [])
+        assert(os.path.isfile(os.path.join(outside, 'keep')))
+        # a directory swapped for a symbolic link while its entries are being
+        # removed isn't followed
+        sub = os.path.join(tmp, 'gone', 'sub')
+        os.makedirs(sub)
+        for name in ('one', 'two'):
+            touch(os.path.join(sub, name))
+            touch(os.path.join(outside, name))
+        class Swapper(object):
+            def wait(self):
+                if not os.path.islink(sub):
+                    os.rename(sub, os.path.join(tmp, 'moved'))
+                    os.symlink(outside, sub)
+        try:
+            project_manager.remove_tree(os.path.join(tmp, 'gone'), jobs=1,
+                    limiter=Swapper())
+            assert(False)
+        except OSError:
+            pass
+        assert(sorted(os.listdir(outside)) == ['keep', 'one', 'two'])
+        assert(os.listdir(os.path.join(tmp, 'moved')) == [])
+
+        # expired trash is removed by one process at a time, in the background
+        # after a delete
+        os.makedirs(os.path.join(tmp, 'alpha', 'data'))
+        conf.save()
+        trash_project(conf, 'root')
+        project_manager.TRASH_RETENTION = 0
+        fd = project_manager.open_lock(project_manager.trash_purge_lock_path())
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            assert(not project_manager.purge_expired())
+            assert(len(trash_entries()) == 1)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            project_manager.purge_in_background()
+            for _ in range(100):
+                if not trash_entries():
+                    break
+                time.sleep(0.05)
+            assert(trash_entries() == [])
+        finally:
+            os.close(fd)
+
+        # cleanup
+        shutil.rmtree(outside)
+
+
+def test_watcher():
+    # prep
+    with scratch_root('memory') as tmp:
+        os.makedirs(os.path.join(tmp, 'alpha', 'data'))
+        ProjectDB('alpha', 'root').save()
+        watcher = Watcher(['alpha'])
+        acls = acl_backend().acls
+        data = os.path.join(tmp, 'alpha', 'data')
+
+        # test
+        touch(os.path.join(data, 'scan'))
+        os.makedirs(os.path.join(tmp, 'incoming', 'raw'))
+        touch(os.path.join(tmp, 'incoming', 'raw', 'notes'))
+        os.rename(os.path.join(tmp, 'incoming'), os.path.join(data, 'incoming'))
+        while watcher.poll(0.1):
+            pass
+        assert((os.path.join(data, 'scan'), False) in acls)
+        assert((os.path.join(data, 'incoming', 'raw', 'notes'), False) in acls)
+        # directories moved in are watched too
+        touch(os.path.join(data, 'incoming', 'raw', 'more'))
+        while watcher.poll(0.1):
+            pass
+        assert((os.path.join(data, 'incoming', 'raw', 'more'), False) in acls)
+        os.rename(data, os.path.join(tmp, 'alpha', 'renamed'))
+        touch(os.path.join(tmp, 'alpha', 'renamed', 'incoming', 'late'))
+        while watcher.poll(0.1):
+            pass
+        assert((os.path.join(tmp, 'alpha', 'renamed', 'incoming', 'late'), False) in acls)
+        # when events are lost, only the directories changed since the last
+        # catch-up are rescanned, a few per poll
+        renamed = os.path.join(tmp, 'alpha', 'renamed')
+        watcher.synced = project_manager.filesystem_time(
+                project_manager.watch_clock_path())
+        os.makedirs(os.path.join(renamed, 'lost', 'deep'))
+        touch(os.path.join(renamed, 'lost', 'deep', 'one'))
+        touch(os.path.join(renamed, 'incoming', 'two'))
+        os.set_blocking(watcher.fd, False)
+        try:
+            while os.read(watcher.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        os.set_blocking(watcher.fd, True)
+        project_manager.WATCH_CATCH_UP_DIRS = 1
+        watcher.catch_up()
+        assert(list(watcher.backlog) == [renamed, os.path.join(renamed, 'incoming')])
+        assert(watcher.poll(0.1) == 1 and len(watcher.backlog) == 1)
+        while watcher.poll(0.1):
+            pass
+        assert((os.path.join(renamed, 'lost', 'deep', 'one'), False) in acls)
+        assert((os.path.join(renamed, 'incoming', 'two'), False) in acls)
+
+        # cleanup
+        watcher.close()
+
+
+def test_config_store():
+    # prep
+    with scratch_root() as tmp:
+        for name in ('alpha', 'beta'):
+            os.makedirs(os.path.join(tmp, name))
+        ProjectDB('alpha', 'root').save()
+        ProjectDB('beta', 'daemon', members=['root']).save()
+        out = io.StringIO()
+
+        def edit(prefix):
+            for i in range(20):
+                edit_conf('alpha', lambda conf: conf.members.append('%s%d' % (prefix, i)))
+
+        # test: edits made at the same time are all kept, with either store
+        for prefix in ('yaml', 'sqlite'):
+            threads = [threading.Thread(target=edit, args=(prefix + t,)) for t in 'ab']
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert(len([m for m in load_conf('alpha').members if m.startswith(prefix)]) == 40)
+            if prefix == 'yaml':
+                args = argparse.Namespace(uid=0, executer='root', which='migrate-config')
+                with contextlib.redirect_stdout(out):
+                    migrate_config(args)
+                assert(isinstance(config_store(), SqliteStore))
+                assert(not os.path.exists(project_conf_path('alpha')))
+        assert(projects_for_user('root') == ['alpha', 'beta'])
+        index = load_index()
+        assert(index['users']['daemon'] == ['beta'])
+        assert(index['projects']['beta']['owner'] == 'daemon')
+        conf = load_conf('beta')
+        assert(conf.owner == 'daemon' and conf.members == ['root'] and not conf.public)
+
+
+def test_batch_argv():
+    assert(batch_argv("adduser demo member jack jill") ==
+            ['adduser', 'demo', 'member', 'jack', 'jill'])
+    assert(batch_argv("create 'my project' --public") ==
+            ['create', 'my project', '--public'])
+    assert(batch_argv('["update", "demo", "-i"]') == ['update', 'demo', '-i'])
+    assert(batch_argv('{"command": "moduser", "project": "demo", '
+            '"role": "owner", "username": ["jack"]}') ==
+            ['moduser', 'demo', 'owner', 'jack'])
+    assert(batch_argv('{"command": "update", "project": "demo", '
+            '"incremental": true, "jobs": false}') ==
+            ['update', 'demo', '--incremental'])
+
+def test_batch():
+    # prep
+    with scratch_root('memory') as tmp:
+        for name in ('alpha', 'beta'):
+            os.makedirs(os.path.join(tmp, name, 'data'))
+            ProjectDB(name, 'root').save()
+        lines = ["du %s beta" % os.path.join(tmp, 'alpha'), "update alpha -i",
+                "update alpha -j 3", "update", "update --all -j 3",
+                "update beta --max-ops 1000", "update beta -j 0"]
+        out = io.StringIO()
+        updates = []
+        def recording_update_perms(conf, **kwargs):
+            updates.append((conf.project, kwargs.get('jobs'), kwargs.get('limiter') is not None))
+            return update_perms(conf, **kwargs)
+
+        # test: commands without a project, or with several, aren't grouped,
+        # nor are updates with options of their own
+        sys.stdin = io.StringIO('\n'.join(lines) + '\n')
+        project_manager.update_perms = recording_update_perms
+        try:
+            with contextlib.redirect_stdout(out):
+                run_batch(argparse.Namespace(json=True, uid=0, executer='root'))
+            assert(False)
+        except SystemExit as e:
+            assert(e.code == 1)
+        results = [json.loads(line) for line in out.getvalue().splitlines()
+                if line.startswith('{')]
+        assert([r['status'] for r in results] == ['ok', 'ok', 'ok', 'error', 'ok', 'ok', 'error'])
+        assert(load_manifest('beta')['entries'] == 2)
+        assert(updates[0] == ('alpha', 3, False) and updates[-1] == ('beta', None, True))
+        # -j only applies to its own command
+        assert(project_manager.JOBS == 1 and project_manager.current_jobs() == 1)
+
+
+def test_daemon():
+    # prep
+    with scratch_root() as tmp:
+        os.mkdir(os.path.join(tmp, 'alpha'))
+        ProjectDB('alpha', 'alice', members=['bob']).save()
+        sock = os.path.join(tmp, '.sock')
+        server = make_server(sock)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        # test
+        status, out, err = call_daemon(['list', '--all'], sock)
+        assert(status == 0 and out == 'alpha\n')
+        status, out, err = call_daemon(['info', 'alpha'], sock)
+        assert(status == 0 and 'Owner: alice' in out and '\tbob' in out)
+        status, out, err = call_daemon(['__complete', 'members', 'alpha'], sock)
+        assert(status == 0 and out == 'alice\nbob\n')
+        status, out, err = call_daemon(['info', 'beta'], sock)
+        assert(status == 1 and 'beta is not a project' in err)
+        status, out, err = call_daemon(['-P', '/', 'list'], sock)
+        assert(status == 1 and 'only serves' in err)
+        status, out, err = call_daemon(['bogus'], sock)
+        assert(status == 2)
+        # updates run in the background, unless the caller waits for them
+        status, out, err = call_daemon(['update', '--all', '--user', 'alice'], sock)
+        assert(status == 0 and 'in the background' in out)
+        status, out, err = call_daemon(['update', '--all', '--user', 'alice', '--wait'], sock)
+        assert(status == 1 and 'Give one of' in err)
+
+        # cleanup
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
@@ -3,40 +3,190 @@
 #include <string.h>
 #include <errno.h>
 #include <unistd.h>
+#include <sys/socket.h>
+#include <sys/un.h>
 
-const char script[] = "/usr/local/lib/project_manager.py";
+/* project_manager.py is imported rather than run as a script, so that
+ * Python reuses its cached bytecode instead of compiling it on every run
+ * (which took most of the startup time of cheap commands and completion).
+ * -I keeps the caller's environment and working directory out of the
+ * module search path. */
+const char launcher[] = "import sys; sys.path.insert(0, '/usr/local/lib'); "
+                        "import project_manager; project_manager.main()";
+
+/* must match SOCKET_PATH in project_manager.py */
+const char socket_path[] = "/run/project.sock";
+
+static int write_all(int fd, const char *buf, size_t len)
+{
+    while (len > 0) {
+        ssize_t n = write(fd, buf, len);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        buf += n;
+        len -= n;
+    }
+    return 0;
+}
+
+static int read_all(int fd, char *buf, size_t len)
+{
+    while (len > 0) {
+        ssize_t n = read(fd, buf, len);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        if (n == 0)
+            return -1;  /* connection closed early */
+        buf += n;
+        len -= n;
+    }
+    return 0;
+}
+
+/* Commands the daemon can't serve: they need this process' stdin, or
+ * a project root other than the daemon's. */
+static int needs_local(int argc, char** argv)
+{
+    int i;
+    if (getenv("PROJECT_ROOT") != NULL)
+        return 1;
+    for (i = 1; i < argc; i++) {
+        if (strcmp(argv[i], "-P") == 0
+                || strncmp(argv[i], "--project-root", 14) == 0
+                || strcmp(argv[i], "batch") == 0
+                || strcmp(argv[i], "daemon") == 0)
+            return 1;
+    }
+    return 0;
+}
+
+/* Connects to the project daemon, as the real user so that the daemon
+ * (which identifies callers with SO_PEERCRED) sees who is calling.
+ * Returns the socket, or -1 if the daemon isn't running. */
+static int connect_daemon(void)
+{
+    struct sockaddr_un addr;
+    uid_t euid = geteuid();
+    int fd, ret;
+
+    fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (fd < 0)
+        return -1;
+
+    memset(&addr, 0, sizeof(addr));
+    addr.sun_family = AF_UNIX;
+    strncpy(addr.sun_path, socket_path, sizeof(addr.sun_path) - 1);
+
+    if (seteuid(getuid()) != 0) {
+        close(fd);
+        return -1;
+    }
+    ret = connect(fd, (struct sockaddr *)&addr, sizeof(addr));
+    if (seteuid(euid) != 0) {
+        fprintf(stderr, "Error: Failed to restore privileges\n");
+        exit(EXIT_FAILURE);
+    }
+    if (ret != 0) {
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+/* Sends the arguments to the daemon and copies its replies to stdout and
+ * stderr. Returns the exit status of the command. */
+static int run_remote(int fd, int argc, char** argv)
+{
+    int i;
+    for (i = 1; i < argc; i++) {
+        /* each argument is sent with its terminating NUL */
+        if (write_all(fd, argv[i], strlen(argv[i]) + 1) != 0) {
+            fprintf(stderr, "ERROR: Failed to send command: %s\n", strerror(errno));
+            return EXIT_FAILURE;
+        }
+    }
+    shutdown(fd, SHUT_WR);
+
+    for (;;) {
+        unsigned char header[5];
+        char buf[4096];
+        size_t len;
+
+        if (read_all(fd, (char *)header, sizeof(header)) != 0)
+            break;
+        len = ((size_t)header[1] << 24) | ((size_t)header[2] << 16)
+            | ((size_t)header[3] << 8) | (size_t)header[4];
+
+        if (header[0] == 'x') {
+            if (len >= sizeof(buf) || read_all(fd, buf, len) != 0)
+                break;
+            buf[len] = '\0';
+            return atoi(buf);
+        }
+        while (len > 0) {
+            size_t chunk = len < sizeof(buf) ? len : sizeof(buf);
+            if (read_all(fd, buf, chunk) != 0) {
+                fprintf(stderr, "ERROR: Lost connection to project daemon\n");
+                return EXIT_FAILURE;
+            }
+            write_all(header[0] == '2' ? STDERR_FILENO : STDOUT_FILENO, buf, chunk);
+            len -= chunk;
+        }
+    }
+    fprintf(stderr, "ERROR: Lost connection to project daemon\n");
+    return EXIT_FAILURE;
+}
 
 int main(int argc, char** argv)
 {
     uid_t uid = getuid();
     uid_t euid = geteuid();
 
+    /* hand the command to the daemon if it's running */
+    if (!needs_local(argc, argv)) {
+        int fd = connect_daemon();
+        if (fd >= 0) {
+            int status = run_remote(fd, argc, argv);
+            close(fd);
+            return status;
+        }
+    }
+
     if (euid != 0) {
         fprintf(stderr, "WARNING: not running with superuser privileges\n");
     }
 
     /* copy argument array and NULL terminate the argument array */
-    char **args = malloc((argc + 1) * sizeof(*args));
+    char **args = malloc((argc + 4) * sizeof(*args));
     if (args == NULL) {
         fprintf(stderr, "Error: Failed to allocate memory\n");
         return EXIT_FAILURE;
     }
 
-    args[0] = (char *)script;
+    args[0] = "python3";
+    args[1] = "-I";
+    args[2] = "-c";
+    args[3] = (char *)launcher;
 
     int i;
     for (i = 1; i < argc; i++) {
         /* copy all arguments */
-        args[i] = argv[i];
+        args[i + 3] = argv[i];
     }
-    args[argc] = NULL;  /* NULL terminate the array of args */
+    args[argc + 3] = NULL;  /* NULL terminate the array of args */
 
     int ret = execvp(args[0], args);
     if (ret == -1) {
         const char * msg;
         switch (errno) {
             case ENOENT:
-                msg = "Could not find project_manager.py.";
+                msg = "Could not find python3.";
                 break;
             default:
                 msg = strerror(errno);